@@ -2,7 +2,7 @@ from django.contrib import admin
 from .models import *
 
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ['title', 'slug']
+    list_display = ['title', 'slug', 'product_count']
     prepopulated_fields = {'slug': ('title',)}
 admin.site.register(Category, CategoryAdmin)
 
@@ -26,4 +26,9 @@ admin.site.register(Wishlist, WishlistAdmin)
 
 class StatusAdmin(admin.ModelAdmin):
     list_display = ['name',]
-admin.site.register(Status, StatusAdmin)
\ No newline at end of file
+admin.site.register(Status, StatusAdmin)
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'status', 'priority', 'attempts', 'run_at', 'finished_at']
+    list_filter = ['status', 'name']
+admin.site.register(Job, JobAdmin)
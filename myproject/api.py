@@ -1,17 +1,61 @@
 from ninja import NinjaAPI, Schema, Field, Router
 from .models import *
 from ninja import UploadedFile, File
-from django.shortcuts import get_object_or_404
-from typing import List
+from django.shortcuts import get_object_or_404, aget_object_or_404
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from typing import Any, Dict, List, Literal
 from django.contrib.auth import authenticate, login, logout
 from ninja.security import django_auth
-from ninja.errors import HttpError, AuthenticationError
+from .tokens import TokenAuth, issue_token
+from .ratelimit import TokenBucket
+import math
+from ninja.errors import HttpError, AuthenticationError, Throttled
 from django.contrib.auth.models import User
 from ninja import Query
 from typing import Optional
-
-api = NinjaAPI()
+from ninja.pagination import paginate
+from ninja.decorators import decorate_view
+from .cache import CACHE_CONTROL, cache_response
+from .pagination import KeysetPagination
+from .fields import Fieldset, sparse
+from .images import variant_names, variant_urls
+from . import media
+from .search import search_products
+from .facets import MAX_BUCKETS, product_facets
+from .wishlists import MAX_OPERATIONS, apply_operations
+from . import product_cache
+from .product_cache import MAX_IDS
+from django.db.models import F
+from pydantic import model_validator
+from .importer import FORMATS, detect_format, import_products
+from .export import ORDER_ITEM_COLUMNS, PRODUCT_COLUMNS, export_response
+from .profiling import list_profiles, make_token, profile_path
+from .renderers import api_parser, api_renderer
+from .jobs import enqueue
+from django.http import FileResponse
+from django.conf import settings
+import json
+import zipfile
+from datetime import datetime
+
+api = NinjaAPI(renderer = api_renderer(), parser = api_parser())
 router = Router()
+token_auth = TokenAuth()
+
+
+@api.exception_handler(Throttled)
+def throttled(request, exc):
+    response = api.create_response(request, {"detail": str(exc)}, status=429)
+    if exc.wait is not None:
+        response['Retry-After'] = str(math.ceil(exc.wait))
+    return response
+
+
+# cache_response wraps the whole operation, so a cached answer is returned before
+# any throttle runs: only requests that reach the database spend tokens
+def has_text_filter(request):
+    return any(request.GET.get(name) for name in ('title', 'description', 'q'))
 
 
 ############## КАТЕГОРИИ-ПРОДУКТЫ ##############
@@ -32,67 +76,187 @@ def create_category(request, payload: CategoryIn):
     return {"id": category.id}
 
 @api.post("/create_product")
-def create_product(request, payload: ProductIn, image: UploadedFile = File(...)):
+async def create_product(request, payload: ProductIn, image: UploadedFile = File(...)):
     payload_dict = payload.dict()
-    category = get_object_or_404(Category, slug=payload_dict.pop('category'))
+    category = await aget_object_or_404(Category, slug=payload_dict.pop('category'))
     product = Product(**payload_dict, category=category)
-    product.image.save(image.name, image)
+    # hashing/writing the file and the INSERT block, keep them off the event loop
+    await sync_to_async(product.image.save)(image.name, image)
     return {"id": product.id}
 
 class CategoryOut(Schema):
     id: int
     title: str
     slug: str
+    product_count: int
+    min_price: Optional[float]
+    max_price: Optional[float]
+    avg_price: Optional[float]
 
-class ProductOut(Schema):
+# ProductOut without resolvers, for products already serialized (product_cache)
+class ProductData(Schema):
     id: int
     title: str
     slug: str
     category_id: int
     description: str
     price: float 
+    variants: Dict[str, str]
+
+class ProductOut(ProductData):
+    @staticmethod
+    def resolve_variants(obj):
+        return variant_urls(obj.image.name, obj.variants_source, obj.variants)
+
+# what the resolvers read, for the values() projections of list endpoints
+COMPUTED_FIELDS = {ProductOut: {'variants': (('image', 'variants_source', 'variants'), variant_urls)}}
+PRODUCT_FIELDS = Fieldset(ProductOut, COMPUTED_FIELDS)
 
 class ProductFilter(Schema):
-    min_price: Optional[float]
-    max_price: Optional[float]
-    title: Optional[str]
-    description: Optional[str]
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    title: Optional[str] = None
+    description: Optional[str] = None
+    category: Optional[int] = None
+    q: Optional[str] = None
+
+class ProductSearch(ProductFilter):
+    q: str
+
+class CategoryFacet(Schema):
+    id: int
+    title: str
+    slug: str
+    count: int
+
+class PriceRange(Schema):
+    min: Optional[float]
+    max: Optional[float]
+
+class PriceBucket(Schema):
+    min: float
+    max: float
+    count: int
+
+class FacetsOut(Schema):
+    count: int
+    price: PriceRange
+    categories: List[CategoryFacet]
+    price_buckets: List[PriceBucket]
+
+
+def filter_products(filters: ProductFilter):
+    qs = Product.objects.all()
+
+    if filters.min_price is not None:
+        qs = qs.filter(price__gte=filters.min_price)
+    if filters.max_price is not None:
+        qs = qs.filter(price__lte=filters.max_price)
+    if filters.title:
+        qs = qs.filter(title__icontains=filters.title)
+    if filters.description:
+        qs = qs.filter(description__icontains=filters.description)
+    if filters.category:
+        qs = qs.filter(category=filters.category)
+    if filters.q:
+        qs = search_products(qs, filters.q)
+    return qs
 
 @api.get("/category/{category_slug}", response=CategoryOut)
-def get_category(request, category_slug: str):
-    category = get_object_or_404(Category, slug=category_slug)
+@decorate_view(cache_response('category:{category_slug}'))
+async def get_category(request, category_slug: str):
+    category = await aget_object_or_404(Category, slug=category_slug)
     return category
 
 @router.get("/product/{product_id}", response=ProductOut)
-def get_product(request, product_id: int):
-    product = get_object_or_404(Product, id=product_id)
+@decorate_view(cache_response('product:{product_id}'))
+async def get_product(request, product_id: int):
+    product = await aget_object_or_404(Product, id=product_id)
     return product
 
+@router.get("/product/{product_id}/image")
+def get_product_image(request, product_id: int, variant: Optional[str] = None):
+    product = get_object_or_404(Product.objects.only('image', 'variants', 'variants_source'), id=product_id)
+    name = product.image.name
+    if variant is not None:
+        if variant not in variant_names():
+            raise HttpError(400, f'Unknown variant: {variant}')
+        name = product.variants.get(variant) if product.variants_ready else None
+    if not name:
+        raise HttpError(404, 'Not Found')
+    response = media.serve(request, name)
+    # the URL outlives the image: revalidate, the ETag makes that a 304
+    response['Cache-Control'] = CACHE_CONTROL
+    return response
+
+class ProductBatchOut(Schema):
+    items: List[ProductData]
+    missing: List[int]
+
+def load_products(ids):
+    qs = Product.objects.filter(id__in=ids)
+    return {product.id: ProductOut.from_orm(product).model_dump() for product in qs}
+
+@api.get("/products/batch", response=ProductBatchOut)
+def get_products(request, ids: List[int] = Query(..., min_length=1, max_length=MAX_IDS)):
+    found = product_cache.get_many(ids, load_products)
+    ids = list(dict.fromkeys(ids))
+    return {
+        "items": [found[pk] for pk in ids if pk in found],
+        "missing": [pk for pk in ids if pk not in found],
+    }
+
 @api.get("/categories", response=List[CategoryOut])
-def list_categories(request):
+@decorate_view(cache_response('categories'))
+async def list_categories(request):
     qs = Category.objects.all()
-    return qs
-
-@api.get("/products", response=List[ProductOut])
-def list_product(request,
-                min_price: Optional[float] = None,
-                max_price: Optional[float] = None,
-                title: Optional[str] = None,
-                description: Optional[str] = None,
-                category: Optional[int] = None):
-    qs = Product.objects.all()
-
-    if min_price is not None:
-        qs = qs.filter(price__gte=min_price)
-    if max_price is not None:
-        qs = qs.filter(price__lte=max_price)
-    if title:
-        qs = qs.filter(title__icontains=title)
-    if description:
-        qs = qs.filter(description__icontains=description)
-    if category:
-        qs = qs.filter(category=category)
-    return qs
+    return [category async for category in qs]
+
+@api.get("/products", response=List[sparse(ProductOut)], exclude_unset=True,
+         throttle=TokenBucket('text_search', when=has_text_filter))
+@decorate_view(cache_response('products'))
+@paginate(KeysetPagination, ordering=('title', 'id'))
+async def list_product(request, filters: ProductFilter = Query(...), fields: Optional[str] = None):
+    return PRODUCT_FIELDS.project(filter_products(filters), fields)
+
+@api.get("/products/search", response=List[sparse(ProductOut)], exclude_unset=True,
+         throttle=TokenBucket('text_search'))
+@decorate_view(cache_response('products'))
+@paginate(KeysetPagination, ordering=('search_rank', 'id'))
+async def search_product(request, filters: ProductSearch = Query(...), fields: Optional[str] = None):
+    return PRODUCT_FIELDS.project(filter_products(filters), fields)
+
+@api.get("/products/facets", response=FacetsOut)
+@decorate_view(cache_response('products', 'categories'))
+async def product_facets_view(request, filters: ProductFilter = Query(...), buckets: int = Query(10, ge=1, le=MAX_BUCKETS)):
+    return await sync_to_async(product_facets)(filter_products(filters), buckets)
+
+@api.get("/export/products")
+def export_products(request, format: Literal['ndjson', 'csv'] = 'ndjson', filters: ProductFilter = Query(...)):
+    qs = filter_products(filters).order_by('id')
+    return export_response(request, qs, PRODUCT_COLUMNS, format, 'products')
+
+class ImportRowError(Schema):
+    row: int
+    error: str
+
+class ImportOut(Schema):
+    imported: int
+    failed: int
+    errors: List[ImportRowError]
+
+@api.post("/import_products", response=ImportOut)
+def bulk_import_products(request,
+                         file: UploadedFile = File(...),
+                         images: UploadedFile = File(None),
+                         format: Optional[str] = None):
+    format = format or detect_format(file.name)
+    if format not in FORMATS:
+        raise HttpError(400, f'Unknown format, expected one of {", ".join(FORMATS)}')
+    try:
+        return import_products(file.file, format, images.file if images else None)
+    except zipfile.BadZipFile:
+        raise HttpError(400, 'Images must be a zip archive')
 
 @api.put("/products/{product_id}")
 def update_product(request, product_id: int, payload: ProductIn):
@@ -154,17 +318,17 @@ def get_users(request):
         raise HttpError(403, 'No rights + maidenless + parried')
     
 
-@api.post('/login')
+@api.post('/login', throttle = TokenBucket('login', by_user = False))
 def login_user(request, payload: UserLogin):
     user = authenticate(username = payload.username, password = payload.password)
     if user is not None:
         login(request, user)
         print(user.username)
-        return {"success": True}
+        return {"success": True, "token": issue_token(user), "expires_in": settings.API_TOKEN_MAX_AGE}
     raise AuthenticationError("AUTHENTICATION ERROR")
 
 
-@api.post('/registration')
+@api.post('/registration', throttle = TokenBucket('registration', by_user = False))
 def registration_user(request, payload: UserRegistration):
     if User.objects.filter(username = payload.username).exists():
         raise HttpError(400, 'This user exists')
@@ -179,6 +343,11 @@ def registration_user(request, payload: UserRegistration):
     return {"success": True}
 
 
+@api.post('/token/refresh', auth = token_auth)
+def refresh_token(request):
+    return {"token": issue_token(request.auth), "expires_in": settings.API_TOKEN_MAX_AGE}
+
+
 @api.post('/logout', auth = None)
 def logout_user(request):
     logout(request)
@@ -197,6 +366,23 @@ class WishlistOut(Schema):
     quantity: int
 
 
+class WishlistOperation(Schema):
+    product: int
+    delta: Optional[int] = None
+    quantity: Optional[int] = Field(None, ge = 0)
+
+    @model_validator(mode = 'after')
+    def check_change(self):
+        if (self.delta is None) == (self.quantity is None):
+            raise ValueError('Give either delta or quantity')
+        return self
+
+
+class WishlistBatchIn(Schema):
+    user: int
+    operations: List[WishlistOperation] = Field(..., min_length = 1, max_length = MAX_OPERATIONS)
+
+
 class StatusOut(Schema):
     name: str
 
@@ -218,6 +404,8 @@ class OrderItemOut(Schema):
     price: float
     quantity: int
 
+ORDER_ITEM_FIELDS = Fieldset(OrderItemOut, COMPUTED_FIELDS)
+
 
 class OrderItemIn(Schema):
     order: int
@@ -226,84 +414,103 @@ class OrderItemIn(Schema):
     quantity: int
 
 @api.get('/get_wishlist/{user_id}/', response = List[WishlistOut])
-def get_wishlist(request, user_id: int):
-    user = get_object_or_404(User, id = user_id)
-    wishlist = Wishlist.objects.filter(user = user)
-    return wishlist
+async def get_wishlist(request, user_id: int):
+    user = await aget_object_or_404(User, id = user_id)
+    wishlist = Wishlist.objects.filter(user = user).select_related('product')
+    return [item async for item in wishlist]
 
 
 @api.post('/create_wishlist', response = WishlistOut)
 def create_wishlist(request, payload: WishlistIn):
-    payload_dict = payload.dict()
-    user = get_object_or_404(User, id = payload_dict.pop('user'))
-    product = get_object_or_404(Product, id = payload_dict.pop('product'))
+    user = get_object_or_404(User, id = payload.user)
+    product = get_object_or_404(Product, id = payload.product)
+    # one upsert on the user_product constraint instead of exists/get/save
+    wishlist = Wishlist(user = user, product = product, quantity = payload.quantity)
+    Wishlist.objects.bulk_create(
+        [wishlist], update_conflicts = True, unique_fields = ['user', 'product'], update_fields = ['quantity'],
+    )
+    return wishlist
 
-    if Wishlist.objects.filter(user = user, product = product).exists():
-        wishlist = get_object_or_404(Wishlist, user = user, product = product)
-        wishlist.quantity = payload_dict.pop('quantity')
-    else:
-        wishlist = Wishlist(**payload_dict, user = user, product = product)    
 
-    wishlist.save()
-    return wishlist
+@api.post('/wishlist/batch', response = List[WishlistOut])
+def batch_wishlist(request, payload: WishlistBatchIn):
+    get_object_or_404(User, id = payload.user)
+    products = {operation.product for operation in payload.operations}
+    if Product.objects.filter(id__in = products).count() != len(products):
+        raise HttpError(404, 'Product not found')
+    touched = apply_operations(
+        payload.user,
+        [(operation.product, operation.delta, operation.quantity) for operation in payload.operations],
+    )
+    wishlist = Wishlist.objects.filter(user_id = payload.user, product_id__in = touched)
+    return wishlist.select_related('product').order_by('product_id')
 
 
 @api.put('/wishlist/add', response = WishlistOut)
 def add_to_wishlist(request, wishlist_id: int):
-    wishlist = get_object_or_404(Wishlist, id = wishlist_id)
-    wishlist.quantity += 1
-    wishlist.save()
-    return wishlist
+    Wishlist.objects.filter(id = wishlist_id).update(quantity = F('quantity') + 1)
+    return get_object_or_404(Wishlist.objects.select_related('product'), id = wishlist_id)
 
 
 @api.put('/wishlist/remove', response = WishlistOut)
 def remove_from_wishlist(request, wishlist_id: int):
-    wishlist = get_object_or_404(Wishlist, id = wishlist_id)
-    wishlist.quantity -= 1
-
-    if wishlist.quantity == 0:
-        wishlist.delete()
-    else:
-        wishlist.save()
+    with transaction.atomic():
+        Wishlist.objects.filter(id = wishlist_id, quantity__gt = 0).update(quantity = F('quantity') - 1)
+        wishlist = get_object_or_404(Wishlist.objects.select_related('product'), id = wishlist_id)
+        if wishlist.quantity == 0:
+            wishlist.delete()
 
     return wishlist
 
 
-@api.get('/get_orders', response = List[OrderItemOut])
-def list_orders(request):
-    return OrderItem.objects.all()
+@api.get('/get_orders', response = List[sparse(OrderItemOut)], exclude_unset = True)
+@paginate(KeysetPagination, ordering = ('order__created_at', 'id'))
+async def list_orders(request, fields: Optional[str] = None):
+    return ORDER_ITEM_FIELDS.project(OrderItem.objects.all(), fields)
+
+
+@api.get('/export/orders')
+def export_orders(request, format: Literal['ndjson', 'csv'] = 'ndjson'):
+    qs = OrderItem.objects.order_by('id')
+    return export_response(request, qs, ORDER_ITEM_COLUMNS, format, 'orders')
 
 
 @api.get('/order/{user_id}/', response = List[OrderOut])
-def get_user_orders(request, user_id: int):
-    user = get_object_or_404(User, id = user_id)
-    orders = Order.objects.filter(user = user)
+@paginate(KeysetPagination, ordering = ('created_at', 'id'))
+async def get_user_orders(request, user_id: int):
+    user = await aget_object_or_404(User, id = user_id)
+    orders = Order.objects.filter(user = user).select_related('status')
     return orders
 
 @api.get('/order/items/{order_id}/', response = List[OrderItemOut])
-def get_order_items(request, order_id: int):
-    order = get_object_or_404(Order, id = order_id)
-    order_items = OrderItem.objects.filter(order = order)
-    return order_items
+async def get_order_items(request, order_id: int):
+    order = await aget_object_or_404(Order, id = order_id)
+    order_items = OrderItem.objects.filter(order = order).select_related('order__status', 'product')
+    return [item async for item in order_items]
 
 
-@api.post('/create_order', response = OrderOut)
+@api.post('/create_order', response = OrderOut, throttle = TokenBucket('create_order'))
 def create_order(request, wishlists: List[int]):
-    status = get_object_or_404(Status, id = 1)
-    wishlist = get_object_or_404(Wishlist, id = wishlists[0])
-    order = Order(user = wishlist.user, status = status, total = 0)   
-    order.save()
-    for item in wishlists:
-        wishlist = get_object_or_404(Wishlist, id = item)
-        OrderItem.objects.create(
-            order = order,
-            product = wishlist.product,
-            quantity = wishlist.quantity,
-            price = wishlist.product.price * wishlist.quantity
+    if not wishlists:
+        raise HttpError(400, 'Order is empty')
+    with transaction.atomic():
+        status = get_object_or_404(Status, id = 1)
+        found = Wishlist.objects.select_related('product').in_bulk(wishlists)
+        if len(found) != len(set(wishlists)):
+            raise HttpError(404, 'Wishlist not found')
+
+        order = Order.objects.create(user_id = found[wishlists[0]].user_id, status = status, total = 0)
+        OrderItem.objects.bulk_create(
+            OrderItem(
+                order = order,
+                product = wishlist.product,
+                quantity = wishlist.quantity,
+                price = wishlist.product.price * wishlist.quantity
+            )
+            for wishlist in found.values()
         )
-    
-    order.total += order.get_total_price()  
-    order.save()
+        order.total = order.get_total_price()
+        order.save(update_fields = ['total'])
 
     return order
 
@@ -317,4 +524,103 @@ def change_status(request, order_id: int, status_id: int):
     return order
 
 
+
+############## ПРОФИЛИ ЗАПРОСОВ ##############
+def check_staff(request):
+    if not request.user.is_staff:
+        raise HttpError(403, 'Staff only')
+
+
+@api.get('/profiles', auth = [token_auth, django_auth])
+def get_profiles(request):
+    check_staff(request)
+    return list_profiles()
+
+
+@api.post('/profiles/token', auth = [token_auth, django_auth])
+def create_profile_token(request):
+    check_staff(request)
+    return {'header': 'X-Profile', 'token': make_token(), 'expires_in': settings.PROFILING_TOKEN_MAX_AGE}
+
+
+@api.get('/profiles/{profile_id}', auth = [token_auth, django_auth])
+def get_profile(request, profile_id: str):
+    check_staff(request)
+    path = profile_path(profile_id, '.json')
+    if path is None:
+        raise HttpError(404, 'Profile not found')
+    with open(path) as f:
+        return json.load(f)
+
+
+@api.get('/profiles/{profile_id}/download', auth = [token_auth, django_auth])
+def download_profile(request, profile_id: str):
+    check_staff(request)
+    path = profile_path(profile_id, '.prof')
+    if path is None:
+        raise HttpError(404, 'Profile not found')
+    return FileResponse(open(path, 'rb'), as_attachment = True, filename = f'{profile_id}.prof')
+
+
+
+############## ФОНОВЫЕ ЗАДАЧИ ##############
+# orders per bulk job; a job's args are one JSON value in its row
+MAX_JOB_ORDERS = 10000
+
+
+class JobOut(Schema):
+    id: int
+    name: str
+    status: str
+    priority: int
+    attempts: int
+    max_attempts: int
+    run_at: datetime
+    created_at: datetime
+    finished_at: Optional[datetime]
+    last_error: str
+    result: Optional[Any]
+
+
+class OrdersJobIn(Schema):
+    order_ids: List[int] = Field(..., min_length = 1, max_length = MAX_JOB_ORDERS)
+    priority: int = 0
+
+
+class OrdersStatusIn(OrdersJobIn):
+    status_id: int
+
+
+@api.get('/jobs', response = List[JobOut], auth = [token_auth, django_auth])
+def get_jobs(request, status: Optional[str] = None, name: Optional[str] = None, limit: int = Query(100, ge = 1, le = 1000)):
+    check_staff(request)
+    jobs = Job.objects.order_by('-created_at', '-id')
+    if status:
+        jobs = jobs.filter(status = status)
+    if name:
+        jobs = jobs.filter(name = name)
+    return jobs[:limit]
+
+
+@api.get('/jobs/{job_id}', response = JobOut, auth = [token_auth, django_auth])
+def get_job(request, job_id: int):
+    check_staff(request)
+    return get_object_or_404(Job, id = job_id)
+
+
+@api.post('/orders/status', response = {202: JobOut}, auth = [token_auth, django_auth])
+def set_orders_status(request, data: OrdersStatusIn):
+    check_staff(request)
+    get_object_or_404(Status, id = data.status_id)
+    job = enqueue('orders.set_status', priority = data.priority, order_ids = data.order_ids, status_id = data.status_id)
+    return 202, job
+
+
+@api.post('/orders/recompute_totals', response = {202: JobOut}, auth = [token_auth, django_auth])
+def recompute_order_totals(request, data: OrdersJobIn):
+    check_staff(request)
+    job = enqueue('orders.recompute_totals', priority = data.priority, order_ids = data.order_ids)
+    return 202, job
+
+
 api.add_router("", router)
\ No newline at end of file
@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+
+
+class MyprojectConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'myproject'
+
+    def ready(self):
+        from . import signals, tasks
+        from .search import ensure_index
+        from .db import configure_connection, install_query_hook
+        post_migrate.connect(ensure_index, sender = self)
+        connection_created.connect(configure_connection)
+        connection_created.connect(install_query_hook)
@@ -3,6 +3,17 @@ ASGI config for myproject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The read endpoints, uploads and exports in myproject.api are async, so under ASGI
+a slow client costs a coroutine instead of a worker thread. To serve it:
+
+    pip install uvicorn gunicorn
+    gunicorn myproject.asgi:application -k uvicorn.workers.UvicornWorker \
+        --workers 4 --keep-alive 5 --graceful-timeout 30
+
+or, for a single process, ``uvicorn myproject.asgi:application --workers 4``.
+Sync endpoints still work; Django runs them in a thread pool. Compare both paths
+with ``manage.py bench_asgi``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
@@ -0,0 +1,29 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    The sqlite3 backend with Django 5.1's OPTIONS['transaction_mode'].
+
+    transaction.atomic() opens a DEFERRED transaction: it reads under a shared
+    lock and upgrades to the write lock at its first write. When another
+    connection writes meanwhile, SQLite fails the upgrade at once with "database
+    is locked", since waiting could deadlock, and `timeout` never applies.
+    'IMMEDIATE' takes the write lock at BEGIN, where busy writers are waited for.
+    """
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        mode = kwargs.pop('transaction_mode', None)
+        if mode is not None and mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(f'transaction_mode must be one of {", ".join(TRANSACTION_MODES)}')
+        self.transaction_mode = mode.upper() if mode else None
+        return kwargs
+
+    def _start_transaction_under_autocommit(self):
+        if getattr(self, 'transaction_mode', None) is None:
+            return super()._start_transaction_under_autocommit()
+        self.cursor().execute(f'BEGIN {self.transaction_mode}')
@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import time
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+
+from .compression import accepted_encoding, compress, compressible, encode
+
+RESPONSE_TIMEOUT = 60 * 60
+CACHE_CONTROL = 'public, no-cache'
+# cached in place of a compressed copy that would not have been smaller than the body
+IDENTITY = 'identity'
+
+
+def _version_key(namespace):
+    return f'api:version:{namespace}'
+
+
+def get_versions(namespaces):
+    keys = [_version_key(namespace) for namespace in namespaces]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # seeded from the clock, so a flushed cache never hands out an old ETag again
+            cache.add(key, time.time_ns(), timeout = None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def _bump(namespaces):
+    for namespace in namespaces:
+        key = _version_key(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), timeout = None)
+
+
+def invalidate(*namespaces):
+    """Move the given namespaces to a new version once the current transaction commits.
+    Responses cached under the old version are never read again and simply expire."""
+    transaction.on_commit(lambda: _bump(namespaces))
+
+
+def _conditional(request, namespaces, kwargs):
+    names = [namespace.format(**kwargs) for namespace in namespaces]
+    versions = get_versions(names)
+    query = urlencode(sorted(request.GET.lists()), doseq = True)
+    key = '|'.join([request.path, query] + [f'{n}={v}' for n, v in zip(names, versions)])
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    etag = f'"{digest[:32]}"'
+    # compressed responses carry the weak form, W/"..."
+    not_modified = etag in {tag.removeprefix('W/') for tag in parse_etags(request.headers.get('If-None-Match', ''))}
+    return f'api:response:{digest}', etag, not_modified
+
+
+def _cached(key, encoding, timeout):
+    keys = [key, f'{key}:{encoding}'] if encoding else [key]
+    entries = cache.get_many(keys)
+    entry = entries.get(key)
+    if entry is not None:
+        response = HttpResponse(entry['content'], content_type = entry['content_type'])
+        return _compressed(response, key, encoding, timeout, entries.get(keys[-1]) if encoding else None)
+
+
+def _compressed(response, key, encoding, timeout, content = None):
+    """Encode a cached body, compressing it only the first time: the outcome is stored
+    next to the body under `<key>:<encoding>`, with the same lifetime. That is the
+    compressed copy when encode() applied it, or IDENTITY when it declined because
+    the copy was no smaller, so the body is then served as is without trying again."""
+    if encoding is None or not compressible(response):
+        return response
+    if content is None:
+        response = encode(response, compress(response.content, encoding), encoding)
+        applied = response.has_header('Content-Encoding')
+        cache.set(f'{key}:{encoding}', response.content if applied else IDENTITY, timeout)
+        return response
+    if content == IDENTITY:
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    return encode(response, content, encoding)
+
+
+def _store(key, response, timeout):
+    if response.status_code != 200 or response.streaming:
+        return False
+    cache.set(key, {
+        'content': response.content,
+        'content_type': response['Content-Type'],
+    }, timeout)
+    return True
+
+
+def _tag(response, etag):
+    response['ETag'] = f'W/{etag}' if response.has_header('Content-Encoding') else etag
+    response['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def cache_response(*namespaces, timeout = RESPONSE_TIMEOUT):
+    """
+    View decorator for `decorate_view`: caches the rendered body of a GET operation
+    under a key built from the request and the current versions of `namespaces`.
+    Namespaces may reference path parameters, e.g. 'product:{product_id}'.
+
+    The ETag is derived from the versioned key, so `If-None-Match` is answered with
+    304 without reading the body or touching the database. Bodies are compressed
+    for the client's Accept-Encoding once per encoding and the result is cached
+    too (see _compressed). Works for sync and async operations alike.
+    """
+    def decorator(run):
+        if asyncio.iscoroutinefunction(run):
+            @wraps(run)
+            async def async_wrapper(request, *args, **kwargs):
+                if request.method != 'GET':
+                    return await run(request, *args, **kwargs)
+                # cache calls stay synchronous: LocMemCache is an in-process dict lookup
+                key, etag, not_modified = _conditional(request, namespaces, kwargs)
+                if not_modified:
+                    return _tag(HttpResponseNotModified(), etag)
+                encoding = accepted_encoding(request)
+                response = _cached(key, encoding, timeout)
+                if response is None:
+                    response = await run(request, *args, **kwargs)
+                    if not _store(key, response, timeout):
+                        return response
+                    response = _compressed(response, key, encoding, timeout)
+                return _tag(response, etag)
+            return async_wrapper
+
+        @wraps(run)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET':
+                return run(request, *args, **kwargs)
+            key, etag, not_modified = _conditional(request, namespaces, kwargs)
+            if not_modified:
+                return _tag(HttpResponseNotModified(), etag)
+            encoding = accepted_encoding(request)
+            response = _cached(key, encoding, timeout)
+            if response is None:
+                response = run(request, *args, **kwargs)
+                if not _store(key, response, timeout):
+                    return response
+                response = _compressed(response, key, encoding, timeout)
+            return _tag(response, etag)
+        return wrapper
+    return decorator
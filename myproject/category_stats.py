@@ -0,0 +1,64 @@
+from decimal import Decimal
+
+from django.db.models import Count, F, Max, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+
+from .cache import invalidate
+from .models import Category, Product
+
+STATS_FIELDS = ('product_count', 'price_total', 'min_price', 'max_price')
+
+
+def aggregates(product_model = Product):
+    """Update expressions computing every stats field of a category from its products,
+    as correlated subqueries. Usable with historical models in migrations."""
+    products = product_model.objects.filter(category = OuterRef('pk')).order_by().values('category')
+
+    def aggregate(expression):
+        return Subquery(products.annotate(value = expression).values('value'))
+
+    return {
+        'product_count': Coalesce(aggregate(Count('id')), 0),
+        'price_total': Coalesce(aggregate(Sum('price')), Value(Decimal(0))),
+        'min_price': aggregate(Min('price')),
+        'max_price': aggregate(Max('price')),
+    }
+
+
+def refresh(category_ids = None):
+    """Recompute the stored stats from scratch, for all categories or the given ones."""
+    categories = Category.objects.all()
+    if category_ids is not None:
+        categories = categories.filter(pk__in = category_ids)
+    return categories.update(**aggregates())
+
+
+# product_added and product_removed apply deltas: they run in the transaction of
+# the product write they account for (Product.save, and the deletion collector's),
+# so a failure rolls both back and concurrent writers take turns
+
+
+def product_added(category_id, price):
+    price = Value(Decimal(str(price)))
+    Category.objects.filter(pk = category_id).update(
+        product_count = F('product_count') + 1,
+        price_total = F('price_total') + price,
+        min_price = Least(Coalesce('min_price', price), price),
+        max_price = Greatest(Coalesce('max_price', price), price),
+    )
+
+
+def product_removed(category_id, price):
+    # count and total shift; the new bounds are one seek each on the (category, price) index
+    products = Product.objects.filter(category = OuterRef('pk')).order_by().values('price')
+    Category.objects.filter(pk = category_id).update(
+        product_count = F('product_count') - 1,
+        price_total = F('price_total') - Value(Decimal(str(price))),
+        min_price = Subquery(products.order_by('price')[:1]),
+        max_price = Subquery(products.order_by('-price')[:1]),
+    )
+
+
+def invalidate_categories(category_ids):
+    slugs = Category.objects.filter(pk__in = category_ids).values_list('slug', flat = True)
+    invalidate('categories', *(f'category:{slug}' for slug in slugs))
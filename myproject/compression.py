@@ -0,0 +1,119 @@
+import gzip
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+def _gzip(content):
+    # mtime 0 keeps the output a function of the body, like a cached copy should be
+    return gzip.compress(content, compresslevel = settings.COMPRESSION_GZIP_LEVEL, mtime = 0)
+
+
+def _brotli(content):
+    return brotli.compress(content, quality = settings.COMPRESSION_BROTLI_QUALITY)
+
+
+# in order of preference
+COMPRESSORS = {'br': _brotli, 'gzip': _gzip} if brotli else {'gzip': _gzip}
+
+
+def accepted_encoding(request):
+    """The preferred encoding among COMPRESSORS that Accept-Encoding allows, or None."""
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if not header:
+        return None
+    weights = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in COMPRESSORS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compressible(response):
+    return (
+        not response.streaming
+        and not response.has_header('Content-Encoding')
+        and response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES)
+        and len(response.content) >= settings.COMPRESSION_MIN_SIZE
+    )
+
+
+def compress(content, encoding):
+    return COMPRESSORS[encoding](content)
+
+
+def encode(response, content, encoding):
+    """Replace the body of `response` with its `encoding` compressed `content`,
+    unless that would not make it any smaller."""
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if len(content) >= len(response.content):
+        return response
+    response.content = content
+    response['Content-Length'] = str(len(content))
+    response['Content-Encoding'] = encoding
+    # a strong ETag names one exact body; the encoded one is only equivalent
+    etag = response.get('ETag')
+    if etag and etag.startswith('"'):
+        response['ETag'] = 'W/' + etag
+    return response
+
+
+def compress_response(request, response):
+    if not compressible(response):
+        return response
+    encoding = accepted_encoding(request)
+    if encoding is None:
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    return encode(response, compress(response.content, encoding), encoding)
+
+
+class CompressionMiddleware:
+    """
+    gzip or, with the brotli package installed, Brotli compression of responses
+    under COMPRESSION_PATH_PREFIX of at least COMPRESSION_MIN_SIZE bytes, as the
+    client's Accept-Encoding allows. Responses that already carry a
+    Content-Encoding, such as the precompressed copies served by
+    cache.cache_response, are left alone, as are streamed ones.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.process(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process(request, await self.get_response(request))
+
+    def process(self, request, response):
+        if not request.path.startswith(settings.COMPRESSION_PATH_PREFIX):
+            return response
+        return compress_response(request, response)
@@ -0,0 +1,57 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+
+def connection_pragmas(settings_dict):
+    return {**settings.SQLITE_PRAGMAS, **settings_dict.get('PRAGMAS', {})}
+
+
+def apply_pragmas(raw_connection, pragmas):
+    for name, value in pragmas.items():
+        raw_connection.execute(f'PRAGMA {name} = {value}')
+
+
+def configure_connection(sender, connection, **kwargs):
+    """connection_created hook: apply the SQLite profile to every new connection."""
+    if connection.vendor != 'sqlite':
+        return
+    apply_pragmas(connection.connection, connection_pragmas(connection.settings_dict))
+
+
+# query logs of the enclosing capture_queries() blocks; asgiref copies the context
+# into sync_to_async threads, so queries of async views are seen too
+_query_logs = ContextVar('query_logs', default = ())
+
+
+def record_query(execute, sql, params, many, context):
+    logs = _query_logs.get()
+    if not logs:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        entry = (context['connection'].alias, sql, time.perf_counter() - started)
+        for log in logs:
+            log.append(entry)
+
+
+def install_query_hook(sender, connection, **kwargs):
+    """connection_created hook: make every connection report to capture_queries()."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def capture_queries():
+    """Collect (alias, sql, seconds) of the queries run inside the block, on any
+    connection of this context. Blocks may nest; each sees its own queries."""
+    log = []
+    token = _query_logs.set(_query_logs.get() + (log,))
+    try:
+        yield log
+    finally:
+        _query_logs.reset(token)
@@ -0,0 +1,84 @@
+from math import floor, log10
+
+from django.db.models import Count, ExpressionWrapper, IntegerField, Max, Min
+from django.db.models.functions import Cast
+
+MAX_BUCKETS = 50
+STEPS = (1, 2, 2.5, 5, 10)
+
+
+def bucket_width(low, high, buckets):
+    """The smallest round whole width (1, 2, 2.5 or 5 times a power of ten, at least 1)
+    that splits [low, high] into at most `buckets` buckets, give or take one at the
+    edges. Prices are whole numbers, so a fractional width would only leave empty
+    buckets, or buckets that overlap on the same prices."""
+    raw = max((high - low) / buckets, 1)
+    magnitude = 10 ** floor(log10(raw))
+    return next(int(step * magnitude) for step in STEPS if step * magnitude >= raw and step * magnitude % 1 == 0)
+
+
+def category_counts(queryset):
+    """Grouped by category in one query: [{id, title, slug, count, min, max}], largest first."""
+    rows = (
+        queryset.order_by()
+        .values('category_id', 'category__title', 'category__slug')
+        .annotate(count = Count('id'), min = Min('price'), max = Max('price'))
+        .order_by('-count', 'category__title')
+    )
+    return [
+        {
+            'id': row['category_id'],
+            'title': row['category__title'],
+            'slug': row['category__slug'],
+            'count': row['count'],
+            'min': float(row['min']),
+            'max': float(row['max']),
+        }
+        for row in rows
+    ]
+
+
+def price_buckets(queryset, low, high, buckets):
+    """Equal-width price histogram between low and high in one grouped query. Every
+    bucket is listed, empty ones included; `max` is exclusive except in the last one.
+    Buckets are numbered with integer division on the whole prices, so a price on a
+    boundary always opens the upper bucket."""
+    width = bucket_width(low, high, buckets)
+    start = int(low) // width * width
+    total = (int(high) - start) // width + 1
+    offset = ExpressionWrapper((Cast('price', IntegerField()) - start) / width, output_field = IntegerField())
+    rows = (
+        queryset.order_by()
+        .annotate(bucket = offset)
+        .values('bucket')
+        .annotate(count = Count('id'))
+    )
+    counts = [0] * total
+    for row in rows:
+        counts[min(max(row['bucket'], 0), total - 1)] += row['count']
+    return [
+        {'min': float(start + i * width), 'max': float(start + (i + 1) * width), 'count': count}
+        for i, count in enumerate(counts)
+    ]
+
+
+def product_facets(queryset, buckets = 10):
+    """Category counts, price range and price histogram of a product queryset, in two queries."""
+    categories = category_counts(queryset)
+    if not categories:
+        return {'count': 0, 'price': {'min': None, 'max': None}, 'categories': [], 'price_buckets': []}
+    low = min(category['min'] for category in categories)
+    high = max(category['max'] for category in categories)
+    count = sum(category['count'] for category in categories)
+    if low == high:
+        buckets = [{'min': low, 'max': high, 'count': count}]
+    else:
+        buckets = price_buckets(queryset, low, high, min(buckets, MAX_BUCKETS))
+    return {
+        'count': count,
+        'price': {'min': low, 'max': high},
+        'categories': [
+            {key: category[key] for key in ('id', 'title', 'slug', 'count')} for category in categories
+        ],
+        'price_buckets': buckets,
+    }
@@ -0,0 +1,113 @@
+from functools import lru_cache
+from typing import Optional
+
+from ninja import Schema
+from ninja.errors import HttpError
+from pydantic import BaseModel, create_model
+
+
+def nested_schema(annotation):
+    return annotation if isinstance(annotation, type) and issubclass(annotation, BaseModel) else None
+
+
+@lru_cache(maxsize = None)
+def sparse(schema):
+    """`schema` with every field optional and no resolvers, nested schemas included:
+    the item type of list responses whose rows may carry only some fields."""
+    fields = {}
+    for name, field in schema.model_fields.items():
+        nested = nested_schema(field.annotation)
+        fields[name] = (Optional[sparse(nested) if nested else field.annotation], None)
+    return create_model(f'Sparse{schema.__name__}', __base__ = Schema, **fields)
+
+
+class Fieldset:
+    """
+    Sparse fieldsets for a list endpoint returning `schema`: `fields=id,title` or
+    `fields=quantity,product.title,order` (a nested schema brings all its fields).
+
+    `project` turns the queryset into a values() query of the selected columns
+    only, so neither unused columns nor unused joins reach the SQL, paired with
+    the function shaping its rows into the nested dicts `sparse(schema)` expects.
+    Operations using it set exclude_unset=True, leaving unselected fields out of
+    the JSON.
+
+    Schema field names are model field names, e.g. OrderItemOut.product.title is
+    the product__title column. Fields filled in by a resolver are declared in
+    `computed` as {schema: {field: (columns, function)}}; the function gets the
+    columns' values of the row.
+    """
+
+    def __init__(self, schema, computed = None):
+        self.schema = schema
+        self.computed = computed or {}
+        # dotted path -> (columns, function or None)
+        self.leaves = dict(self.walk(schema, ''))
+
+    def walk(self, schema, prefix):
+        computed = self.computed.get(schema, {})
+        for name, field in schema.model_fields.items():
+            path = prefix + name
+            nested = nested_schema(field.annotation)
+            if name in computed:
+                columns, function = computed[name]
+                yield path, (tuple(self.column(prefix + column) for column in columns), function)
+            elif nested:
+                yield from self.walk(nested, path + '.')
+            else:
+                yield path, ((self.column(path),), None)
+
+    @staticmethod
+    def column(path):
+        return path.replace('.', '__')
+
+    def select(self, fields):
+        """The leaf paths `fields` asks for, all of them when it is empty."""
+        if not fields:
+            return list(self.leaves)
+        names = [name.strip() for name in fields.split(',') if name.strip()]
+        selected, unknown = {}, []
+        for name in names:
+            matches = [path for path in self.leaves if path == name or path.startswith(name + '.')]
+            if not matches:
+                unknown.append(name)
+            selected.update(dict.fromkeys(matches))
+        if unknown:
+            raise HttpError(400, f'Unknown fields: {", ".join(unknown)}')
+        return list(selected)
+
+    def project(self, queryset, fields):
+        paths = self.select(fields)
+        columns = dict.fromkeys(column for path in paths for column in self.leaves[path][0])
+        return Projection(queryset.values(*columns), self.shaper(paths))
+
+    def shaper(self, paths):
+        """A function turning a values() row into the nested dict of `paths`."""
+        leaves = [(path.split('.'), *self.leaves[path]) for path in paths]
+
+        def shape(row):
+            item = {}
+            for parts, columns, function in leaves:
+                target = item
+                for part in parts[:-1]:
+                    target = target.setdefault(part, {})
+                if function:
+                    target[parts[-1]] = function(*(row[column] for column in columns))
+                else:
+                    target[parts[-1]] = row[columns[0]]
+            return item
+
+        return shape
+
+
+class Projection:
+    """
+    What Fieldset.project returns: a plain values() queryset, which can still be
+    filtered, annotated and sliced, and `shape` for its rows. KeysetPagination
+    pages the queryset and shapes only the rows of the page.
+    """
+    __slots__ = ('queryset', 'shape')
+
+    def __init__(self, queryset, shape):
+        self.queryset = queryset
+        self.shape = shape
@@ -0,0 +1,117 @@
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from PIL import Image, ImageOps
+
+from .cache import invalidate
+from .jobs import enqueue
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+# name -> bounding box; every size is written as JPEG and WebP
+SIZES = {
+    'thumb': (200, 200),
+    'medium': (800, 800),
+}
+FORMATS = {
+    'jpeg': ('JPEG', '.jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', '.webp', {'quality': 80, 'method': 4}),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(settings.IMAGE_VARIANT_QUEUE)
+
+
+def variant_names():
+    return [f'{size}_{format}' for size in SIZES for format in FORMATS]
+
+
+def variant_urls(image, variants_source, variants):
+    """{variant: URL} of a product's variants, empty while they are missing or were
+    built from a previous image."""
+    if not image or variants_source != image:
+        return {}
+    storage = Product._meta.get_field('image').storage
+    return {variant: storage.url(name) for variant, name in variants.items()}
+
+
+def render_variants(source):
+    """Write every variant of the stored image `source` and return {variant: name}.
+    Touches only the storage, so it is safe to run in another process."""
+    storage = Product._meta.get_field('image').storage
+    directory = source.rsplit('/', 1)[0] if '/' in source else ''
+    variants = {}
+    with storage.open(source) as fp, Image.open(fp) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        for size, box in SIZES.items():
+            resized = image.copy()
+            resized.thumbnail(box, Image.LANCZOS)
+            for format, (encoder, extension, options) in FORMATS.items():
+                frame = resized.convert('RGB') if encoder == 'JPEG' else resized
+                buffer = io.BytesIO()
+                frame.save(buffer, encoder, **options)
+                name = f'{directory}/{size}{extension}' if directory else f'{size}{extension}'
+                variants[f'{size}_{format}'] = storage.save(name, ContentFile(buffer.getvalue()))
+    return variants
+
+
+def store_variants(source, variants):
+    # every product sharing this (content-addressed) image gets the same variants
+    products = Product.objects.filter(image = source)
+    ids = list(products.values_list('id', flat = True))
+    updated = products.update(variants = variants, variants_source = source)
+    invalidate('products', *(f'product:{pk}' for pk in ids))
+    return updated
+
+
+def build_variants(source):
+    """Render and store the variants of `source`. When rendering fails the error
+    propagates and the products are left as they were, to be tried again."""
+    variants = render_variants(source)
+    store_variants(source, variants)
+    return variants
+
+
+def _run(source):
+    try:
+        if Product.objects.filter(image = source).exclude(variants_source = source).exists():
+            build_variants(source)
+    except Exception:
+        logger.warning('Cannot build variants for %s', source, exc_info = True)
+    finally:
+        _slots.release()
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(settings.IMAGE_VARIANT_WORKERS, thread_name_prefix = 'image-variants')
+        return _executor
+
+
+def schedule_variants(source):
+    """Queue variant generation on the background pool. When the queue is full the
+    image is skipped; `build_image_variants` picks up whatever was left behind.
+    With IMAGE_VARIANT_BACKEND = 'jobs' it becomes a job for `run_jobs` instead,
+    and with None nothing is scheduled at all."""
+    if settings.IMAGE_VARIANT_BACKEND is None:
+        return False
+    if settings.IMAGE_VARIANT_BACKEND == 'jobs':
+        enqueue('images.build_variants', source = source)
+        return True
+    if not _slots.acquire(blocking = False):
+        logger.info('Image variant queue is full, skipping %s', source)
+        return False
+    get_executor().submit(_run, source)
+    return True
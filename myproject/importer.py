@@ -0,0 +1,170 @@
+import csv
+import io
+import json
+import zipfile
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+
+from . import category_stats
+from .cache import invalidate
+from .images import schedule_variants
+from .models import Category, Product
+
+BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ('csv', 'ndjson')
+UPDATE_FIELDS = ['title', 'price']
+# updated only when the row has them, and the image only when it is not empty
+OPTIONAL_FIELDS = ['description', 'image']
+
+
+class RowError(ValueError):
+    pass
+
+
+def detect_format(filename):
+    name = (filename or '').lower()
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return None
+
+
+def read_rows(stream, format):
+    """Yield (line number, row dict) pairs one at a time from a binary stream."""
+    text = io.TextIOWrapper(stream, encoding = 'utf-8-sig', newline = '')
+    if format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    elif format == 'ndjson':
+        for number, line in enumerate(text, start = 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, RowError(f'Invalid JSON: {e}')
+                continue
+            yield number, row if isinstance(row, dict) else RowError('Row is not an object')
+    else:
+        raise ValueError(f'Unknown format {format!r}, expected one of {FORMATS}')
+    text.detach()
+
+
+class ProductImporter:
+    """
+    Upserts products from a stream of rows in batches of `batch_size`, keyed on
+    (category, slug). Existing products get the title and price of their row, and
+    the description and image only where the row has them. Bad rows are reported and skipped; the rest of the batch is
+    still written. Only one batch is held in memory at a time.
+    """
+
+    def __init__(self, images = None, batch_size = BATCH_SIZE):
+        self.images = zipfile.ZipFile(images) if images is not None else None
+        self.image_names = set(self.images.namelist()) if self.images else set()
+        self.batch_size = batch_size
+        self.image_field = Product._meta.get_field('image')
+        self.price_field = Product._meta.get_field('price')
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def report(self):
+        return {'imported': self.imported, 'failed': self.failed, 'errors': self.errors}
+
+    def error(self, number, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': number, 'error': message})
+
+    def build(self, row):
+        if isinstance(row, RowError):
+            raise row
+        try:
+            category_id = self.categories[str(row.get('category') or '')]
+        except KeyError:
+            raise RowError(f"Unknown category {row.get('category')!r}")
+        for name in ('title', 'slug'):
+            if not str(row.get(name) or '').strip():
+                raise RowError(f'{name} is required')
+        try:
+            price = Decimal(str(row.get('price'))).quantize(Decimal(1))
+        except InvalidOperation:
+            raise RowError(f"Invalid price {row.get('price')!r}")
+        # caught here, NaN or too many digits would fail the whole batch in flush()
+        if not price.is_finite() or price < 0:
+            raise RowError(f"Invalid price {row.get('price')!r}")
+        try:
+            self.price_field.clean(price, None)
+        except ValidationError as e:
+            raise RowError(f"Invalid price {row.get('price')!r}: {' '.join(e.messages)}")
+        product = Product(
+            category_id = category_id,
+            title = str(row['title']).strip(),
+            slug = str(row['slug']).strip(),
+            description = str(row.get('description') or ''),
+            price = price,
+            image = self.save_image(str(row.get('image') or '')),
+        )
+        provided = [name for name in OPTIONAL_FIELDS if row.get(name) is not None and (name != 'image' or product.image)]
+        return product, tuple(UPDATE_FIELDS + provided)
+
+    def save_image(self, name):
+        if not name or self.images is None:
+            return name
+        if name not in self.image_names:
+            raise RowError(f'Image {name!r} is not in the archive')
+        with self.images.open(name) as fp:
+            path = self.image_field.generate_filename(None, name.rsplit('/', 1)[-1])
+            return self.image_field.storage.save(path, File(fp, name = path))
+
+    def flush(self, batch):
+        if not batch:
+            return
+        products = [product for product, _ in batch.values()]
+        groups = {}
+        for product, fields in batch.values():
+            groups.setdefault(fields, []).append(product)
+        with transaction.atomic():
+            # an existing product keeps the columns its row leaves out
+            for fields, group in groups.items():
+                Product.objects.bulk_create(
+                    group,
+                    update_conflicts = True,
+                    unique_fields = ['category', 'slug'],
+                    update_fields = list(fields),
+                )
+            invalidate('products', *(f'product:{product.pk}' for product in products if product.pk))
+            # upserts may change prices of existing rows, so recount the touched categories
+            category_ids = {product.category_id for product in products}
+            category_stats.refresh(category_ids)
+            category_stats.invalidate_categories(category_ids)
+            for image in {product.image.name for product in products if product.image}:
+                transaction.on_commit(lambda image = image: schedule_variants(image))
+        self.imported += len(products)
+        batch.clear()
+
+    def run(self, rows):
+        batch = {}
+        for number, row in rows:
+            try:
+                product, fields = self.build(row)
+            except RowError as e:
+                self.error(number, str(e))
+                continue
+            # a later row for the same product wins, as it would across batches
+            batch[product.category_id, product.slug] = product, fields
+            if len(batch) >= self.batch_size:
+                self.flush(batch)
+        self.flush(batch)
+        return self.report()
+
+
+def import_products(stream, format, images = None, batch_size = BATCH_SIZE):
+    return ProductImporter(images, batch_size).run(read_rows(stream, format))
@@ -0,0 +1,123 @@
+import logging
+import os
+import random
+import socket
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# name -> function, filled by @task
+TASKS = {}
+
+
+def task(name):
+    """Register a function as the job `name`. It is called with the job's args as
+    keyword arguments and its return value, if any, must be JSON serializable. A
+    job may run more than once (retries, a worker dying mid-job), so tasks should
+    be idempotent."""
+    def decorator(function):
+        TASKS[name] = function
+        return function
+    return decorator
+
+
+def enqueue(name, *, priority = 0, delay = 0, max_attempts = None, **args):
+    """
+    Queue the job `name` and return its Job row; a worker picks it up after
+    `delay` seconds. Inside a transaction the job becomes visible to workers only
+    once it commits, and disappears with a rollback.
+    """
+    if name not in TASKS:
+        raise ValueError(f'Unknown task: {name}')
+    return Job.objects.create(
+        name = name,
+        args = args,
+        priority = priority,
+        run_at = timezone.now() + timedelta(seconds = delay),
+        max_attempts = max_attempts or settings.JOB_MAX_ATTEMPTS,
+    )
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim(worker, limit):
+    """
+    Mark up to `limit` due jobs as running and return them, highest priority first.
+    The guarded UPDATE only takes rows that are still queued, so two workers
+    racing for the same rows split them instead of both running them.
+    """
+    now = timezone.now()
+    due = Job.objects.filter(status = Job.QUEUED, run_at__lte = now).order_by('-priority', 'run_at', 'id')
+    ids = list(due.values_list('id', flat = True)[:limit])
+    if not ids:
+        return []
+    token = f'{worker}:{uuid.uuid4().hex[:8]}'
+    Job.objects.filter(id__in = ids, status = Job.QUEUED).update(
+        status = Job.RUNNING, locked_by = token, locked_at = now, attempts = F('attempts') + 1,
+    )
+    # from the primary: the rows were written a moment ago
+    return list(Job.objects.using('default').filter(locked_by = token).order_by('-priority', 'run_at', 'id'))
+
+
+def backoff(attempts):
+    """Seconds before retry number `attempts`: exponential, capped, with full jitter
+    so jobs failing together do not come back together."""
+    delay = min(settings.JOB_RETRY_BASE * 2 ** (attempts - 1), settings.JOB_RETRY_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+def execute(job_id):
+    """Run a claimed job and record the outcome; returns the job's new status.
+    Meant for worker threads and processes, each with its own connection."""
+    try:
+        job = Job.objects.using('default').get(id = job_id)
+        function = TASKS.get(job.name)
+        try:
+            if function is None:
+                raise LookupError(f'Unknown task: {job.name}')
+            result = function(**job.args)
+        except Exception:
+            error = traceback.format_exc()
+            logger.warning('Job %s failed (attempt %d of %d)', job, job.attempts, job.max_attempts, exc_info = True)
+            if function is not None and job.attempts < job.max_attempts:
+                changes = {'status': Job.QUEUED, 'run_at': timezone.now() + timedelta(seconds = backoff(job.attempts))}
+            else:
+                changes = {'status': Job.FAILED, 'finished_at': timezone.now()}
+            changes['last_error'] = error
+        else:
+            changes = {'status': Job.SUCCEEDED, 'result': result, 'finished_at': timezone.now()}
+        changes.update(locked_by = '', locked_at = None)
+        # a job taken back by requeue_stale() and claimed again is no longer ours
+        Job.objects.filter(id = job.id, locked_by = job.locked_by).update(**changes)
+        return changes['status']
+    finally:
+        close_old_connections()
+
+
+def requeue_stale():
+    """Put back jobs whose worker has held them longer than JOB_TIMEOUT seconds,
+    presumably because it died (failing those out of attempts), and drop
+    succeeded jobs older than JOB_RETENTION seconds."""
+    now = timezone.now()
+    stale = Job.objects.filter(status = Job.RUNNING, locked_at__lt = now - timedelta(seconds = settings.JOB_TIMEOUT))
+    stale.filter(attempts__gte = F('max_attempts')).update(
+        status = Job.FAILED, finished_at = now, locked_by = '', locked_at = None, last_error = 'Worker lost',
+    )
+    requeued = stale.update(status = Job.QUEUED, run_at = now, locked_by = '', locked_at = None)
+    if requeued:
+        logger.warning('Requeued %d stale jobs', requeued)
+    Job.objects.filter(
+        status = Job.SUCCEEDED, finished_at__lt = now - timedelta(seconds = settings.JOB_RETENTION),
+    ).delete()
+    return requeued
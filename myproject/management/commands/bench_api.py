@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from myproject.management.stats import summarize
+from myproject.models import Category, Order, Product, Wishlist
+from myproject.pagination import encode_cursor
+
+NO_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive every API endpoint with --requests requests at --concurrency and report '
+        'throughput, p50/p95/p99 latency and queries per request. Runs in process '
+        'through the full middleware stack, or against a live server with --url. '
+        'Fill the database with generate_data first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help = 'base URL of a running server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--prefix', default = '/api', help = 'where the API is mounted')
+        parser.add_argument('--host', default = 'localhost', help = 'Host header for in-process requests')
+        parser.add_argument('--requests', type = int, default = 200, help = 'requests per scenario')
+        parser.add_argument('--concurrency', type = int, default = 8,
+                            help = 'client threads; 1 sends the requests one by one from this thread')
+        parser.add_argument('--only', nargs = '+', metavar = 'SCENARIO', help = 'run only these scenarios')
+        parser.add_argument('--writes', action = 'store_true', help = 'include scenarios that modify data')
+        parser.add_argument('--no-cache', action = 'store_true', help = 'in process: run with the dummy cache')
+        parser.add_argument('--save', metavar = 'FILE', help = 'write the results as a JSON baseline')
+        parser.add_argument('--compare', metavar = 'FILE', help = 'print the change against a saved baseline')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.local = threading.local()
+        scenarios = self.scenarios(options['writes'])
+        if options['only']:
+            unknown = set(options['only']) - set(scenarios)
+            if unknown:
+                raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+            scenarios = {name: scenarios[name] for name in options['only']}
+
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['scenarios']
+
+        if options['no_cache'] and not options['url']:
+            with override_settings(CACHES = NO_CACHE):
+                results = self.run(scenarios, baseline)
+        else:
+            results = self.run(scenarios, baseline)
+
+        if options['save']:
+            report = {
+                'target': options['url'] or 'in-process',
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'cache': not options['no_cache'],
+                'scenarios': results,
+            }
+            with open(options['save'], 'w') as f:
+                json.dump(report, f, indent = 2)
+            self.stdout.write(f'Saved {options["save"]}')
+
+    def scenarios(self, writes):
+        """name -> (method, path, JSON body, share of --requests), built from rows in the database."""
+        category = Category.objects.order_by('id').first()
+        product = Product.objects.order_by('id').first()
+        wishlist = Wishlist.objects.order_by('id').first()
+        order = Order.objects.order_by('id').first()
+        if not (category and product and wishlist and order):
+            raise CommandError('The database needs categories, products, wishlists and orders; run generate_data')
+
+        middle = Product.objects.count() // 2
+        title, pk = Product.objects.order_by('title', 'id').values_list('title', 'id')[middle]
+        word = product.title.split()[0]
+        scenarios = {
+            'categories': ('GET', '/categories', None, 1),
+            'category': ('GET', f'/category/{category.slug}', None, 1),
+            'products': ('GET', '/products', None, 1),
+            'products_deep_page': ('GET', f'/products?cursor={encode_cursor([title, pk])}', None, 1),
+            'products_filtered': ('GET', f'/products?category={category.id}&min_price=10&max_price=100', None, 1),
+            'products_title': ('GET', f'/products?title={word}', None, 1),
+            'products_search': ('GET', f'/products/search?q={word}', None, 1),
+            'product': ('GET', f'/product/{product.id}', None, 1),
+            'orders': ('GET', '/get_orders', None, 1),
+            'user_orders': ('GET', f'/order/{order.user_id}/', None, 1),
+            'order_items': ('GET', f'/order/items/{order.id}/', None, 1),
+            'wishlist': ('GET', f'/get_wishlist/{wishlist.user_id}/', None, 1),
+            # full-table downloads; a few of them are enough
+            'export_products': ('GET', f'/export/products?category={category.id}', None, 0.05),
+            'export_orders': ('GET', '/export/orders', None, 0.05),
+        }
+        if writes:
+            wishlists = list(Wishlist.objects.filter(user_id = wishlist.user_id).values_list('id', flat = True))
+            scenarios.update({
+                'create_wishlist': ('POST', '/create_wishlist',
+                                    {'user': wishlist.user_id, 'product': product.id, 'quantity': 1}, 1),
+                'wishlist_add': ('PUT', f'/wishlist/add?wishlist_id={wishlist.id}', None, 1),
+                'create_order': ('POST', '/create_order', wishlists, 1),
+            })
+        return scenarios
+
+    def run(self, scenarios, baseline):
+        results = {}
+        for name, (method, path, body, share) in scenarios.items():
+            path = self.options['prefix'] + path
+            count = max(1, int(self.options['requests'] * share))
+            queries = None if self.options['url'] else self.count_queries(method, path, body)
+            started = time.perf_counter()
+            if self.options['concurrency'] > 1:
+                with ThreadPoolExecutor(self.options['concurrency']) as executor:
+                    calls = list(executor.map(lambda _: self.call(method, path, body), range(count)))
+            else:
+                calls = [self.call(method, path, body) for _ in range(count)]
+            elapsed = time.perf_counter() - started
+            stats = summarize([latency for latency, _ in calls], elapsed)
+            stats['queries'] = queries
+            stats['statuses'] = sorted({status for _, status in calls})
+            results[name] = stats
+            self.report(name, stats, baseline.get(name))
+        return results
+
+    def call(self, method, path, body):
+        started = time.perf_counter()
+        status = self.request(method, path, body)
+        return time.perf_counter() - started, status
+
+    def request(self, method, path, body):
+        data = json.dumps(body) if body is not None else ''
+        if self.options['url']:
+            request = urllib.request.Request(
+                self.options['url'].rstrip('/') + path, data = data.encode() or None, method = method,
+                headers = {'Content-Type': 'application/json'},
+            )
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as e:
+                e.read()
+                return e.code
+
+        # one client per thread: the test client keeps cookies and is not thread-safe;
+        # server errors are counted as 500s like over HTTP instead of aborting the run
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client(HTTP_HOST = self.options['host'], raise_request_exception = False)
+        response = self.local.client.generic(method, path, data, content_type = 'application/json')
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        return response.status_code
+
+    def count_queries(self, method, path, body):
+        # one extra request per scenario, on this thread, where the ORM calls of both
+        # sync and async views land; the timed requests are not instrumented
+        contexts = [CaptureQueriesContext(connections[alias]) for alias in connections]
+        for context in contexts:
+            context.__enter__()
+        try:
+            self.request(method, path, body)
+        finally:
+            for context in contexts:
+                context.__exit__(None, None, None)
+        return sum(len(context) for context in contexts)
+
+    def report(self, name, stats, previous):
+        line = (
+            f'{name:20} {stats["rps"]:8.1f} req/s  '
+            f'p50 {stats["p50_ms"]:8.2f}  p95 {stats["p95_ms"]:8.2f}  p99 {stats["p99_ms"]:8.2f} ms  '
+            f'queries {stats["queries"] if stats["queries"] is not None else "-":>3}  '
+            f'status {stats["statuses"]}'
+        )
+        if previous:
+            line += (
+                f'  | rps {self.change(stats["rps"], previous["rps"])}'
+                f'  p95 {self.change(stats["p95_ms"], previous["p95_ms"])}'
+            )
+        self.stdout.write(line)
+
+    @staticmethod
+    def change(current, previous):
+        if not previous:
+            return 'n/a'
+        return f'{(current - previous) / previous * 100:+.1f}%'
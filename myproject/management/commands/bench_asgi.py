@@ -0,0 +1,110 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+
+from myproject.management.stats import summarize
+
+DEFAULT_PATHS = ['/api/categories', '/api/products', '/api/product/2', '/api/get_orders']
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare WSGI and ASGI throughput on the same endpoints, in process. '
+        'WSGI requests run on a pool of --threads threads, ASGI requests as '
+        '--concurrency coroutines; --delay adds a slow-client pause to every response.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs = '*', default = DEFAULT_PATHS)
+        parser.add_argument('--requests', type = int, default = 500, help = 'requests per path and server')
+        parser.add_argument('--concurrency', type = int, default = 100)
+        parser.add_argument('--threads', type = int, default = 8, help = 'WSGI worker threads')
+        parser.add_argument('--delay', type = float, default = 0.0,
+                            help = 'seconds a client takes to read the response')
+
+    def handle(self, *args, **options):
+        self.delay = options['delay']
+        for path in options['paths']:
+            wsgi = self.bench_wsgi(path, options['requests'], options['threads'])
+            asgi = asyncio.run(self.bench_asgi(path, options['requests'], options['concurrency']))
+            for name, (elapsed, latencies, statuses) in (('wsgi', wsgi), ('asgi', asgi)):
+                stats = summarize(latencies, elapsed)
+                self.stdout.write(
+                    f'{name} {path}: {stats["rps"]:8.1f} req/s  '
+                    f'p50 {stats["p50_ms"]:7.2f} ms  '
+                    f'p99 {stats["p99_ms"]:7.2f} ms  '
+                    f'mean {stats["mean_ms"]:7.2f} ms  '
+                    f'status {sorted(statuses)}'
+                )
+
+    def bench_wsgi(self, path, count, threads):
+        handler = WSGIHandler()
+        path, _, query = path.partition('?')
+
+        def call(_):
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query,
+                'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http',
+                'wsgi.input': BytesIO(), 'wsgi.errors': BytesIO(),
+            }
+            status = []
+            started = time.perf_counter()
+            body = handler(environ, lambda s, headers: status.append(int(s.split()[0])))
+            for _ in body:
+                pass
+            if self.delay:
+                time.sleep(self.delay)
+            body.close()
+            return time.perf_counter() - started, status[0]
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(call, range(count)))
+        return time.perf_counter() - started, [r[0] for r in results], {r[1] for r in results}
+
+    async def bench_asgi(self, path, count, concurrency):
+        handler = ASGIHandler()
+        path, _, query = path.partition('?')
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call():
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+                'query_string': query.encode(), 'headers': [(b'host', b'testserver')],
+                'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+            }
+            status = []
+            requested = False
+            finished = asyncio.Event()
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                # Django listens for a disconnect while the view runs
+                await finished.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+                elif not message.get('more_body'):
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    finished.set()
+
+            async with semaphore:
+                started = time.perf_counter()
+                await handler(scope, receive, send)
+                return time.perf_counter() - started, status[0]
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(call() for _ in range(count)))
+        return time.perf_counter() - started, [r[0] for r in results], {r[1] for r in results}
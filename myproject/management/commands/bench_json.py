@@ -0,0 +1,65 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from ninja.renderers import JSONRenderer
+
+from myproject.api import OrderItemOut, ProductOut
+from myproject.management.stats import percentile
+from myproject.models import OrderItem, Product
+from myproject.renderers import ORJSONRenderer, orjson
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the encoding of large /products and /get_orders payloads with ninja\'s '
+        'default JSON renderer and with the orjson one. Only serialization is measured: '
+        'the rows are loaded and validated into schemas once, beforehand.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type = int, default = 5000, help = 'items per payload')
+        parser.add_argument('--repeat', type = int, default = 20, help = 'encodings per renderer')
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            raise CommandError('orjson is not installed')
+        rows = options['rows']
+        products = Product.objects.order_by('title', 'id')[:rows]
+        items = OrderItem.objects.select_related('order__status', 'product').order_by('order__created_at', 'id')[:rows]
+        payloads = {
+            'products': self.payload(ProductOut, products),
+            'get_orders': self.payload(OrderItemOut, items),
+        }
+        renderers = {'json': JSONRenderer(), 'orjson': ORJSONRenderer()}
+
+        for name, payload in payloads.items():
+            if not payload['items']:
+                raise CommandError(f'No rows for {name}; run generate_data')
+            expected = json.loads(renderers['json'].render(None, payload, response_status = 200))
+            timings = {}
+            for label, renderer in renderers.items():
+                body, timings[label] = self.time(renderer, payload, options['repeat'])
+                if json.loads(body) != expected:
+                    raise CommandError(f'{label} output differs for {name}')
+                self.stdout.write(
+                    f'{name:12} {label:7} {len(payload["items"]):6} items  {len(body) / 1024:9.1f} KiB  '
+                    f'p50 {percentile(timings[label], 0.5) * 1000:8.2f}  '
+                    f'min {min(timings[label]) * 1000:8.2f} ms'
+                )
+            speedup = percentile(timings['json'], 0.5) / percentile(timings['orjson'], 0.5)
+            self.stdout.write(f'{name:12} orjson is {speedup:.1f}x faster')
+
+    @staticmethod
+    def payload(schema, queryset):
+        # the shape a paginated operation hands to its renderer
+        return {'items': [schema.from_orm(obj).model_dump() for obj in queryset], 'next_cursor': None}
+
+    @staticmethod
+    def time(renderer, payload, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            body = renderer.render(None, payload, response_status = 200)
+            timings.append(time.perf_counter() - started)
+        return body, timings
@@ -0,0 +1,90 @@
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myproject.db import apply_pragmas
+
+SCHEMA = """
+CREATE TABLE product (id INTEGER PRIMARY KEY, title TEXT NOT NULL, price INTEGER NOT NULL);
+CREATE INDEX product_title ON product (title, id);
+"""
+
+
+def worker(path, pragmas, timeout, seconds, write_ratio, seed):
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path, timeout = timeout, isolation_level = None)
+    apply_pragmas(connection, pragmas)
+    reads = writes = locked = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            if rng.random() < write_ratio:
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute('INSERT INTO product (title, price) VALUES (?, ?)',
+                                   (f'rat {rng.random()}', rng.randrange(1000)))
+                connection.execute('UPDATE product SET price = price + 1 WHERE id = ?', (rng.randrange(1, 10000),))
+                connection.execute('COMMIT')
+                writes += 1
+            else:
+                start = f'rat {rng.random()}'
+                connection.execute('SELECT id, title, price FROM product WHERE title > ? ORDER BY title, id LIMIT 50',
+                                   (start,)).fetchall()
+                reads += 1
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            locked += 1
+    connection.close()
+    return reads, writes, locked
+
+
+class Command(BaseCommand):
+    help = (
+        'Mixed read/write throughput of several processes on one SQLite file, '
+        'with stock settings versus the SQLITE_PRAGMAS profile'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type = int, default = 8)
+        parser.add_argument('--seconds', type = float, default = 5)
+        parser.add_argument('--write-ratio', type = float, default = 0.2)
+        parser.add_argument('--rows', type = int, default = 10000)
+
+    def handle(self, *args, **options):
+        timeout = settings.DATABASES['default'].get('OPTIONS', {}).get('timeout', 5)
+        profiles = {
+            'stock (rollback journal)': ({}, 5),
+            'tuned (SQLITE_PRAGMAS)': (settings.SQLITE_PRAGMAS, timeout),
+        }
+        for name, (pragmas, timeout) in profiles.items():
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'bench.sqlite3')
+                self.prepare(path, pragmas, options['rows'])
+                args = [(path, pragmas, timeout, options['seconds'], options['write_ratio'], seed)
+                        for seed in range(options['processes'])]
+                with get_context('spawn').Pool(options['processes']) as pool:
+                    results = pool.starmap(worker, args)
+            reads, writes, locked = (sum(column) for column in zip(*results))
+            seconds = options['seconds']
+            self.stdout.write(
+                f'{name}: {reads / seconds:9.1f} reads/s  {writes / seconds:8.1f} writes/s  '
+                f'{locked} "database is locked" errors'
+            )
+
+    def prepare(self, path, pragmas, rows):
+        connection = sqlite3.connect(path, isolation_level = None)
+        apply_pragmas(connection, pragmas)
+        connection.executescript(SCHEMA)
+        connection.execute('BEGIN')
+        connection.executemany('INSERT INTO product (title, price) VALUES (?, ?)',
+                               ((f'rat {random.random()}', i % 1000) for i in range(rows)))
+        connection.execute('COMMIT')
+        connection.close()
@@ -0,0 +1,48 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import F
+
+from myproject.images import render_variants, store_variants
+from myproject.models import Product
+
+
+def render(source):
+    try:
+        return source, render_variants(source), None
+    except Exception as e:
+        return source, {}, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Render missing image variants (thumbnails, WebP) in parallel across CPU cores'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type = int, default = os.cpu_count())
+        parser.add_argument('--all', action = 'store_true', help = 'rebuild variants that are already current')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image = '')
+        if not options['all']:
+            products = products.exclude(variants_source = F('image'))
+        sources = products.order_by().values_list('image', flat = True).distinct().iterator()
+
+        # children only read and write files; the database stays with this process
+        connections.close_all()
+        done = failed = 0
+        workers = max(options['workers'], 1)
+        with ProcessPoolExecutor(workers) as executor:
+            while chunk := list(islice(sources, workers * 16)):
+                for source, variants, error in executor.map(render, chunk):
+                    if error:
+                        # left without variants_source, so the next run tries again
+                        failed += 1
+                        self.stderr.write(f'{source}: {error}')
+                    else:
+                        store_variants(source, variants)
+                        done += 1
+
+        self.stdout.write(self.style.SUCCESS(f'{done} images rendered, {failed} failed'))
@@ -0,0 +1,64 @@
+import posixpath
+import time
+
+from django.core.management.base import BaseCommand
+
+from myproject.models import Product
+from myproject.storage import is_content_addressed
+
+
+class Command(BaseCommand):
+    help = 'Delete product image files that no product references anymore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type = int, default = 3600,
+                            help = 'keep unreferenced files younger than this many seconds (uploads in flight)')
+        parser.add_argument('--rehash', action = 'store_true',
+                            help = 'first move referenced files with legacy names to their content-addressed name')
+        parser.add_argument('--dry-run', action = 'store_true')
+
+    def handle(self, *args, **options):
+        field = Product._meta.get_field('image')
+        storage = field.storage
+        directory = field.upload_to.rstrip('/')
+
+        if options['rehash'] and not options['dry_run']:
+            self.rehash(storage)
+
+        referenced = set(Product.objects.exclude(image = '').values_list('image', flat = True).iterator())
+        for variants in Product.objects.exclude(variants = {}).values_list('variants', flat = True).iterator():
+            referenced.update(variants.values())
+        deadline = time.time() - options['grace']
+        removed = freed = 0
+        for name in self.walk(storage, directory):
+            if name in referenced:
+                continue
+            if storage.get_modified_time(name).timestamp() > deadline:
+                continue
+            size = storage.size(name)
+            if not options['dry_run']:
+                storage.delete(name)
+            self.stdout.write(f'{"would remove" if options["dry_run"] else "removed"} {name}', self.style.NOTICE)
+            removed += 1
+            freed += size
+
+        self.stdout.write(self.style.SUCCESS(f'{removed} files, {freed} bytes'))
+
+    def walk(self, storage, directory):
+        if not storage.exists(directory):
+            return
+        directories, files = storage.listdir(directory)
+        for name in files:
+            yield posixpath.join(directory, name)
+        for name in directories:
+            yield from self.walk(storage, posixpath.join(directory, name))
+
+    def rehash(self, storage):
+        names = Product.objects.exclude(image = '').values_list('image', flat = True).distinct()
+        for name in names.iterator():
+            if is_content_addressed(name) or not storage.exists(name):
+                continue
+            with storage.open(name) as fp:
+                hashed = storage.save(name, fp)
+            Product.objects.filter(image = name).update(image = hashed)
+            self.stdout.write(f'{name} -> {hashed}')
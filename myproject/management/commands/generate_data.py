@@ -0,0 +1,124 @@
+import random
+from decimal import Decimal
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myproject import category_stats
+from myproject.cache import invalidate
+from myproject.models import Category, Order, OrderItem, Product, Status, Wishlist
+
+ADJECTIVES = ['big', 'small', 'average', 'fluffy', 'grey', 'brave', 'sleepy', 'royal', 'tiny', 'wild',
+              'golden', 'shy', 'loud', 'ancient', 'swift', 'lazy', 'spotted', 'striped', 'curious', 'giant']
+NOUNS = ['rat', 'mouse', 'hamster', 'gerbil', 'squirrel', 'chinchilla', 'vole', 'shrew', 'dormouse', 'capybara']
+WORDS = ['cheese', 'tail', 'whiskers', 'cage', 'wheel', 'nest', 'seeds', 'tunnel', 'burrow', 'paws', 'fur',
+         'night', 'garden', 'kitchen', 'maze', 'crumbs', 'velvet', 'warm', 'quick', 'quiet', 'bright', 'soft']
+STATUSES = ['New', 'Paid', 'Delivered']
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the database with a synthetic catalog, users, wishlists and orders of the '
+        'given size, using bulk inserts. Rows are named with --prefix so several runs '
+        'can coexist.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type = int, default = 50)
+        parser.add_argument('--products', type = int, default = 100000)
+        parser.add_argument('--users', type = int, default = 1000)
+        parser.add_argument('--wishlist-items', type = int, default = 5, help = 'wishlist rows per user')
+        parser.add_argument('--orders', type = int, default = 20000)
+        parser.add_argument('--max-items', type = int, default = 5, help = 'maximum items per order')
+        parser.add_argument('--batch-size', type = int, default = 5000)
+        parser.add_argument('--prefix', default = 'gen')
+        parser.add_argument('--seed', type = int, default = 0)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        prefix = options['prefix']
+
+        categories = self.create_categories(prefix, options['categories'])
+        products = self.create_products(prefix, categories, options['products'])
+        category_stats.refresh(categories)
+        users = self.create_users(prefix, options['users'])
+        self.create_wishlists(users, products, options['wishlist_items'])
+        self.create_orders(users, products, options['orders'], options['max_items'])
+        invalidate('categories', 'products')
+
+    def insert(self, model, objects, keep = None):
+        """bulk_create `objects` batch by batch; only `keep(obj)` of each row is retained,
+        so memory follows the batch size rather than the row count."""
+        kept = []
+        count = 0
+        for batch in batched(objects, self.batch_size):
+            with transaction.atomic():
+                model.objects.bulk_create(batch)
+            count += len(batch)
+            if keep:
+                kept += map(keep, batch)
+        self.stdout.write(f'{model.__name__}: {count}')
+        return kept
+
+    def create_categories(self, prefix, count):
+        return self.insert(Category, (
+            Category(title = f'{prefix} {self.rng.choice(NOUNS)}s {i}', slug = f'{prefix}-category-{i}')
+            for i in range(count)
+        ), keep = lambda category: category.id)
+
+    def create_products(self, prefix, categories, count):
+        def product(i):
+            title = f'{self.rng.choice(ADJECTIVES)} {self.rng.choice(ADJECTIVES)} {self.rng.choice(NOUNS)} {i}'
+            description = ' '.join(self.rng.choices(WORDS, k = self.rng.randint(5, 60)))
+            price = Decimal(round(self.rng.lognormvariate(3.5, 1)) + 1)
+            return Product(category_id = self.rng.choice(categories), title = title,
+                           slug = f'{prefix}-product-{i}', description = description, price = price)
+
+        return self.insert(Product, (product(i) for i in range(count)),
+                           keep = lambda product: (product.id, int(product.price)))
+
+    def create_users(self, prefix, count):
+        # one hash for everybody: hashing a password per user would dominate the run
+        password = make_password(prefix)
+        return self.insert(User, (
+            User(username = f'{prefix}-user-{i}', email = f'{prefix}-user-{i}@example.com', password = password)
+            for i in range(count)
+        ), keep = lambda user: user.id)
+
+    def create_wishlists(self, users, products, per_user):
+        per_user = min(per_user, len(products))
+        self.insert(Wishlist, (
+            Wishlist(user_id = user, product_id = product, quantity = self.rng.randint(1, 5))
+            for user in users
+            for product, _ in self.rng.sample(products, per_user)
+        ))
+
+    def create_orders(self, users, products, count, max_items):
+        statuses = [Status.objects.get_or_create(name = name)[0].id for name in STATUSES]
+        items = 0
+        for batch in batched(range(count), self.batch_size):
+            lines = [self.rng.sample(products, self.rng.randint(1, max_items)) for _ in batch]
+            orders = [
+                Order(user_id = self.rng.choice(users), status_id = self.rng.choice(statuses),
+                      total = sum(price for _, price in order_lines))
+                for order_lines in lines
+            ]
+            with transaction.atomic():
+                Order.objects.bulk_create(orders)
+                created = OrderItem.objects.bulk_create(
+                    OrderItem(order_id = order.id, product_id = product, price = price, quantity = 1)
+                    for order, order_lines in zip(orders, lines)
+                    for product, price in order_lines
+                )
+            items += len(created)
+        self.stdout.write(f'Order: {count}\nOrderItem: {items}')
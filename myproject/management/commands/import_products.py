@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from myproject.importer import BATCH_SIZE, FORMATS, detect_format, import_products
+
+
+class Command(BaseCommand):
+    help = 'Upsert products from a CSV or NDJSON file, keyed on (category, slug)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices = FORMATS)
+        parser.add_argument('--images', help = 'zip archive with the files named in the image column')
+        parser.add_argument('--batch-size', type = int, default = BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        format = options['format'] or detect_format(options['path'])
+        if format is None:
+            raise CommandError('Cannot guess the format from the file name, pass --format')
+
+        images = open(options['images'], 'rb') if options['images'] else None
+        try:
+            with open(options['path'], 'rb') as stream:
+                report = import_products(stream, format, images, options['batch_size'])
+        finally:
+            if images:
+                images.close()
+
+        for error in report['errors']:
+            self.stderr.write(f"row {error['row']}: {error['error']}")
+        self.stdout.write(self.style.SUCCESS(f"Imported {report['imported']} products, {report['failed']} rows failed"))
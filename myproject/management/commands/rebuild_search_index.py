@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from myproject import search
+from myproject.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of products from the product table'
+
+    def handle(self, *args, **options):
+        search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {Product.objects.count()} products'))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myproject import category_stats
+from myproject.models import Category
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the stored per-category product stats with the products table and '
+        'fix the categories that drifted (e.g. after raw SQL or fixture loads)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action = 'store_true', help = 'only report the drift')
+
+    def handle(self, *args, **options):
+        fields = category_stats.STATS_FIELDS
+        actual = {f'actual_{field}': expression for field, expression in category_stats.aggregates().items()}
+        rows = Category.objects.annotate(**actual).values('id', 'slug', *fields, *actual)
+        drifted = []
+        for row in rows:
+            changes = [
+                f'{field} {row[field]} -> {row[f"actual_{field}"]}'
+                for field in fields if row[field] != row[f'actual_{field}']
+            ]
+            if changes:
+                drifted.append(row['id'])
+                self.stdout.write(f'{row["slug"]}: {", ".join(changes)}')
+
+        if drifted and not options['dry_run']:
+            with transaction.atomic():
+                category_stats.refresh(drifted)
+                category_stats.invalidate_categories(drifted)
+        verb = 'drifted' if options['dry_run'] else 'fixed'
+        self.stdout.write(f'{len(drifted)} of {len(rows)} categories {verb}')
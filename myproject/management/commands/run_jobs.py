@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from myproject.jobs import claim, execute, requeue_stale, worker_name
+from myproject.models import Job
+
+
+class Command(BaseCommand):
+    help = (
+        'Run queued background jobs on a pool of threads or, with --processes, of '
+        'processes. Jobs are claimed from the database as workers free up, highest '
+        'priority first; several run_jobs commands may share one queue.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'jobs run at the same time')
+        parser.add_argument('--processes', action = 'store_true', help = 'for CPU-bound jobs: a process pool instead of threads')
+        parser.add_argument('--poll', type = float, default = settings.JOB_POLL_INTERVAL, help = 'seconds between queue checks when idle')
+        parser.add_argument('--once', action = 'store_true', help = 'exit once no job is due')
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        if options['processes']:
+            # spawned children set up Django themselves and open their own connections
+            connections.close_all()
+            executor = ProcessPoolExecutor(
+                workers, mp_context = multiprocessing.get_context('spawn'), initializer = django.setup,
+            )
+        else:
+            executor = ThreadPoolExecutor(workers, thread_name_prefix = 'jobs')
+        name = worker_name()
+        counts = {Job.SUCCEEDED: 0, Job.QUEUED: 0, Job.FAILED: 0}
+        running = set()
+        last_check = 0
+
+        try:
+            while True:
+                if time.monotonic() - last_check >= settings.JOB_TIMEOUT / 10:
+                    requeue_stale()
+                    last_check = time.monotonic()
+                free = workers - len(running)
+                claimed = claim(name, free) if free else []
+                running.update(executor.submit(execute, job.id) for job in claimed)
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll'])
+                    continue
+                # wake up when a job ends, or to look for new ones when slots are free
+                timeout = options['poll'] if len(running) < workers else None
+                done, running = wait(running, timeout = timeout, return_when = FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        counts[future.result()] += 1
+                    except Exception as e:
+                        # the outcome was not recorded: requeue_stale() takes the job back
+                        self.stderr.write(f'Job outcome lost: {e!r}')
+        except KeyboardInterrupt:
+            self.stderr.write(f'Interrupted, waiting for {len(running)} running jobs')
+        finally:
+            executor.shutdown(wait = True)
+            connections.close_all()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{counts[Job.SUCCEEDED]} jobs succeeded, {counts[Job.QUEUED]} to be retried, {counts[Job.FAILED]} failed'
+        ))
@@ -0,0 +1,151 @@
+import mimetypes
+import mmap
+import os
+import posixpath
+import re
+from stat import S_ISREG
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+from .models import Product
+from .storage import is_content_addressed
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+# names are hashes of the content: the bytes behind a URL never change
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def image_storage():
+    return Product._meta.get_field('image').storage
+
+
+def media_path(name):
+    """Absolute path of a stored product image, or Http404. Only files under the
+    image upload directory are served, hidden ones (in-progress uploads) excepted."""
+    directory = Product._meta.get_field('image').upload_to.strip('/') + '/'
+    if not name.startswith(directory) or posixpath.basename(name).startswith('.'):
+        raise Http404
+    try:
+        return image_storage().path(name)
+    except SuspiciousFileOperation:
+        raise Http404
+
+
+def file_etag(name, stat):
+    if is_content_addressed(name):
+        return '"%s"' % posixpath.splitext(posixpath.basename(name))[0]
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def requested_range(request, size, etag, last_modified):
+    """(start, end) inclusive for a single satisfiable `Range: bytes=` header, None to
+    send the whole file, or False when the range cannot be satisfied. Several ranges
+    in one header are answered with the whole file, as RFC 9110 allows."""
+    header = request.META.get('HTTP_RANGE')
+    if not header or request.method not in ('GET', 'HEAD'):
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range:
+        # the range applies only to the representation the client already has part of
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            if parse_etags(if_range) != [etag]:
+                return None
+        elif parse_http_date_safe(if_range) != last_modified:
+            return None
+    match = RANGE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # the final `last` bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), int(last) if last else size - 1
+        if last and end < start:
+            return None  # invalid, so ignored
+    if start >= size:
+        return False
+    return start, min(end, size - 1)
+
+
+def mapped_chunks(path, start, end):
+    """The bytes start..end of a file read through a read-only memory map, so the
+    kernel's page cache backs the copy and nothing else is buffered."""
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+        position = start
+        while position <= end:
+            stop = min(position + CHUNK_SIZE, end + 1)
+            yield mapped[position:stop]
+            position = stop
+
+
+def accel_response(name, path, content_type):
+    # an empty body: the front-end server sends the file, Range requests included
+    response = HttpResponse(content_type = content_type)
+    if settings.MEDIA_ACCEL == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + name
+    else:
+        response['X-Sendfile'] = path
+    return response
+
+
+def file_response(request, path, stat, content_type, etag, last_modified):
+    byte_range = requested_range(request, stat.st_size, etag, last_modified)
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type = content_type)
+    elif byte_range is False:
+        response = HttpResponse(status = 416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(mapped_chunks(path, start, end), status = 206, content_type = content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def serve(request, name):
+    """
+    A stored product image with long-lived caching headers: content-addressed
+    names are immutable, others are cached for MEDIA_MAX_AGE seconds. ETag and
+    Last-Modified answer conditional requests with 304, `Range: bytes=` with 206.
+
+    Whole files go out as a FileResponse, which WSGI servers with
+    wsgi.file_wrapper send with sendfile(); ranges are sliced from a memory map.
+    With MEDIA_ACCEL set only the headers are built here and the front-end server
+    sends the body, ranges included.
+    """
+    name = posixpath.normpath(name)
+    path = media_path(name)
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404
+    if not S_ISREG(stat.st_mode):
+        raise Http404
+    etag = file_etag(name, stat)
+    last_modified = int(stat.st_mtime)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': IMMUTABLE if is_content_addressed(name) else f'public, max-age={settings.MEDIA_MAX_AGE}',
+    }
+
+    response = get_conditional_response(request, etag = etag, last_modified = last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if settings.MEDIA_ACCEL:
+            response = accel_response(name, path, content_type)
+        else:
+            response = file_response(request, path, stat, content_type, etag, last_modified)
+    for header, value in headers.items():
+        response[header] = value
+    return response
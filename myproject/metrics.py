@@ -0,0 +1,293 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from ipaddress import ip_address, ip_network
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from .db import capture_queries
+
+# seconds; the Prometheus client defaults
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UNMATCHED = '<unmatched>'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class RouteStats:
+    """Counters of one (method, route) pair. Buckets are per bucket, not cumulative;
+    the last one counts requests slower than BUCKETS[-1]."""
+    __slots__ = ('statuses', 'buckets', 'seconds', 'queries', 'query_seconds', 'response_bytes')
+
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.response_bytes = 0
+
+    def to_dict(self):
+        # read while the owning thread records: copy before iterating
+        statuses = dict(self.statuses)
+        return {
+            'statuses': {str(status): count for status, count in statuses.items()},
+            'buckets': list(self.buckets),
+            'seconds': self.seconds,
+            'queries': self.queries,
+            'query_seconds': self.query_seconds,
+            'response_bytes': self.response_bytes,
+        }
+
+
+class Registry:
+    """
+    Each thread records into its own dict of RouteStats, so the request path takes
+    no lock; readers merge the shards. Shards of finished threads are folded into
+    `retired` when read, so servers starting a thread per request do not pile
+    them up. Every METRICS_FLUSH_INTERVAL seconds the process writes its totals to
+    METRICS_DIR, where the /metrics view of any worker sums the files of all of them.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []  # (thread, shard)
+        self.retired = {}  # totals of finished threads, as snapshot() returns them
+        self.lock = threading.Lock()  # guards self.shards and self.retired
+        self.name = f'{os.getpid()}-{time.time_ns()}.json'
+        self.next_flush = 0.0
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def stats(self, method, route):
+        shard = self.shard()
+        key = (method, route)
+        stats = shard.get(key)
+        if stats is None:
+            stats = shard[key] = RouteStats()
+        return stats
+
+    def observe(self, method, route, status, seconds, queries, size):
+        stats = self.stats(method, route)
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        stats.buckets[bisect_left(BUCKETS, seconds)] += 1
+        stats.seconds += seconds
+        stats.queries += len(queries)
+        stats.query_seconds += sum(duration for _, _, duration in queries)
+        if size is not None:
+            stats.response_bytes += size
+        if time.monotonic() >= self.next_flush:
+            self.flush()
+
+    def add_bytes(self, method, route, size):
+        self.stats(method, route).response_bytes += size
+
+    def snapshot(self):
+        """This process's totals as {'METHOD route': RouteStats.to_dict()}."""
+        with self.lock:
+            shards = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    shards.append((thread, shard))
+                else:
+                    # nobody writes to it anymore
+                    for (method, route), stats in shard.items():
+                        merge(self.retired.setdefault(f'{method} {route}', empty()), stats.to_dict())
+            self.shards = shards
+            totals = {}
+            for key, stats in self.retired.items():
+                merge(totals.setdefault(key, empty()), stats)
+        for _, shard in shards:
+            for (method, route), stats in list(shard.items()):
+                merge(totals.setdefault(f'{method} {route}', empty()), stats.to_dict())
+        return totals
+
+    def flush(self):
+        self.next_flush = time.monotonic() + settings.METRICS_FLUSH_INTERVAL
+        directory = settings.METRICS_DIR
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok = True)
+        # write and rename, so readers never see half a file
+        fd, temporary = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, os.path.join(directory, self.name))
+
+    def collect(self):
+        """Totals of every worker that flushed within METRICS_RETENTION seconds."""
+        directory = settings.METRICS_DIR
+        if not directory:
+            return self.snapshot()
+        self.flush()
+        totals = {}
+        expired = time.time() - settings.METRICS_RETENTION
+        for name in os.listdir(directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, stats in snapshot.items():
+                merge(totals.setdefault(key, empty()), stats)
+        return totals
+
+
+def empty():
+    return RouteStats().to_dict()
+
+
+def merge(total, stats):
+    for status, count in stats['statuses'].items():
+        total['statuses'][status] = total['statuses'].get(status, 0) + count
+    total['buckets'] = [a + b for a, b in zip(total['buckets'], stats['buckets'])]
+    for field in ('seconds', 'queries', 'query_seconds', 'response_bytes'):
+        total[field] += stats[field]
+
+
+registry = Registry()
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(totals):
+    """Prometheus text exposition format."""
+    families = {
+        'http_requests_total': ('counter', 'Requests by route and status.', []),
+        'http_request_duration_seconds': ('histogram', 'Request latency.', []),
+        'db_queries_total': ('counter', 'SQL queries run by requests.', []),
+        'db_query_duration_seconds_total': ('counter', 'Time spent in SQL queries.', []),
+        'http_response_size_bytes_total': ('counter', 'Response body bytes.', []),
+    }
+    for key in sorted(totals):
+        stats = totals[key]
+        method, route = key.split(' ', 1)
+        labels = f'method="{escape(method)}",route="{escape(route)}"'
+        for status, count in sorted(stats['statuses'].items()):
+            families['http_requests_total'][2].append(f'{{{labels},status="{status}"}} {count}')
+        lines = families['http_request_duration_seconds'][2]
+        cumulative = 0
+        for bound, count in zip(BUCKETS, stats['buckets']):
+            cumulative += count
+            lines.append(f'_bucket{{{labels},le="{bound}"}} {cumulative}')
+        count = sum(stats['buckets'])
+        lines.append(f'_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f'_sum{{{labels}}} {stats["seconds"]}')
+        lines.append(f'_count{{{labels}}} {count}')
+        families['db_queries_total'][2].append(f'{{{labels}}} {stats["queries"]}')
+        families['db_query_duration_seconds_total'][2].append(f'{{{labels}}} {stats["query_seconds"]}')
+        families['http_response_size_bytes_total'][2].append(f'{{{labels}}} {stats["response_bytes"]}')
+
+    output = []
+    for name, (kind, help, lines) in families.items():
+        name = f'{settings.METRICS_NAMESPACE}_{name}'
+        output.append(f'# HELP {name} {help}')
+        output.append(f'# TYPE {name} {kind}')
+        output.extend(name + line for line in lines)
+    return '\n'.join(output) + '\n'
+
+
+def allowed(address):
+    if settings.METRICS_ALLOWED_IPS is None:
+        return True
+    try:
+        address = ip_address(address)
+    except ValueError:
+        return False
+    return any(address in ip_network(network) for network in settings.METRICS_ALLOWED_IPS)
+
+
+def metrics_view(request):
+    if not allowed(request.META.get('REMOTE_ADDR', '')):
+        return HttpResponseForbidden()
+    return HttpResponse(render(registry.collect()), content_type = CONTENT_TYPE)
+
+
+def route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    return '/' + match.route if match else UNMATCHED
+
+
+class MetricsMiddleware:
+    """
+    Records every request under its URL pattern (e.g. /api/product/<product_id>),
+    so ids in paths do not multiply the series. Bytes of streamed responses are
+    added as the body is sent.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with capture_queries() as queries:
+            response = self.get_response(request)
+        return self.record(request, response, time.perf_counter() - started, queries)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with capture_queries() as queries:
+            response = await self.get_response(request)
+        return self.record(request, response, time.perf_counter() - started, queries)
+
+    def record(self, request, response, seconds, queries):
+        method, route = request.method, route_of(request)
+        if getattr(response, 'file_to_stream', None) is not None:
+            # wrapping its content would keep a FileResponse from wsgi.file_wrapper (sendfile)
+            size = int(response.get('Content-Length') or 0)
+        elif response.streaming:
+            size = None
+            response.streaming_content = count_bytes(response, method, route)
+        else:
+            size = len(response.content)
+        registry.observe(method, route, response.status_code, seconds, queries, size)
+        return response
+
+
+def count_bytes(response, method, route):
+    content = response.streaming_content
+    if response.is_async:
+        async def counted():
+            size = 0
+            try:
+                async for chunk in content:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                registry.add_bytes(method, route, size)
+    else:
+        def counted():
+            size = 0
+            try:
+                for chunk in content:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                registry.add_bytes(method, route, size)
+    return counted()
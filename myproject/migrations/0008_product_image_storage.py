@@ -0,0 +1,24 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:37
+
+import myproject.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myproject', '0007_product_category_slug'),
+    ]
+
+    # storage does not touch the column; skip the table rebuild SQLite would do
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='product',
+                    name='image',
+                    field=models.ImageField(storage=myproject.storage.get_image_storage, upload_to='images/'),
+                ),
+            ],
+        ),
+    ]
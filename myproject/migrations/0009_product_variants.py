@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myproject', '0008_product_image_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='variants_source',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+    ]
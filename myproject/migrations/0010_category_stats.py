@@ -0,0 +1,45 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:57
+
+from django.db import migrations, models
+
+from myproject.category_stats import aggregates
+
+
+def compute_stats(apps, schema_editor):
+    Category = apps.get_model('myproject', 'Category')
+    Category.objects.update(**aggregates(apps.get_model('myproject', 'Product')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myproject', '0009_product_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='max_price',
+            field=models.DecimalField(decimal_places=0, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='min_price',
+            field=models.DecimalField(decimal_places=0, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='price_total',
+            field=models.DecimalField(decimal_places=0, default=0, editable=False, max_digits=16),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='product_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'price'], name='myproject_p_categor_37fdc4_idx'),
+        ),
+        migrations.RunPython(compute_stats, migrations.RunPython.noop),
+    ]
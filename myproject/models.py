@@ -1,10 +1,17 @@
-from django.db import models
+from django.db import models, router, transaction
 from django.urls import reverse
 from django.contrib.auth.models import User
+from .storage import get_image_storage
 
 class Category(models.Model):
     title = models.CharField(max_length=200, db_index=True)
     slug = models.SlugField(max_length=200, db_index=True, unique=True)
+    # kept up to date by myproject.category_stats on every product write;
+    # `manage.py reconcile_category_stats` recomputes them
+    product_count = models.IntegerField(default=0, editable=False)
+    price_total = models.DecimalField(max_digits=16, decimal_places=0, default=0, editable=False)
+    min_price = models.DecimalField(max_digits=10, decimal_places=0, null=True, editable=False)
+    max_price = models.DecimalField(max_digits=10, decimal_places=0, null=True, editable=False)
 
     class Meta:
         ordering = ('title',)
@@ -14,23 +21,57 @@ class Category(models.Model):
     def __str__(self):
         return self.title
 
+    @property
+    def avg_price(self):
+        if not self.product_count:
+            return None
+        return self.price_total / self.product_count
+
 class Product(models.Model):
     category = models.ForeignKey(Category, related_name='products', on_delete=models.CASCADE)
     title = models.CharField(max_length=200, db_index=True)
     slug = models.SlugField(max_length=200, db_index=True)
-    image = models.ImageField(upload_to='images/')
+    image = models.ImageField(upload_to='images/', storage=get_image_storage)
     description = models.TextField(blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=0)
+    # resized copies of `image`, filled in by myproject.images off the request path;
+    # they are current when variants_source equals the image name
+    variants = models.JSONField(default=dict, blank=True, editable=False)
+    variants_source = models.CharField(max_length=100, blank=True, editable=False)
 
     class Meta:
         ordering = ('title',)
-        indexes = [models.Index(fields=['id', 'slug'])]
+        indexes = [
+            models.Index(fields=['id', 'slug']),
+            models.Index(fields=['title', 'id']),
+            models.Index(fields=['category', 'price']),
+        ]
+        constraints = [models.UniqueConstraint(fields=['category', 'slug'], name='category_slug')]
         verbose_name = 'Продукт'
         verbose_name_plural = 'Продукты'
 
     def __str__(self):
         return self.title
-    
+
+    def save(self, *args, **kwargs):
+        # pre_save and post_save run outside Model.save's own transaction; in this
+        # one the category stats move together with the row (see signals), and
+        # their deltas start from the row as it is when the write lock is taken
+        using = kwargs.get('using') or router.db_for_write(type(self), instance = self)
+        with transaction.atomic(using = using):
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # the collector's transaction has no savepoint: nested in another one, a
+        # failed delete would otherwise break it rather than roll back on its own
+        using = kwargs.get('using') or router.db_for_write(type(self), instance = self)
+        with transaction.atomic(using = using):
+            return super().delete(*args, **kwargs)
+
+    @property
+    def variants_ready(self):
+        return bool(self.image) and self.variants_source == self.image.name
+
     def get_absolute_url(self):
         return reverse('product_detail', kwargs={'id':self.id, 'slug':self.slug})
     
@@ -67,11 +108,13 @@ class Order(models.Model):
 
     class Meta:
         ordering = ('created_at', )
+        indexes = [models.Index(fields = ['created_at', 'id'])]
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
 
     def get_total_price(self):
-        return sum(item.get_total_price() for item in self.items.all())
+        total = self.items.aggregate(total = models.Sum(models.F('product__price') * models.F('quantity')))['total']
+        return total or 0
 
 
 class OrderItem(models.Model):
@@ -84,4 +127,39 @@ class OrderItem(models.Model):
         verbose_name = 'Заказано'
 
     def get_total_price(self):
-        return self.product.price * self.quantity
\ No newline at end of file
+        return self.product.price * self.quantity
+
+
+class Job(models.Model):
+    """A unit of deferred work for `manage.py run_jobs`, see myproject.jobs."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'В очереди'), (RUNNING, 'Выполняется'), (SUCCEEDED, 'Выполнена'), (FAILED, 'Ошибка')]
+
+    name = models.CharField(max_length = 100)
+    args = models.JSONField(default = dict, blank = True)
+    status = models.CharField(max_length = 10, choices = STATUSES, default = QUEUED)
+    # higher first; equal priorities in run_at order
+    priority = models.SmallIntegerField(default = 0)
+    run_at = models.DateTimeField()
+    attempts = models.PositiveSmallIntegerField(default = 0)
+    max_attempts = models.PositiveSmallIntegerField()
+    locked_by = models.CharField(max_length = 100, blank = True)
+    locked_at = models.DateTimeField(null = True, blank = True)
+    last_error = models.TextField(blank = True)
+    result = models.JSONField(null = True, blank = True)
+    created_at = models.DateTimeField(auto_now_add = True)
+    finished_at = models.DateTimeField(null = True, blank = True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields = ['status', '-priority', 'run_at'], name = 'job_queue'),
+            models.Index(fields = ['status', 'locked_at'], name = 'job_locks'),
+        ]
+        verbose_name = 'Задача'
+        verbose_name_plural = 'Задачи'
+
+    def __str__(self):
+        return f'{self.name} #{self.id}'
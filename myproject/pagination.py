@@ -0,0 +1,121 @@
+import base64
+import json
+from datetime import datetime
+from math import inf
+from typing import Any, List, Optional, Sequence
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q, QuerySet
+from ninja import Field, Schema
+from ninja.conf import settings
+from ninja.errors import HttpError
+from ninja.pagination import AsyncPaginationBase
+
+from .fields import Projection
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    # DjangoJSONEncoder cuts datetimes to milliseconds, and a key that compares
+    # below the row it came from would seek to that row again
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, cls = CursorEncoder).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise HttpError(400, 'Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise HttpError(400, 'Invalid cursor')
+    return values
+
+
+def unwrap(items):
+    """(queryset, row shaping function or None) of a view's return value, which may
+    be a Fieldset projection."""
+    if isinstance(items, Projection):
+        return items.queryset, items.shape
+    return items, None
+
+
+class KeysetPagination(AsyncPaginationBase):
+    """
+    Seek pagination: every page is a `WHERE (key) > (last key) ORDER BY key LIMIT n`,
+    so page 1000 costs the same as page 1. The cursor is the last row's key,
+    opaque to the client.
+    """
+
+    class Input(Schema):
+        cursor: Optional[str] = None
+        limit: int = Field(
+            settings.PAGINATION_PER_PAGE,
+            ge = 1,
+            le = settings.PAGINATION_MAX_LIMIT
+            if settings.PAGINATION_MAX_LIMIT != inf
+            else None,
+        )
+
+    class Output(Schema):
+        items: List[Any]
+        next_cursor: Optional[str] = None
+
+    def __init__(self, ordering: Sequence[str] = ('id',), **kwargs: Any) -> None:
+        self.ordering = tuple(ordering)
+        super().__init__(**kwargs)
+
+    def _seek(self, values):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y)
+        condition = Q()
+        for i in reversed(range(len(self.ordering))):
+            field = self.ordering[i]
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            step = Q(**{field.lstrip('-') + lookup: values[i]})
+            if i < len(self.ordering) - 1:
+                step |= Q(**{field.lstrip('-'): values[i]}) & condition
+            condition = step
+        return condition
+
+    def _page_queryset(self, queryset, pagination):
+        keys = {f'_keyset_{i}': F(field.lstrip('-')) for i, field in enumerate(self.ordering)}
+        queryset = queryset.annotate(**keys).order_by(*self.ordering)
+
+        if pagination.cursor:
+            values = decode_cursor(pagination.cursor, len(self.ordering))
+            queryset = queryset.filter(self._seek(values))
+
+        limit = min(pagination.limit, settings.PAGINATION_MAX_LIMIT)
+        return queryset[:limit + 1], list(keys), limit
+
+    def _page(self, items, keys, limit, shape):
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            last = items[-1]
+            # model instances, or dicts of values() querysets
+            next_cursor = encode_cursor([last[key] if isinstance(last, dict) else getattr(last, key) for key in keys])
+        if shape is not None:
+            items = [shape(item) for item in items]
+
+        return {
+            'items': items,
+            'next_cursor': next_cursor,
+        }
+
+    def paginate_queryset(self, queryset: QuerySet, pagination: Input, **params: Any) -> Any:
+        queryset, shape = unwrap(queryset)
+        page, keys, limit = self._page_queryset(queryset, pagination)
+        return self._page(list(page), keys, limit, shape)
+
+    async def apaginate_queryset(self, queryset: QuerySet, pagination: Input, **params: Any) -> Any:
+        queryset, shape = unwrap(queryset)
+        page, keys, limit = self._page_queryset(queryset, pagination)
+        return self._page([item async for item in page], keys, limit, shape)
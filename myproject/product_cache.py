@@ -0,0 +1,107 @@
+import threading
+
+from django.conf import settings
+
+from .cache import get_versions
+from .lru import TTLCache
+
+MAX_IDS = 200
+
+# product id -> (version of its 'product:<id>' namespace, serialized product)
+products = TTLCache(settings.PRODUCT_CACHE_SIZE, settings.PRODUCT_CACHE_TTL)
+
+
+class Call:
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent fetches of the same keys within the process: a key asked
+    for while another thread is already loading it is waited for, not fetched again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def fetch_many(self, keys, fetch):
+        """{key: value} for `keys`, calling `fetch(keys)` (which returns such a dict,
+        missing keys left out) only for the keys nobody else is loading."""
+        own, waiting = [], {}
+        with self.lock:
+            for key in keys:
+                call = self.calls.get(key)
+                if call is None:
+                    self.calls[key] = Call()
+                    own.append(key)
+                else:
+                    waiting[key] = call
+
+        results = {}
+        if own:
+            error = None
+            try:
+                results = fetch(own)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                with self.lock:
+                    calls = [self.calls.pop(key) for key in own]
+                for key, call in zip(own, calls):
+                    call.value = results.get(key)
+                    call.error = error
+                    call.event.set()
+
+        for key, call in waiting.items():
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            if call.value is not None:
+                results[key] = call.value
+        return results
+
+
+flights = SingleFlight()
+
+
+def get_many(ids, fetch):
+    """
+    Serialized products by id, from the in-process LRU where possible. `fetch(ids)`
+    loads the misses, e.g. with one `id IN (...)` query, as {id: serialized product};
+    ids it leaves out do not exist and are left out of the result as well.
+
+    Entries are tagged with the version of their 'product:<id>' response cache
+    namespace, which every product write bumps (see cache.invalidate). Versions
+    are read from the shared cache with one get_many per call, so a write in any
+    worker retires the entry everywhere once the default cache is shared between
+    workers; with a per-process cache, other workers notice after PRODUCT_CACHE_TTL.
+    """
+    ids = list(dict.fromkeys(ids))
+    versions = dict(zip(ids, get_versions([f'product:{pk}' for pk in ids])))
+    found, misses = {}, []
+    for pk in ids:
+        entry = products.get(pk)
+        if entry is not None and entry[0] == versions[pk]:
+            found[pk] = entry[1]
+        else:
+            misses.append(pk)
+
+    if misses:
+        def load(keys):
+            loaded = fetch([pk for pk, _ in keys])
+            for pk, version in keys:
+                if pk in loaded:
+                    products.set(pk, (version, loaded[pk]))
+            return {(pk, version): loaded[pk] for pk, version in keys if pk in loaded}
+        # flights are keyed by version too: a request that has seen a write never
+        # waits for a fetch started before it
+        loaded = flights.fetch_many([(pk, versions[pk]) for pk in misses], load)
+        found.update((pk, product) for (pk, _), product in loaded.items())
+    return found
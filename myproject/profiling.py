@@ -0,0 +1,185 @@
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+
+from .db import capture_queries
+
+HEADER = 'HTTP_X_PROFILE'
+SALT = 'myproject.profiling'
+PROFILE_ID = re.compile(r'^\d+-[0-9a-f]+$')
+TOP_FUNCTIONS = 25
+MAX_QUERIES = 200
+
+_local = threading.local()
+
+
+def make_token():
+    """A header value that triggers profiling for PROFILING_TOKEN_MAX_AGE seconds."""
+    return signing.TimestampSigner(salt = SALT).sign('profile')
+
+
+def valid_token(token):
+    try:
+        signing.TimestampSigner(salt = SALT).unsign(token, max_age = settings.PROFILING_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def profile_dir():
+    return str(settings.PROFILING_DIR)
+
+
+def hot_functions(profiler, limit = TOP_FUNCTIONS):
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key = lambda item: item[1][2], reverse = True)[:limit]
+    return [
+        {
+            'function': pstats.func_std_string(function),
+            'calls': calls,
+            'own_ms': round(own * 1000, 3),
+            'cumulative_ms': round(cumulative * 1000, 3),
+        }
+        for function, (_, calls, own, cumulative, _) in rows
+    ]
+
+
+class RequestProfile:
+    def __init__(self, request):
+        self.request = request
+        self.profiler = cProfile.Profile()
+        self.capture = capture_queries()
+
+    def __enter__(self):
+        _local.active = True
+        self.queries = self.capture.__enter__()
+        self.started = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        self.wall = time.perf_counter() - self.started
+        self.capture.__exit__(*exc_info)
+        _local.active = False
+
+    def save(self, response):
+        """Write <id>.prof (pstats format, for snakeviz, pstats, etc.) and an <id>.json
+        summary, then drop the oldest profiles beyond PROFILING_KEEP."""
+        directory = profile_dir()
+        os.makedirs(directory, exist_ok = True)
+        profile_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+        self.profiler.dump_stats(os.path.join(directory, f'{profile_id}.prof'))
+        summary = {
+            'id': profile_id,
+            'method': self.request.method,
+            'path': self.request.get_full_path(),
+            'status': response.status_code,
+            'wall_ms': round(self.wall * 1000, 3),
+            'query_count': len(self.queries),
+            'query_ms': round(sum(duration for _, _, duration in self.queries) * 1000, 3),
+            'queries': [
+                {'database': alias, 'sql': sql, 'ms': round(duration * 1000, 3)}
+                for alias, sql, duration in self.queries[:MAX_QUERIES]
+            ],
+            'hot_functions': hot_functions(self.profiler),
+        }
+        with open(os.path.join(directory, f'{profile_id}.json'), 'w') as f:
+            json.dump(summary, f)
+        prune(directory, settings.PROFILING_KEEP)
+        response['X-Profile-Id'] = profile_id
+        return response
+
+
+def prune(directory, keep):
+    ids = sorted(name[:-5] for name in os.listdir(directory) if name.endswith('.json'))
+    for profile_id in ids[:-keep] if keep else ids:
+        for extension in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, profile_id + extension))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles():
+    """Summaries of the stored profiles, newest first, without the query lists."""
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse = True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue  # pruned or half-written meanwhile
+        summary.pop('queries')
+        summary['hot_functions'] = summary['hot_functions'][:5]
+        profiles.append(summary)
+    return profiles
+
+
+def profile_path(profile_id, extension):
+    if not PROFILE_ID.match(profile_id):
+        return None
+    path = os.path.join(profile_dir(), profile_id + extension)
+    return path if os.path.exists(path) else None
+
+
+class ProfilingMiddleware:
+    """
+    Runs an API request under cProfile when it carries a valid X-Profile header (see
+    make_token) or is picked by PROFILING_SAMPLE_RATE. Other requests pay for one
+    dict lookup and, with sampling on, one random().
+
+    Under ASGI the profiler sees the event loop thread: the view coroutines and
+    whatever other requests the loop serves meanwhile, while ORM calls running in
+    sync_to_async threads show up as waiting time. Their SQL is recorded either way.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def triggered(self, request):
+        token = request.META.get(HEADER)
+        rate = settings.PROFILING_SAMPLE_RATE
+        if token is None and not (rate and random.random() < rate):
+            return False
+        if not request.path.startswith(settings.PROFILING_PATH_PREFIX):
+            return False
+        if getattr(_local, 'active', False):
+            return False  # one profiler per thread at a time
+        return token is None or valid_token(token)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.triggered(request):
+            return self.get_response(request)
+        with RequestProfile(request) as profile:
+            response = self.get_response(request)
+        return profile.save(response)
+
+    async def __acall__(self, request):
+        if not self.triggered(request):
+            return await self.get_response(request)
+        with RequestProfile(request) as profile:
+            response = await self.get_response(request)
+        return await sync_to_async(profile.save)(response)
@@ -0,0 +1,95 @@
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from ninja.throttling import BaseThrottle
+
+from .tokens import verify_token
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# seconds until the next token, set by a refused allow_request() for wait();
+# ninja calls the two back to back on a shared throttle instance
+_retry_after = ContextVar('retry_after', default = None)
+
+
+@lru_cache(maxsize = None)
+def parse_rate(rate):
+    """'10/m' -> (capacity 10, refill 10/60 tokens per second)."""
+    count, period = rate.split('/')
+    return int(count), int(count) / PERIODS[period[0]]
+
+
+def session_user_id(session_key):
+    """The user id of a logged-in session found in the session cache, else None.
+    Sessions are looked up only in the cache, never in the database."""
+    store = import_string(settings.SESSION_ENGINE + '.SessionStore')
+    prefix = getattr(store, 'cache_key_prefix', None)
+    if prefix is None or not session_key:
+        return None
+    data = caches[settings.SESSION_CACHE_ALIAS].get(prefix + session_key)
+    return data.get(SESSION_KEY) if isinstance(data, dict) else None
+
+
+def client_ident(request, throttle, by_user = True):
+    """
+    Who is spending tokens, without a query: the user id of a bearer token or of
+    a logged-in session, else the client address. A session cookie counts only
+    once the session store knows it, so made-up cookies do not buy fresh
+    buckets. Resolving request.user is avoided on purpose, async operations run
+    their throttles inside the event loop.
+    """
+    if by_user:
+        scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        payload = verify_token(token) if scheme.lower() == 'bearer' else None
+        if isinstance(payload, dict) and 'id' in payload:
+            return f'user:{payload["id"]}'
+        user_id = session_user_id(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+        if user_id is not None:
+            return f'user:{user_id}'
+    return f'ip:{throttle.get_ident(request)}'
+
+
+class TokenBucket(BaseThrottle):
+    """
+    Ninja throttle: every client of `scope` gets a bucket of RATE_LIMITS[scope]
+    tokens (e.g. '10/m': 10 at once, refilled at 10 per minute), stored in the
+    RATE_LIMIT_CACHE cache so all workers share it when that cache is shared.
+    A request spends one token; an empty bucket answers 429 with Retry-After.
+
+    The bucket is read and written without a lock, so concurrent requests of one
+    client in different workers may spend the same token; the limit then
+    overshoots by at most one request per worker.
+
+    `by_user=False` keys by client address only; `when(request)` limits just the
+    matching requests, e.g. those with text filters.
+    """
+
+    def __init__(self, scope, by_user = True, when = None):
+        self.scope = scope
+        self.by_user = by_user
+        self.when = when
+
+    def allow_request(self, request):
+        rate = settings.RATE_LIMITS.get(self.scope)
+        if rate is None or (self.when is not None and not self.when(request)):
+            return True
+        capacity, refill = parse_rate(rate)
+        cache = caches[settings.RATE_LIMIT_CACHE]
+        key = f'ratelimit:{self.scope}:{client_ident(request, self, self.by_user)}'
+        now = time.time()
+        tokens, updated = cache.get(key) or (capacity, now)
+        tokens = min(capacity, tokens + (now - updated) * refill)
+        if tokens < 1:
+            _retry_after.set((1 - tokens) / refill)
+            return False
+        # a bucket left alone for capacity / refill seconds is full again, as if absent
+        cache.set(key, (tokens - 1, now), capacity / refill)
+        return True
+
+    def wait(self):
+        return _retry_after.get()
@@ -0,0 +1,45 @@
+from ninja.parser import Parser
+from ninja.renderers import BaseRenderer, JSONRenderer
+from ninja.responses import NinjaJSONEncoder
+
+try:
+    import orjson
+except ImportError:  # the stdlib json renderer and parser are used instead
+    orjson = None
+
+# what orjson cannot encode itself (Decimal, pydantic models, ...) goes through
+# ninja's encoder; datetimes too, so they keep its millisecond, 'Z' format
+_default = NinjaJSONEncoder().default
+_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def dumps(data):
+    """JSON bytes of `data`, equal once parsed to what ninja's JSONRenderer produces."""
+    return orjson.dumps(data, default = _default, option = _OPTIONS)
+
+
+class ORJSONRenderer(BaseRenderer):
+    """
+    Encodes responses with orjson, several times faster than json.dumps on large
+    lists of schemas. Output differs from the default renderer in whitespace only:
+    Decimal is a string, datetimes are ISO 8601 to the millisecond, UUIDs strings.
+    """
+    media_type = 'application/json'
+
+    def render(self, request, data, *, response_status):
+        return dumps(data)
+
+
+class ORJSONParser(Parser):
+    """Decodes request bodies with orjson; its errors subclass json.JSONDecodeError."""
+
+    def parse_body(self, request):
+        return orjson.loads(request.body)
+
+
+def api_renderer():
+    return ORJSONRenderer() if orjson else JSONRenderer()
+
+
+def api_parser():
+    return ORJSONParser() if orjson else Parser()
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.db import connections
+
+READ_ALIAS = 'readonly'
+
+
+class ReadOnlyRouter:
+    """
+    Sends reads to the `readonly` connection and writes to `default`. Inside a
+    transaction on `default` reads stay there, so a request sees its own
+    uncommitted writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        if READ_ALIAS not in settings.DATABASES or connections['default'].in_atomic_block:
+            return 'default'
+        return READ_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name = None, **hints):
+        return db == 'default'
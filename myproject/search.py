@@ -0,0 +1,96 @@
+import re
+
+from django.db import connection, connections
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'myproject_product_fts'
+
+# External-content FTS5 table over myproject_product: the index stores only tokens,
+# the text itself stays in the product table. Triggers keep it in sync for every
+# kind of write (save(), delete(), bulk_create(), queryset.update()).
+CREATE_SQL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, description,
+        content='myproject_product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON myproject_product BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON myproject_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, description ON myproject_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+DROP_SQL = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+# bm25 weights for (title, description): a hit in the title counts ten times more
+RANK_SQL = f"bm25({FTS_TABLE}, 10.0, 1.0)"
+
+
+def match_query(text):
+    """Turn free user input into a safe FTS5 expression: every word is a quoted
+    term, the last one is a prefix so search-as-you-type works."""
+    terms = re.findall(r'\w+', text)
+    if not terms:
+        return None
+    quoted = ['"%s"' % term for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def search_products(queryset, text):
+    """Narrow a Product queryset to full-text matches and annotate `search_rank`
+    (lower is better, as returned by bm25).
+
+    The FTS table is joined once: the MATCH runs a single time and every matching
+    row carries its rank, so ordering and seeking by `search_rank` cost no extra
+    lookups. A correlated `SELECT bm25(...) ... MATCH` per row would re-run the
+    full-text query for every candidate, quadratic on common terms."""
+    expression = match_query(text)
+    if expression is None:
+        return queryset.none()
+    table = queryset.model._meta.db_table
+    return queryset.extra(
+        tables = [FTS_TABLE],
+        where = [f'{FTS_TABLE}.rowid = {table}.id', f'{FTS_TABLE} MATCH %s'],
+        params = [expression],
+    ).annotate(search_rank = RawSQL(RANK_SQL, ()))
+
+
+def create_index(schema_editor):
+    for sql in CREATE_SQL:
+        schema_editor.execute(sql)
+
+
+def drop_index(schema_editor):
+    for sql in DROP_SQL:
+        schema_editor.execute(sql)
+
+
+def ensure_index(using = 'default', **kwargs):
+    """post_migrate hook: SQLite drops a table's triggers whenever a migration
+    rebuilds the table, so put them back after every migrate."""
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for sql in CREATE_SQL:
+            cursor.execute(sql)
+
+
+def rebuild_index():
+    with connection.cursor() as cursor:
+        for sql in CREATE_SQL:
+            cursor.execute(sql)
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
@@ -41,11 +41,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'myproject.metrics.MetricsMiddleware',
+    'myproject.profiling.ProfilingMiddleware',
+    'myproject.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'myproject.tokens.BearerTokenMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -74,14 +78,102 @@ WSGI_APPLICATION = 'myproject.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Connections are kept for CONN_MAX_AGE seconds and tuned with SQLITE_PRAGMAS when
+# opened (see myproject.db). WAL lets readers run alongside the single writer;
+# `timeout` is how long a writer waits for the lock instead of failing with
+# "database is locked"; write transactions take the lock at BEGIN IMMEDIATE so
+# that the wait applies to them (myproject.backends.sqlite3). Reads go to the
+# `readonly` alias (myproject.routers), a query_only connection to the same file.
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'myproject.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {'timeout': 20, 'transaction_mode': 'IMMEDIATE'},
+    },
+    'readonly': {
+        'ENGINE': 'myproject.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {'timeout': 20},
+        'PRAGMAS': {'query_only': 'ON'},
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['myproject.routers.ReadOnlyRouter']
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # KiB, i.e. 64 MB of page cache per connection
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# API responses and their version counters live here. LocMemCache is per process:
+# with several workers point this at a shared backend (Redis, Memcached).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'myproject',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
     }
 }
 
 
+# Authentication
+# API clients send `Authorization: Bearer <token>` with the token returned by
+# /api/login: an HMAC-signed user id checked without a query. Token and session
+# users are resolved through a per-process LRU, so a password change or
+# deactivation reaches other workers within USER_CACHE_TTL seconds. Browser
+# sessions are read from the cache and written through to the database.
+
+AUTHENTICATION_BACKENDS = ['myproject.tokens.CachedModelBackend']
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+API_TOKEN_MAX_AGE = 24 * 3600
+
+USER_CACHE_SIZE = 1024
+
+USER_CACHE_TTL = 60
+
+
+# Product object cache
+# /api/products/batch keeps serialized products in a per-process LRU. Entries are
+# checked against the product's response cache version on every read, so writes
+# retire them in all workers sharing the default cache; PRODUCT_CACHE_TTL bounds
+# their age otherwise.
+
+PRODUCT_CACHE_SIZE = 10000
+
+PRODUCT_CACHE_TTL = 300
+
+
+# Rate limits
+# Token buckets per client (bearer token or session user, else address) for the
+# expensive operations, see myproject.ratelimit. '10/m' allows a burst of 10 and
+# 10 more per minute; None turns a scope off. Buckets live in RATE_LIMIT_CACHE,
+# which must be shared (Redis, Memcached) for the limits to span workers.
+
+RATE_LIMITS = {
+    'login': '10/m',
+    'registration': '5/m',
+    'text_search': '60/m',
+    'create_order': '30/m',
+}
+
+RATE_LIMIT_CACHE = 'default'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -118,6 +210,116 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+
+# Media
+# Product images are stored under MEDIA_ROOT/images/ (see myproject.storage) and
+# served at MEDIA_URL by myproject.media, with Range and conditional requests.
+# MEDIA_ACCEL hands the body to the front-end server instead:
+# 'x-accel-redirect' for nginx, with an `internal` location at MEDIA_ACCEL_PREFIX
+# aliased to MEDIA_ROOT, or 'x-sendfile' for Apache mod_xsendfile and lighttpd.
+# Content-addressed files are cached for a year; others for MEDIA_MAX_AGE seconds.
+
+MEDIA_ROOT = BASE_DIR
+
+MEDIA_URL = '/media/'
+
+MEDIA_ACCEL = None
+
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+MEDIA_MAX_AGE = 24 * 3600
+
+
+# Product image variants
+# Thumbnails are rendered by a thread pool in each process ('threads'); uploads
+# beyond the queue size are left for `manage.py build_image_variants`. With
+# 'jobs' they are queued for `manage.py run_jobs` instead, see Background jobs;
+# with None all of them are left for the command.
+
+IMAGE_VARIANT_BACKEND = 'threads'
+
+IMAGE_VARIANT_WORKERS = 2
+
+IMAGE_VARIANT_QUEUE = 256
+
+
+# Request profiling
+# API requests run under cProfile when they carry an X-Profile header minted by
+# POST /api/profiles/token, or with probability PROFILING_SAMPLE_RATE. The newest
+# PROFILING_KEEP profiles are kept; list them at GET /api/profiles (staff only).
+
+PROFILING_DIR = BASE_DIR / 'profiles'
+
+PROFILING_KEEP = 100
+
+PROFILING_SAMPLE_RATE = 0.0
+
+PROFILING_TOKEN_MAX_AGE = 3600
+
+PROFILING_PATH_PREFIX = '/api/'
+
+
+# Metrics
+# Every process keeps per-route counters in memory and writes them to METRICS_DIR
+# every METRICS_FLUSH_INTERVAL seconds; /metrics sums the files of all workers in
+# Prometheus text format. Files not updated for METRICS_RETENTION seconds are
+# dropped. /metrics answers only clients in METRICS_ALLOWED_IPS (addresses or
+# networks, None for anyone); behind a proxy REMOTE_ADDR is the proxy's, so keep
+# /metrics internal there too.
+
+METRICS_DIR = BASE_DIR / 'metrics'
+
+METRICS_FLUSH_INTERVAL = 1.0
+
+METRICS_RETENTION = 7 * 24 * 3600
+
+METRICS_NAMESPACE = 'myproject'
+
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+
+# Compression
+# API responses of at least COMPRESSION_MIN_SIZE bytes are sent gzip compressed,
+# or with Brotli when the brotli package is installed and the client accepts it.
+# Cached responses keep their compressed copies in the cache next to the body.
+
+COMPRESSION_PATH_PREFIX = '/api/'
+
+COMPRESSION_MIN_SIZE = 1024
+
+COMPRESSION_GZIP_LEVEL = 6
+
+COMPRESSION_BROTLI_QUALITY = 5
+
+
+# Background jobs
+# Deferred work is queued in the Job table (myproject.jobs) and run by
+# `manage.py run_jobs` workers. A failed job is retried after JOB_RETRY_BASE,
+# 2 * JOB_RETRY_BASE, ... seconds (at most JOB_RETRY_MAX) until it has run
+# JOB_MAX_ATTEMPTS times. Jobs running longer than JOB_TIMEOUT seconds are taken
+# to belong to a dead worker and queued again; succeeded jobs are deleted after
+# JOB_RETENTION seconds.
+
+JOB_MAX_ATTEMPTS = 5
+
+JOB_RETRY_BASE = 10
+
+JOB_RETRY_MAX = 3600
+
+JOB_TIMEOUT = 600
+
+JOB_RETENTION = 7 * 24 * 3600
+
+JOB_POLL_INTERVAL = 1.0
+
+
+# Tests
+# The default runner, with metrics kept in memory and no image variants rendered
+# in the background (myproject.testing).
+
+TEST_RUNNER = 'myproject.testing.TestRunner'
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
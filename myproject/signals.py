@@ -0,0 +1,73 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import category_stats
+from .cache import invalidate
+from .images import schedule_variants
+from .models import Category, Product
+from .tokens import users
+
+
+@receiver(pre_save, sender = Category)
+def remember_category_slug(sender, instance, **kwargs):
+    if instance.pk:
+        instance._old_slug = Category.objects.filter(pk = instance.pk).values_list('slug', flat = True).first()
+
+
+@receiver(post_save, sender = Category)
+@receiver(post_delete, sender = Category)
+def invalidate_category(sender, instance, **kwargs):
+    slugs = {instance.slug, getattr(instance, '_old_slug', None)} - {None}
+    invalidate('categories', *(f'category:{slug}' for slug in slugs))
+
+
+@receiver(post_save, sender = Product)
+@receiver(post_delete, sender = Product)
+def invalidate_product(sender, instance, **kwargs):
+    invalidate('products', f'product:{instance.pk}')
+
+
+@receiver(post_save, sender = Product)
+def schedule_image_variants(sender, instance, **kwargs):
+    if instance.image and not instance.variants_ready:
+        name = instance.image.name
+        transaction.on_commit(lambda: schedule_variants(name))
+
+
+@receiver(pre_save, sender = Product)
+def remember_product_category(sender, instance, raw, **kwargs):
+    if instance.pk and not raw:
+        instance._old_stats = Product.objects.filter(pk = instance.pk).values_list('category_id', 'price').first()
+
+
+@receiver(post_save, sender = Product)
+def update_category_stats(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    old = getattr(instance, '_old_stats', None)
+    new = (instance.category_id, Decimal(str(instance.price)))
+    if old == new:
+        return
+    if old:
+        category_stats.product_removed(*old)
+    category_stats.product_added(*new)
+    category_stats.invalidate_categories({old[0], new[0]} if old else {new[0]})
+
+
+@receiver(post_delete, sender = Product)
+def remove_from_category_stats(sender, instance, origin = None, **kwargs):
+    if isinstance(origin, Category):
+        return  # the whole category goes with it
+    category_stats.product_removed(instance.category_id, instance.price)
+    category_stats.invalidate_categories({instance.category_id})
+
+
+@receiver(post_save, sender = User)
+@receiver(post_delete, sender = User)
+def forget_cached_user(sender, instance, **kwargs):
+    # other processes drop it after USER_CACHE_TTL
+    users.pop(instance.pk)
@@ -0,0 +1,66 @@
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+
+HASHED_NAME = re.compile(r'^[0-9a-f]{64}(\.\w+)?$')
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every file under the SHA-256 of its bytes, keeping the upload directory
+    and the extension: `images/<sha256>.jpg`. The upload is hashed while it is
+    streamed to a temporary file next to its destination; if a file with that hash
+    already exists the temporary copy is dropped and the existing file, its mtime
+    refreshed, is returned.
+    Files are shared between rows, so nothing is deleted with a product; the
+    `collect_images` command removes blobs no row references anymore.
+    """
+
+    def get_available_name(self, name, max_length = None):
+        # the final name depends on the content and is picked in _save
+        return name
+
+    def _save(self, name, content):
+        directory, filename = posixpath.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        full_directory = self.path(directory)
+        os.makedirs(full_directory, exist_ok = True)
+
+        digest = hashlib.sha256()
+        fd, temporary = tempfile.mkstemp(dir = full_directory, prefix = '.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    fp.write(chunk)
+            name = posixpath.join(directory, digest.hexdigest() + extension)
+            try:
+                # a reused file is as new as this upload for collect_images' grace
+                # period, or it could be collected before the row using it commits
+                os.utime(self.path(name))
+            except FileNotFoundError:
+                if self.file_permissions_mode is not None:
+                    os.chmod(temporary, self.file_permissions_mode)
+                os.replace(temporary, self.path(name))
+            else:
+                os.remove(temporary)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return name
+
+
+def is_content_addressed(name):
+    return bool(HASHED_NAME.match(posixpath.basename(name)))
+
+
+image_storage = ContentAddressedStorage()
+
+
+def get_image_storage():
+    return image_storage
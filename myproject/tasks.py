@@ -0,0 +1,35 @@
+from django.db.models import F, Sum
+
+from .images import build_variants
+from .jobs import task
+from .models import Order, OrderItem, Product
+
+
+@task('images.build_variants')
+def build_image_variants(source):
+    # already built, e.g. by an earlier attempt or build_image_variants
+    if not Product.objects.filter(image = source).exclude(variants_source = source).exists():
+        return None
+    # a failure raises, so the job is retried with backoff
+    return build_variants(source)
+
+
+@task('orders.recompute_totals')
+def recompute_totals(order_ids):
+    """Order.total from the current product prices, for all orders in one query."""
+    totals = dict(
+        OrderItem.objects.filter(order_id__in = order_ids)
+        .values('order_id')
+        .annotate(total = Sum(F('product__price') * F('quantity')))
+        .values_list('order_id', 'total')
+    )
+    orders = list(Order.objects.using('default').filter(id__in = order_ids).only('id', 'total'))
+    for order in orders:
+        order.total = totals.get(order.id) or 0
+    Order.objects.bulk_update(orders, ['total'], batch_size = 500)
+    return {'updated': len(orders)}
+
+
+@task('orders.set_status')
+def set_status(order_ids, status_id):
+    return {'updated': Order.objects.filter(id__in = order_ids).update(status_id = status_id)}
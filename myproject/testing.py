@@ -0,0 +1,18 @@
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    """The default runner with METRICS_DIR off, so test requests do not write
+    metrics into the source tree (MetricsTest sets a temporary directory), and
+    IMAGE_VARIANT_BACKEND off, so no background thread renders images into it
+    or writes to the test database behind a test's back."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.test_settings = override_settings(METRICS_DIR = None, IMAGE_VARIANT_BACKEND = None)
+        self.test_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.test_settings.disable()
+        super().teardown_test_environment(**kwargs)
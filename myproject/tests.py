@@ -1,9 +1,53 @@
-from django.test import Client, TestCase
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase
 from ninja.testing import TestClient
 from .api import api, router, UserLogin
 from .models import *
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.core.management import call_command
+from django.core.cache import cache
+from .search import search_products
+from .facets import price_buckets
+from .importer import import_products
+from .images import build_variants, variant_names
+from django.core.files.base import ContentFile
+from django.db.models import F
+from PIL import Image as PILImage
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.db import connection, connections, transaction
+from django.conf import settings
+from .db import connection_pragmas
+from .routers import ReadOnlyRouter
+from .profiling import make_token
+from .metrics import MetricsMiddleware, Registry
+from .media import serve
+from .tokens import users, verify_token
+from .lru import TTLCache
+from . import product_cache
+from .product_cache import SingleFlight
+from .renderers import ORJSONRenderer
+from . import cache as cache_module
+from . import compression
+from .compression import accepted_encoding
+from . import jobs
+from .jobs import claim, enqueue, execute, requeue_stale
+from django.test import RequestFactory
+import gzip
+from ninja.renderers import JSONRenderer
+from decimal import Decimal
+import datetime
+import threading
+import uuid
+from django.core.files.uploadedfile import SimpleUploadedFile
+from unittest import mock
+import csv
+import hashlib
+import io
+import pstats
+import os
+import tempfile
+import time
+import zipfile
 import json
 
 
@@ -11,6 +55,7 @@ class ProductTest(TestCase):
     fixtures = ['db.json']
     def setUp(self):
         self.client = Client()
+        cache.clear()
 
     def test_str(self):
         category = Category(title='slay', slug='slay')
@@ -32,12 +77,42 @@ class ProductTest(TestCase):
         response = self.client.get("/api/product/2")
         print(response.json())
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json(), {'id': 2, 'title': 'ratew', 'slug': 'rat', 'category_id': 1, 'description': 'very rat', 'price': 24.0})
+        self.assertEqual(response.json(), {'id': 2, 'title': 'ratew', 'slug': 'rat', 'category_id': 1, 'description': 'very rat', 'price': 24.0, 'variants': {}})
     
     def test_get_products_filter(self):
         response = self.client.get("/api/products?min_price=30&max_price=40")
         print(response.json())
         self.assertEqual(response.status_code, 200)
+
+    def test_get_products_cursor(self):
+        titles = []
+        cursor = ''
+        while True:
+            response = self.client.get("/api/products", {'limit': 2, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data['items']), 2)
+            titles += [item['title'] for item in data['items']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(titles, list(Product.objects.order_by('title', 'id').values_list('title', flat=True)))
+
+    def test_get_products_cursor_same_title(self):
+        product = Product.objects.get(id=2)
+        product.pk = None
+        product.slug = 'rat-2'
+        product.save()
+        response = self.client.get("/api/products", {'limit': 1, 'min_price': 24, 'max_price': 24})
+        first = response.json()
+        response = self.client.get("/api/products", {'limit': 1, 'min_price': 24, 'max_price': 24, 'cursor': first['next_cursor']})
+        second = response.json()
+        self.assertEqual([first['items'][0]['id'], second['items'][0]['id']], [2, product.id])
+        self.assertIsNone(second['next_cursor'])
+
+    def test_get_products_bad_cursor(self):
+        response = self.client.get("/api/products?cursor=nope")
+        self.assertEqual(response.status_code, 400)
     
     
 
@@ -45,6 +120,7 @@ class CategoryTest(TestCase):
     fixtures = ['db.json']
     def setUp(self):
         self.client = Client()
+        cache.clear()
 
     def test_str(self):
         category = Category(
@@ -62,13 +138,14 @@ class CategoryTest(TestCase):
         response = self.client.get("/api/category/slay")
         print(response.json())
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json(), {'id': 5, 'title': 'slay', 'slug': 'slay'})
+        self.assertEqual(response.json(), {'id': 5, 'title': 'slay', 'slug': 'slay', 'product_count': 1, 'min_price': 100.0, 'max_price': 100.0, 'avg_price': 100.0})
 
 
 class RegisterTest(TestCase):
     fixtures = ['db.json']
     def setUp(self):
         self.client = Client()
+        cache.clear()
 
     def test_register(self):
         payload = {
@@ -89,11 +166,13 @@ class LoginTest(TestCase):
     fixtures = ['db.json']
     def setUp(self):
         self.client = Client()
+        cache.clear()
 
     def test_login(self):
         response = self.client.post("/api/login", content_type = 'application/json', data={"username": "admin","password": "admin"},follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json(), {'success':True})
+        self.assertEqual(response.json()['success'], True)
+        self.assertEqual(verify_token(response.json()['token'])['id'], User.objects.get(username = 'admin').id)
 
     def test_get_user(self):
         response = self.client.post("/api/login", content_type = 'application/json', data={"username": "admin", "password": "admin"})
@@ -121,6 +200,7 @@ class WishlistTest(TestCase):
     fixtures = ['db.json']
     def setUp(self):
         self.client = Client()
+        cache.clear()
 
     def test_get_wl(self):
         self.client.post("/api/login", content_type = 'application/json', data={"username": "admin", "password": "admin"})
@@ -141,12 +221,43 @@ class OrderTest(TestCase):
     fixtures = ['db.json']
     def setUp(self):
         self.client = Client()
+        cache.clear()
 
     def test_get_orders(self):
         self.client.post("/api/login", content_type = 'application/json', data={"username": "admin", "password": "admin"})
         response = self.client.get("/api/get_orders")
         self.assertEqual(response.status_code, 200)
 
+    def test_get_orders_cursor(self):
+        response = self.client.get("/api/get_orders?limit=1")
+        first = response.json()
+        self.assertEqual(len(first['items']), 1)
+        response = self.client.get("/api/get_orders", {'limit': 1, 'cursor': first['next_cursor']})
+        second = response.json()
+        self.assertEqual(second['items'][0]['price'], 120.0)
+        self.assertIsNone(second['next_cursor'])
+
+    def test_get_user_orders_cursor(self):
+        user = User.objects.get(username = 'test')
+        response = self.client.get(f"/api/order/{user.id}/?limit=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['items'], [{'status': {'name': 'New'}, 'total': 150.0}])
+        self.assertIsNotNone(response.json()['next_cursor'])
+
+    def test_get_user_orders_cursor_microseconds(self):
+        user = User.objects.get(username = 'test')
+        status = Status.objects.get(id = 1)
+        created = [Order.objects.create(user = user, status = status, total = i) for i in range(3)]
+        self.assertTrue(any(order.created_at.microsecond % 1000 for order in created))
+        seen, cursor = [], ''
+        for _ in range(10):
+            data = self.client.get(f"/api/order/{user.id}/", {'limit': 1, 'cursor': cursor}).json()
+            seen += [item['total'] for item in data['items']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, [150.0, 120.0, 0.0, 1.0, 2.0])
+
     def test_get_order(self):
         self.client.post("/api/login", content_type = 'application/json', data={"username": "admin", "password": "admin"})
         response = self.client.get("/api/order/1", follow=True)
@@ -158,7 +269,1444 @@ class OrderTest(TestCase):
         self.assertEqual(response.status_code, 200)
         
 
+    def test_create_order(self):
+        response = self.client.post("/api/create_order", content_type = 'application/json', data = [1, 2])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': {'name': 'New'}, 'total': 270.0})
+        order = Order.objects.latest('id')
+        self.assertEqual(order.user.username, 'test')
+        self.assertEqual(sorted(order.items.values_list('price', flat = True)), [120, 150])
+
+    def test_create_order_missing_wishlist(self):
+        orders = Order.objects.count()
+        response = self.client.post("/api/create_order", content_type = 'application/json', data = [1, 404])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Order.objects.count(), orders)
+
+    def test_create_order_atomic(self):
+        orders = Order.objects.count()
+        with mock.patch.object(OrderItem.objects, 'bulk_create', side_effect = RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post("/api/create_order", content_type = 'application/json', data = [1, 2])
+        self.assertEqual(Order.objects.count(), orders)
+
     def test_change_status(self):
         self.client.post("/api/login", content_type = 'application/json', data={"username": "admin", "password": "admin"})
         response = self.client.put("/api/change_status?order_id=3&status_id=2")
-        self.assertEqual(response.status_code, 200)
\ No newline at end of file
+        self.assertEqual(response.status_code, 200)
+
+class SearchTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def test_search_ranked(self):
+        response = self.client.get("/api/products/search?q=big")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.json()['items']], [3])
+
+    def test_search_prefix_and_filters(self):
+        response = self.client.get("/api/products/search?q=rat&category=2&max_price=30")
+        self.assertEqual([item['id'] for item in response.json()['items']], [4])
+
+    def test_search_title_ranks_first(self):
+        response = self.client.get("/api/products/search?q=slayer")
+        self.assertEqual(response.json()['items'][0]['id'], 6)
+
+    def test_search_cursor(self):
+        response = self.client.get("/api/products/search?q=rat&limit=2")
+        first = response.json()
+        response = self.client.get("/api/products/search", {'q': 'rat', 'limit': 10, 'cursor': first['next_cursor']})
+        rest = response.json()
+        ids = [item['id'] for item in first['items'] + rest['items']]
+        self.assertEqual(sorted(ids), [2, 3, 4, 5, 6])
+
+    def test_search_large_match_set(self):
+        Product.objects.bulk_create(
+            Product(category_id = 1, title = f'item {i}', slug = f'item-{i}', price = 1,
+                    description = 'hamster ' * (i % 7 + 1) + 'filler ' * (i % 11))
+            for i in range(600)
+        )
+        expected = list(search_products(Product.objects.all(), 'hamster').order_by('search_rank', 'id').values_list('id', flat = True))
+        self.assertEqual(len(expected), 600)
+        ids, cursor = [], None
+        while True:
+            params = {'q': 'hamster', 'limit': 100}
+            if cursor:
+                params['cursor'] = cursor
+            with CaptureQueriesContext(connection) as queries:
+                page = self.client.get("/api/products/search", params).json()
+            # one full-text evaluation per statement, however many rows match
+            for query in queries.captured_queries:
+                self.assertLessEqual(query['sql'].count('MATCH'), 1)
+            ids += [item['id'] for item in page['items']]
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(ids, expected)
+
+    def test_index_follows_writes(self):
+        product = Product.objects.get(id = 2)
+        product.description = 'a hamster, actually'
+        product.save()
+        self.assertEqual(list(search_products(Product.objects.all(), 'hamster').values_list('id', flat = True)), [2])
+        product.delete()
+        self.assertFalse(search_products(Product.objects.all(), 'hamster').exists())
+
+    def test_products_q_filter(self):
+        response = self.client.get("/api/products?q=smallest")
+        self.assertEqual([item['id'] for item in response.json()['items']], [4])
+
+    def test_rebuild_command(self):
+        call_command('rebuild_search_index', stdout = io.StringIO())
+        self.assertEqual(search_products(Product.objects.all(), 'average').count(), 1)
+
+
+class ResponseCacheTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def test_etag_and_not_modified(self):
+        response = self.client.get("/api/product/2")
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/product/2", HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_cached_body(self):
+        first = self.client.get("/api/products?min_price=30")
+        with self.assertNumQueries(0):
+            second = self.client.get("/api/products?min_price=30")
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_update_invalidates(self):
+        etag = self.client.get("/api/product/2")['ETag']
+        list_etag = self.client.get("/api/products")['ETag']
+        other_etag = self.client.get("/api/product/3")['ETag']
+        payload = {'title': 'renamed', 'slug': 'rat', 'category': 'slay', 'description': 'very rat', 'price': 24}
+        with mock.patch('myproject.signals.schedule_variants') as schedule, \
+                self.captureOnCommitCallbacks(execute = True):
+            self.client.put("/api/products/2", content_type = 'application/json', data = payload)
+        schedule.assert_called_once_with(Product.objects.get(id = 2).image.name)
+        response = self.client.get("/api/product/2", HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['title'], 'renamed')
+        self.assertEqual(self.client.get("/api/products", HTTP_IF_NONE_MATCH = list_etag).status_code, 200)
+        self.assertEqual(self.client.get("/api/product/3", HTTP_IF_NONE_MATCH = other_etag).status_code, 304)
+
+    def test_delete_category_invalidates(self):
+        etag = self.client.get("/api/category/slay")['ETag']
+        categories_etag = self.client.get("/api/categories")['ETag']
+        product_etag = self.client.get("/api/product/6")['ETag']
+        with self.captureOnCommitCallbacks(execute = True):
+            self.client.delete("/api/categories/slay")
+        self.assertEqual(self.client.get("/api/category/slay", HTTP_IF_NONE_MATCH = etag).status_code, 404)
+        self.assertEqual(self.client.get("/api/categories", HTTP_IF_NONE_MATCH = categories_etag).status_code, 200)
+        self.assertEqual(self.client.get("/api/product/6", HTTP_IF_NONE_MATCH = product_etag).status_code, 404)
+
+    def test_errors_not_cached(self):
+        self.client.get("/api/product/999")
+        Product.objects.create(id = 999, category_id = 1, title = 'late rat', slug = 'late-rat', image = 'images/rat3.jpeg', price = 1)
+        self.assertEqual(self.client.get("/api/product/999").status_code, 200)
+
+
+class QueryCountTest(TestCase):
+    fixtures = ['db.json']
+    ROWS = 2000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.get(username = 'test')
+        statuses = list(Status.objects.all())
+        category = Category.objects.get(slug = 'slay')
+        products = Product.objects.bulk_create(
+            Product(category = category, title = f'rat {i}', slug = f'rat-{i}', image = 'images/rat3.jpeg', price = i)
+            for i in range(cls.ROWS)
+        )
+        Wishlist.objects.bulk_create(Wishlist(user = cls.user, product = product) for product in products)
+        cls.order = Order.objects.create(user = cls.user, status = statuses[1], total = 0)
+        orders = Order.objects.bulk_create(
+            Order(user = cls.user, status = statuses[i % len(statuses)], total = 0) for i in range(cls.ROWS)
+        )
+        OrderItem.objects.bulk_create(
+            OrderItem(order = cls.order if i % 2 else orders[i], product = product, price = product.price)
+            for i, product in enumerate(products)
+        )
+
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def test_get_wishlist_queries(self):
+        # user lookup + wishlist with products
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/get_wishlist/{self.user.id}/")
+        self.assertEqual(len(response.json()), self.ROWS + 2)
+
+    def test_list_orders_queries(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(f"/api/get_orders?limit={self.ROWS * 2}")
+        self.assertEqual(len(response.json()['items']), self.ROWS + 2)
+
+    def test_get_user_orders_queries(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/order/{self.user.id}/?limit={self.ROWS * 2}")
+        self.assertEqual(len(response.json()['items']), self.ROWS + 3)
+
+    def test_get_order_items_queries(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/order/items/{self.order.id}/")
+        self.assertEqual(len(response.json()), self.ROWS // 2)
+
+    def test_create_order_queries(self):
+        ids = list(Wishlist.objects.filter(user = self.user).values_list('id', flat = True))
+        counts = []
+        for size in (20, 200):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post("/api/create_order", content_type = 'application/json', data = ids[:size])
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Order.objects.latest('id').items.count(), 200)
+
+
+class ImportTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def upload(self, name, content, **files):
+        data = {'file': SimpleUploadedFile(name, content.encode())}
+        data.update(files)
+        return self.client.post("/api/import_products", data = data)
+
+    def test_import_csv(self):
+        content = (
+            "title,slug,category,description,price\n"
+            "new rat,new-rat,slay,fresh,10\n"
+            "rat slayer v2,rat-slayer,slay,updated,110\n"
+            "lost rat,lost-rat,nowhere,,5\n"
+            "cheap rat,cheap-rat,slay,,free\n"
+        )
+        response = self.upload('products.csv', content)
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual(report['imported'], 2)
+        self.assertEqual(report['failed'], 2)
+        self.assertEqual([error['row'] for error in report['errors']], [4, 5])
+        self.assertEqual(Product.objects.get(id = 6).title, 'rat slayer v2')
+        self.assertEqual(Product.objects.get(slug = 'new-rat').price, 10)
+
+    def test_import_ndjson(self):
+        content = '{"title": "json rat", "slug": "json-rat", "category": "slay", "price": 7}\nnot json\n\n[1]\n'
+        report = self.upload('products.ndjson', content).json()
+        self.assertEqual((report['imported'], report['failed']), (1, 2))
+        self.assertTrue(search_products(Product.objects.all(), 'json').exists())
+
+    def test_import_batches(self):
+        content = "title,slug,category,price\n" + ''.join(f"rat {i},rat-{i},slay,{i}\n" for i in range(25))
+        with open(os.devnull, 'w') as devnull, tempfile.NamedTemporaryFile('w', suffix = '.csv') as fp:
+            fp.write(content)
+            fp.flush()
+            with CaptureQueriesContext(connection) as queries:
+                call_command('import_products', fp.name, batch_size = 10, stdout = devnull)
+        self.assertEqual(Product.objects.filter(slug__startswith = 'rat-').count(), 26)
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "myproject_product"')]
+        self.assertEqual(len(inserts), 3)
+
+    def test_import_images(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('pics/rat.jpg', b'not really a jpeg')
+        content = "title,slug,category,price,image\nzip rat,zip-rat,slay,1,pics/rat.jpg\nno rat,no-rat,slay,1,pics/none.jpg\n"
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT = media):
+            report = self.upload('products.csv', content, images = SimpleUploadedFile('images.zip', archive.getvalue())).json()
+            product = Product.objects.get(slug = 'zip-rat')
+            self.assertEqual(product.image.read(), b'not really a jpeg')
+            product.image.close()
+        self.assertEqual((report['imported'], report['failed']), (1, 1))
+        self.assertTrue(product.image.name.startswith('images/'))
+
+    def test_import_bad_prices(self):
+        content = "title,slug,category,price\n" + ''.join(
+            f"rat {i},bad-rat-{i},slay,{price}\n" for i, price in enumerate(['NaN', '1e20', '-5', 'Infinity', 'sNaN'])
+        ) + "good rat,good-rat,slay,5\n"
+        report = self.upload('products.csv', content).json()
+        self.assertEqual((report['imported'], report['failed']), (1, 5))
+        self.assertEqual([error['row'] for error in report['errors']], [2, 3, 4, 5, 6])
+        self.assertFalse(Product.objects.filter(slug__startswith = 'bad-rat').exists())
+
+    def test_import_keeps_missing_columns(self):
+        Product.objects.filter(id = 6).update(image = 'images/rat3.jpeg', description = 'kept')
+        content = "title,slug,category,price,image\nrat slayer v3,rat-slayer,slay,120,\n"
+        with mock.patch('myproject.importer.schedule_variants'):
+            report = self.upload('products.csv', content).json()
+        self.assertEqual(report['imported'], 1)
+        product = Product.objects.get(id = 6)
+        self.assertEqual((product.title, product.price), ('rat slayer v3', 120))
+        self.assertEqual((product.image.name, product.description), ('images/rat3.jpeg', 'kept'))
+
+        content = '{"title": "rat slayer v4", "slug": "rat-slayer", "category": "slay", "price": 1, "description": ""}\n'
+        self.upload('products.ndjson', content)
+        product = Product.objects.get(id = 6)
+        self.assertEqual((product.image.name, product.description), ('images/rat3.jpeg', ''))
+
+    def test_import_unknown_format(self):
+        self.assertEqual(self.upload('products.xlsx', 'x').status_code, 400)
+
+
+class ImageStorageTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = media.name
+        override = self.settings(MEDIA_ROOT = self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def create(self, slug, content, name = 'rat.JPG'):
+        payload = {'title': slug, 'slug': slug, 'category': 'slay', 'description': '', 'price': 1}
+        response = self.client.post("/api/create_product", data = {
+            'payload': json.dumps(payload),
+            'image': SimpleUploadedFile(name, content),
+        })
+        self.assertEqual(response.status_code, 200)
+        return Product.objects.get(id = response.json()['id'])
+
+    def test_same_content_is_stored_once(self):
+        first = self.create('first-rat', b'rat bytes')
+        second = self.create('second-rat', b'rat bytes', name = 'other.jpg')
+        third = self.create('third-rat', b'other bytes')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertNotEqual(first.image.name, third.image.name)
+        self.assertEqual(first.image.name, 'images/%s.jpg' % hashlib.sha256(b'rat bytes').hexdigest())
+        self.assertEqual(sorted(os.listdir(os.path.join(self.media, 'images'))), sorted(
+            [os.path.basename(first.image.name), os.path.basename(third.image.name)]
+        ))
+
+    def test_collect_unreferenced(self):
+        kept = self.create('kept-rat', b'kept')
+        dropped = self.create('dropped-rat', b'dropped')
+        dropped.delete()
+        call_command('collect_images', grace = 0, stdout = io.StringIO())
+        self.assertTrue(kept.image.storage.exists(kept.image.name))
+        self.assertFalse(dropped.image.storage.exists(dropped.image.name))
+
+    def test_collect_grace(self):
+        dropped = self.create('dropped-rat', b'dropped')
+        dropped.delete()
+        call_command('collect_images', stdout = io.StringIO())
+        self.assertTrue(dropped.image.storage.exists(dropped.image.name))
+
+    def test_reuse_refreshes_mtime(self):
+        dropped = self.create('dropped-rat', b'dropped')
+        dropped.delete()
+        path = dropped.image.path
+        os.utime(path, (0, 0))  # long past the grace period
+        # uploaded again, its row not yet committed while collect_images runs
+        self.assertEqual(Product._meta.get_field('image').storage.save('images/again.jpg', ContentFile(b'dropped')),
+                         dropped.image.name)
+        call_command('collect_images', stdout = io.StringIO())
+        self.assertTrue(os.path.exists(path))
+
+    def test_rehash_legacy_names(self):
+        storage = Product._meta.get_field('image').storage
+        os.makedirs(os.path.join(self.media, 'images'))
+        for name in ('rat3.jpeg', 'rat3_abc.jpeg'):
+            with open(os.path.join(self.media, 'images', name), 'wb') as fp:
+                fp.write(b'legacy rat')
+        Product.objects.filter(id = 2).update(image = 'images/rat3_abc.jpeg')
+        call_command('collect_images', grace = 0, rehash = True, stdout = io.StringIO())
+        hashed = 'images/%s.jpeg' % hashlib.sha256(b'legacy rat').hexdigest()
+        self.assertEqual(set(Product.objects.filter(id__in = [2, 6]).values_list('image', flat = True)), {hashed})
+        self.assertEqual(os.listdir(os.path.join(self.media, 'images')), [os.path.basename(hashed)])
+
+
+class ImageVariantTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        override = self.settings(MEDIA_ROOT = media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        buffer = io.BytesIO()
+        PILImage.new('RGB', (1200, 600), 'gray').save(buffer, 'JPEG')
+        storage = Product._meta.get_field('image').storage
+        self.source = storage.save('images/rat.jpg', ContentFile(buffer.getvalue()))
+        Product.objects.filter(id__in = [2, 3]).update(image = self.source)
+
+    def test_build_variants(self):
+        variants = build_variants(self.source)
+        self.assertEqual(sorted(variants), sorted(variant_names()))
+        storage = Product._meta.get_field('image').storage
+        with storage.open(variants['thumb_webp']) as fp, PILImage.open(fp) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (200, 100)))
+        for product in Product.objects.filter(id__in = [2, 3]):
+            self.assertTrue(product.variants_ready)
+        response = self.client.get("/api/product/2")
+        self.assertEqual(response.json()['variants']['medium_jpeg'], storage.url(variants['medium_jpeg']))
+
+    def test_pending_variants_hidden(self):
+        Product.objects.filter(id = 2).update(variants = {'thumb_jpeg': 'images/old.jpg'}, variants_source = 'images/old.jpg')
+        self.assertEqual(self.client.get("/api/product/2").json()['variants'], {})
+
+    def test_broken_image(self):
+        Product.objects.filter(id = 4).update(image = 'images/missing.jpg')
+        with self.assertRaises(FileNotFoundError):
+            build_variants('images/missing.jpg')
+        # not marked done: the backfill command and the job queue try again
+        self.assertFalse(Product.objects.get(id = 4).variants_ready)
+
+    def test_save_schedules(self):
+        product = Product.objects.get(id = 2)
+        product.title = 'renamed rat'
+        with mock.patch('myproject.signals.schedule_variants') as schedule:
+            with self.captureOnCommitCallbacks(execute = True):
+                product.save()
+        schedule.assert_called_once_with(self.source)
+
+    def test_backfill_command(self):
+        call_command('build_image_variants', workers = 1, stdout = io.StringIO(), stderr = io.StringIO())
+        product = Product.objects.get(id = 3)
+        self.assertTrue(product.variants_ready)
+        self.assertEqual(len(product.variants), len(variant_names()))
+        # the other fixture images are not in this media root and are left for the next run
+        self.assertEqual(set(Product.objects.exclude(variants_source = F('image')).values_list('id', flat = True)),
+                         set(Product.objects.exclude(image = '').exclude(id__in = [2, 3]).values_list('id', flat = True)))
+
+
+class ExportTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def read(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_export_products_ndjson(self):
+        response = self.client.get("/api/export/products?min_price=30")
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in self.read(response).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [3, 5, 6])
+        self.assertEqual(rows[0]['price'], 50.0)
+
+    def test_export_products_csv_search(self):
+        response = self.client.get("/api/export/products?format=csv&q=smallest")
+        rows = list(csv.reader(io.StringIO(self.read(response))))
+        self.assertEqual(rows[0], ['id', 'title', 'slug', 'category_id', 'description', 'price'])
+        self.assertEqual(rows[1][:2], ['4', 'the small rat'])
+        self.assertEqual(len(rows), 2)
+
+    def test_export_orders(self):
+        rows = [json.loads(line) for line in self.read(self.client.get("/api/export/orders")).splitlines()]
+        self.assertEqual([(row['order_id'], row['status'], row['product_title']) for row in rows],
+                         [(3, 'New', 'the big rat'), (4, 'New', 'ratew')])
+        self.assertEqual(rows[0]['created_at'], '2025-04-27T08:45:20.030Z')
+
+    async def test_export_asgi(self):
+        response = await AsyncClient().get("/api/export/products?format=csv&category=2")
+        self.assertEqual(response.status_code, 200)
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual([row[0] for row in csv.reader(io.StringIO(body))], ['id', '3', '4'])
+
+    def test_export_chunked_queries(self):
+        category = Category.objects.get(slug = 'slay')
+        Product.objects.bulk_create(
+            Product(category = category, title = f'rat {i}', slug = f'rat-{i}', image = 'images/rat3.jpeg', price = i)
+            for i in range(5000)
+        )
+        with self.assertNumQueries(1):
+            body = self.read(self.client.get("/api/export/products?format=csv"))
+        self.assertEqual(len(body.splitlines()), 5006)
+
+
+class AsyncViewTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        cache.clear()
+
+    async def test_async_reads(self):
+        client = AsyncClient()
+        response = await client.get("/api/category/slay")
+        self.assertEqual(response.json(), {'id': 5, 'title': 'slay', 'slug': 'slay', 'product_count': 1, 'min_price': 100.0, 'max_price': 100.0, 'avg_price': 100.0})
+        response = await client.get("/api/products?category=2")
+        self.assertEqual([item['id'] for item in response.json()['items']], [3, 4])
+        response = await client.get("/api/order/items/3/")
+        self.assertEqual(response.json()[0]['product']['title'], 'the big rat')
+        self.assertEqual((await client.get("/api/product/404")).status_code, 404)
+
+
+class DatabaseProfileTest(TestCase):
+    def test_pragmas_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['cache_size'])
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    def test_query_only_pragma(self):
+        pragmas = connection_pragmas(settings.DATABASES['readonly'])
+        self.assertEqual(pragmas['query_only'], 'ON')
+        self.assertEqual(pragmas['journal_mode'], 'WAL')
+
+    def test_router(self):
+        router = ReadOnlyRouter()
+        self.assertEqual(router.db_for_read(Product), 'default')  # the test runs in a transaction
+        with mock.patch.object(connections['default'], 'in_atomic_block', False):
+            self.assertEqual(router.db_for_read(Product), 'readonly')
+        self.assertEqual(router.db_for_write(Product), 'default')
+        self.assertFalse(router.allow_migrate('readonly', 'myproject'))
+
+
+class ConcurrentWriteTest(TransactionTestCase):
+    # a database file: the in-memory test database locks per table and never waits
+    WRITERS = 4
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.alias = 'writers'
+        database = {**settings.DATABASES['default'], 'NAME': os.path.join(directory.name, 'writers.sqlite3')}
+        connections.settings[self.alias] = connections.configure_settings({'default': database})['default']
+        self.addCleanup(connections.settings.pop, self.alias)
+        self.addCleanup(lambda: connections[self.alias].close())
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('CREATE TABLE counter (n integer)')
+            cursor.execute('INSERT INTO counter VALUES (0)')
+
+    def write(self, barrier, errors):
+        try:
+            barrier.wait()
+            # read first, then write: what create_order does
+            with transaction.atomic(using = self.alias), connections[self.alias].cursor() as cursor:
+                cursor.execute('SELECT n FROM counter')
+                n = cursor.fetchone()[0]
+                time.sleep(0.05)
+                cursor.execute('UPDATE counter SET n = %s', [n + 1])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections[self.alias].close()
+
+    def test_writers_wait_for_the_lock(self):
+        barrier, errors = threading.Barrier(self.WRITERS), []
+        threads = [threading.Thread(target = self.write, args = (barrier, errors)) for _ in range(self.WRITERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('SELECT n FROM counter')
+            self.assertEqual(cursor.fetchone()[0], self.WRITERS)
+
+
+class BenchmarkDataTest(TestCase):
+    def test_generate_data(self):
+        call_command('generate_data', categories = 3, products = 40, users = 4, wishlist_items = 2,
+                     orders = 10, max_items = 3, batch_size = 7, prefix = 'bench', stdout = io.StringIO())
+        self.assertEqual(Category.objects.filter(slug__startswith = 'bench-').count(), 3)
+        self.assertEqual(Product.objects.filter(slug__startswith = 'bench-').count(), 40)
+        self.assertEqual(Wishlist.objects.filter(user__username__startswith = 'bench-').count(), 8)
+        orders = Order.objects.filter(user__username__startswith = 'bench-')
+        self.assertEqual(orders.count(), 10)
+        order = orders.first()
+        self.assertEqual(order.total, order.get_total_price())
+
+
+class BenchmarkRunTest(TransactionTestCase):
+    # the runner counts queries on every connection, the read replica included
+    databases = {'default', 'readonly'}
+
+    def test_bench_api(self):
+        call_command('generate_data', categories = 2, products = 20, users = 2, orders = 4,
+                     prefix = 'bench', stdout = io.StringIO())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            call_command('bench_api', requests = 2, concurrency = 1, only = ['product', 'orders'],
+                         host = 'testserver', save = path, stdout = io.StringIO())
+            with open(path) as f:
+                scenarios = json.load(f)['scenarios']
+        self.assertEqual(set(scenarios), {'product', 'orders'})
+        self.assertEqual(scenarios['product']['statuses'], [200])
+        self.assertEqual(scenarios['product']['requests'], 2)
+        self.assertEqual(scenarios['product']['queries'], 1)
+
+
+class ProfilingTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        override = self.settings(PROFILING_DIR = self.directory, PROFILING_KEEP = 2)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_not_profiled_by_default(self):
+        response = self.client.get("/api/categories")
+        self.assertNotIn('X-Profile-Id', response)
+        response = self.client.get("/api/categories", HTTP_X_PROFILE = 'forged')
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_profile_with_token(self):
+        response = self.client.get("/api/product/2", HTTP_X_PROFILE = make_token())
+        self.assertEqual(response.status_code, 200)
+        profile_id = response['X-Profile-Id']
+        stats = pstats.Stats(os.path.join(self.directory, f'{profile_id}.prof'))
+        self.assertTrue(stats.total_calls)
+        with open(os.path.join(self.directory, f'{profile_id}.json')) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['path'], '/api/product/2')
+        self.assertEqual(summary['status'], 200)
+        self.assertEqual(summary['query_count'], 1)
+        self.assertIn('myproject_product', summary['queries'][0]['sql'])
+        self.assertTrue(summary['hot_functions'])
+
+    async def test_profile_async(self):
+        response = await AsyncClient().get("/api/order/items/3/", headers = {"X-Profile": make_token()})
+        with open(os.path.join(self.directory, f'{response["X-Profile-Id"]}.json')) as f:
+            self.assertEqual(json.load(f)['query_count'], 2)
+
+    def test_sampling_and_ring_buffer(self):
+        with self.settings(PROFILING_SAMPLE_RATE = 1.0):
+            ids = [self.client.get("/api/categories")['X-Profile-Id'] for _ in range(3)]
+            self.assertNotIn('X-Profile-Id', self.client.get("/admin/login/"))
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(f'{profile_id}{ext}' for profile_id in ids[1:] for ext in ('.json', '.prof')))
+
+    def test_staff_endpoints(self):
+        self.assertEqual(self.client.get("/api/profiles").status_code, 401)
+        User.objects.create_user(username = 'plain', password = 'plain')
+        self.client.login(username = 'plain', password = 'plain')
+        self.assertEqual(self.client.get("/api/profiles").status_code, 403)
+
+        User.objects.create_user(username = 'staff', password = 'staff', is_staff = True)
+        self.client.login(username = 'staff', password = 'staff')
+        token = self.client.post("/api/profiles/token").json()['token']
+        profile_id = self.client.get("/api/categories", HTTP_X_PROFILE = token)['X-Profile-Id']
+        profiles = self.client.get("/api/profiles").json()
+        self.assertEqual([p['id'] for p in profiles], [profile_id])
+        self.assertNotIn('queries', profiles[0])
+        self.assertEqual(self.client.get(f"/api/profiles/{profile_id}").json()['id'], profile_id)
+        response = self.client.get(f"/api/profiles/{profile_id}/download")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content))
+        self.assertEqual(self.client.get("/api/profiles/..%2Fdb/download").status_code, 404)
+
+
+class MetricsTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        override = self.settings(METRICS_DIR = self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        patcher = mock.patch('myproject.metrics.registry', Registry())
+        self.registry = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scrape(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode().splitlines()
+
+    def test_route_metrics(self):
+        self.client.get("/api/product/2")
+        self.client.get("/api/product/3")
+        self.client.get("/api/product/404")
+        self.client.get("/nowhere")
+        lines = self.scrape()
+        labels = 'method="GET",route="/api/product/<product_id>"'
+        self.assertIn(f'myproject_http_requests_total{{{labels},status="200"}} 2', lines)
+        self.assertIn(f'myproject_http_requests_total{{{labels},status="404"}} 1', lines)
+        self.assertIn(f'myproject_http_request_duration_seconds_count{{{labels}}} 3', lines)
+        self.assertIn(f'myproject_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3', lines)
+        self.assertIn(f'myproject_db_queries_total{{{labels}}} 3', lines)
+        self.assertIn('myproject_http_requests_total{method="GET",route="<unmatched>",status="404"} 1', lines)
+        self.assertIn('# TYPE myproject_http_request_duration_seconds histogram', lines)
+
+    def test_streamed_bytes(self):
+        response = self.client.get("/api/export/products")
+        size = len(b''.join(response.streaming_content))
+        lines = self.scrape()
+        self.assertIn(f'myproject_http_response_size_bytes_total{{method="GET",route="/api/export/products"}} {size}', lines)
+
+    def test_workers_aggregated(self):
+        self.client.get("/api/categories")
+        other = Registry()
+        other.observe('GET', '/api/categories', 200, 0.2, [('default', 'SELECT 1', 0.01)], 10)
+        other.flush()
+        lines = self.scrape()
+        labels = 'method="GET",route="/api/categories"'
+        self.assertIn(f'myproject_http_requests_total{{{labels},status="200"}} 2', lines)
+        self.assertIn(f'myproject_http_request_duration_seconds_bucket{{{labels},le="0.25"}} 2', lines)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+    def test_finished_threads_folded(self):
+        def request():
+            self.registry.observe('GET', '/api/categories', 200, 0.01, [], 10)
+        for _ in range(3):
+            thread = threading.Thread(target = request)
+            thread.start()
+            thread.join()
+        request()
+        totals = self.registry.snapshot()
+        self.assertEqual(totals['GET /api/categories']['statuses'], {'200': 4})
+        self.assertEqual(len(self.registry.shards), 1)  # this thread's
+        self.assertEqual(self.registry.snapshot()['GET /api/categories']['response_bytes'], 40)
+
+    def test_allowed_addresses(self):
+        self.assertEqual(Client(REMOTE_ADDR = '203.0.113.5').get("/metrics").status_code, 403)
+        with self.settings(METRICS_ALLOWED_IPS = ['203.0.113.0/24']):
+            self.assertEqual(Client(REMOTE_ADDR = '203.0.113.5').get("/metrics").status_code, 200)
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+        with self.settings(METRICS_ALLOWED_IPS = None):
+            self.assertEqual(Client(REMOTE_ADDR = '203.0.113.5').get("/metrics").status_code, 200)
+
+
+class FacetTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def test_facets(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/products/facets?buckets=4")
+        self.assertEqual(response.status_code, 200)
+        facets = response.json()
+        self.assertEqual(facets['count'], 5)
+        self.assertEqual(facets['price'], {'min': 20.0, 'max': 100.0})
+        self.assertEqual([(c['slug'], c['count']) for c in facets['categories']],
+                         [('cat3', 2), ('aoaoa', 1), ('new-cat', 1), ('slay', 1)])
+        self.assertEqual(facets['price_buckets'], [
+            {'min': 20.0, 'max': 40.0, 'count': 2},
+            {'min': 40.0, 'max': 60.0, 'count': 2},
+            {'min': 60.0, 'max': 80.0, 'count': 0},
+            {'min': 80.0, 'max': 100.0, 'count': 0},
+            {'min': 100.0, 'max': 120.0, 'count': 1},
+        ])
+
+    def test_facets_filtered(self):
+        facets = self.client.get("/api/products/facets?category=2&min_price=30").json()
+        self.assertEqual(facets['count'], 1)
+        self.assertEqual(facets['price_buckets'], [{'min': 50.0, 'max': 50.0, 'count': 1}])
+        facets = self.client.get("/api/products/facets?title=nothing").json()
+        self.assertEqual(facets, {'count': 0, 'price': {'min': None, 'max': None},
+                                  'categories': [], 'price_buckets': []})
+        self.assertEqual(self.client.get("/api/products/facets?buckets=0").status_code, 422)
+
+    def test_price_buckets_whole_widths(self):
+        products = Product.objects.bulk_create(
+            Product(category_id = 1, title = f'p{price}', slug = f'p{price}', price = price) for price in (7, 8, 9, 60, 80)
+        )
+        queryset = Product.objects.filter(id__in = [product.id for product in products[:3]])
+        # a 2 unit range in 50 buckets: one bucket per whole price, none left empty in between
+        self.assertEqual(price_buckets(queryset, 7, 9, 50), [
+            {'min': 7.0, 'max': 8.0, 'count': 1},
+            {'min': 8.0, 'max': 9.0, 'count': 1},
+            {'min': 9.0, 'max': 10.0, 'count': 1},
+        ])
+        queryset = Product.objects.filter(id__in = [product.id for product in products[2:]])
+        self.assertEqual([bucket['count'] for bucket in price_buckets(queryset, 9, 80, 3)], [1, 0, 1, 1])
+
+    def test_facets_cached_until_product_write(self):
+        self.client.get("/api/products/facets")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get("/api/products/facets").json()['count'], 5)
+        with self.captureOnCommitCallbacks(execute = True):
+            Product.objects.create(category_id = 5, title = 'rat king', slug = 'rat-king', description = '', price = 300)
+        self.assertEqual(self.client.get("/api/products/facets").json()['count'], 6)
+
+
+class CategoryStatsTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def stats(self, pk):
+        category = Category.objects.get(pk = pk)
+        return category.product_count, category.min_price, category.max_price, category.avg_price
+
+    def test_product_writes(self):
+        Product.objects.create(category_id = 5, title = 'rat king', slug = 'rat-king', description = '', price = 50)
+        self.assertEqual(self.stats(5), (2, 50, 100, 75))
+
+        product = Product.objects.get(pk = 6)
+        product.price = 10
+        product.save()
+        self.assertEqual(self.stats(5), (2, 10, 50, 30))
+
+        product = Product.objects.get(pk = 2)
+        product.category_id = 5
+        product.save()
+        self.assertEqual(self.stats(1), (0, None, None, None))
+        self.assertEqual(self.stats(5), (3, 10, 50, 28))
+
+        Product.objects.get(pk = 6).delete()
+        self.assertEqual(self.stats(5), (2, 24, 50, 37))
+        Category.objects.get(pk = 5).delete()
+
+    def test_failed_save_keeps_stats(self):
+        before = self.stats(1), self.stats(5)
+        product = Product.objects.get(pk = 2)
+        product.category_id = 5
+        with mock.patch('myproject.signals.category_stats.product_added', side_effect = RuntimeError):
+            with self.assertRaises(RuntimeError):
+                product.save()
+        self.assertEqual(Product.objects.get(pk = 2).category_id, 1)
+        self.assertEqual((self.stats(1), self.stats(5)), before)
+
+        with mock.patch('myproject.signals.category_stats.product_removed', side_effect = RuntimeError):
+            with self.assertRaises(RuntimeError):
+                Product.objects.get(pk = 2).delete()
+        self.assertTrue(Product.objects.filter(pk = 2).exists())
+        self.assertEqual((self.stats(1), self.stats(5)), before)
+
+    def test_list_categories(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/categories")
+        cat3 = next(c for c in response.json() if c['slug'] == 'cat3')
+        self.assertEqual(cat3, {'id': 2, 'title': 'category3', 'slug': 'cat3', 'product_count': 2,
+                                'min_price': 20.0, 'max_price': 50.0, 'avg_price': 35.0})
+        with self.captureOnCommitCallbacks(execute = True):
+            self.client.delete("/api/products/3")
+        cat3 = next(c for c in self.client.get("/api/categories").json() if c['slug'] == 'cat3')
+        self.assertEqual((cat3['product_count'], cat3['max_price']), (1, 20.0))
+        self.assertEqual(self.client.get("/api/category/cat3").json()['product_count'], 1)
+
+    def test_import_refreshes_stats(self):
+        rows = 'title,slug,category,description,price\nratew,rat,aoaoa,,4\nrat two,rat-two,aoaoa,,8\n'
+        import_products(io.BytesIO(rows.encode()), 'csv')
+        self.assertEqual(self.stats(1), (2, 4, 8, 6))
+
+    def test_reconcile(self):
+        Category.objects.filter(pk = 2).update(product_count = 7, min_price = None)
+        out = io.StringIO()
+        call_command('reconcile_category_stats', dry_run = True, stdout = out)
+        self.assertIn('cat3: product_count 7 -> 2, min_price None -> 20', out.getvalue())
+        self.assertEqual(self.stats(2)[0], 7)
+        call_command('reconcile_category_stats', stdout = out)
+        self.assertEqual(self.stats(2), (2, 20, 50, 35))
+        call_command('reconcile_category_stats', stdout = out)
+        self.assertTrue(out.getvalue().endswith('0 of 4 categories fixed\n'))
+
+
+class WishlistBatchTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        self.user = User.objects.get(username = 'test')
+
+    def batch(self, operations, user = None):
+        data = {'user': user or self.user.id, 'operations': operations}
+        return self.client.post("/api/wishlist/batch", content_type = 'application/json', data = data)
+
+    def quantities(self):
+        return dict(Wishlist.objects.filter(user = self.user).values_list('product_id', 'quantity'))
+
+    def test_batch(self):
+        operations = [
+            {'product': 3, 'delta': 2},       # existing row: 3 + 2
+            {'product': 2, 'delta': -10},     # below zero: deleted
+            {'product': 4, 'delta': 1},       # new row
+            {'product': 4, 'delta': 1},
+            {'product': 5, 'quantity': 7},    # new row with an absolute quantity
+            {'product': 6, 'quantity': 2},
+            {'product': 6, 'delta': -1},
+        ]
+        with self.assertNumQueries(9):  # user, products, savepoint, 4 statements, release, result
+            response = self.batch(operations)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(item['product']['id'], item['quantity']) for item in response.json()],
+                         [(3, 5), (4, 2), (5, 7), (6, 1)])
+        self.assertEqual(self.quantities(), {3: 5, 4: 2, 5: 7, 6: 1})
+
+        self.batch([{'product': 3, 'quantity': 0}, {'product': 4, 'delta': -1}])
+        self.assertEqual(self.quantities(), {4: 1, 5: 7, 6: 1})
+
+    def test_batch_validation(self):
+        self.assertEqual(self.batch([{'product': 3}]).status_code, 422)
+        self.assertEqual(self.batch([{'product': 3, 'delta': 1, 'quantity': 1}]).status_code, 422)
+        self.assertEqual(self.batch([{'product': 3, 'quantity': -1}]).status_code, 422)
+        self.assertEqual(self.batch([]).status_code, 422)
+        self.assertEqual(self.batch([{'product': 404, 'delta': 1}]).status_code, 404)
+        self.assertEqual(self.batch([{'product': 3, 'delta': 1}], user = 404).status_code, 404)
+        self.assertEqual(self.quantities(), {3: 3, 2: 5})
+
+    def test_add_remove_are_increments(self):
+        wishlist = Wishlist.objects.get(pk = 1)
+        self.client.put("/api/wishlist/add?wishlist_id=1")
+        wishlist.refresh_from_db()
+        self.assertEqual(wishlist.quantity, 4)
+        for _ in range(4):
+            response = self.client.put("/api/wishlist/remove?wishlist_id=1")
+        self.assertEqual(response.json()['quantity'], 0)
+        self.assertFalse(Wishlist.objects.filter(pk = 1).exists())
+        self.assertEqual(self.client.put("/api/wishlist/add?wishlist_id=1").status_code, 404)
+
+    def test_create_wishlist_upsert(self):
+        data = {'user': self.user.id, 'product': 3, 'quantity': 9}
+        with self.assertNumQueries(3):
+            response = self.client.post("/api/create_wishlist", content_type = 'application/json', data = data)
+        self.assertEqual(response.json()['quantity'], 9)
+        self.assertEqual(self.quantities(), {3: 9, 2: 5})
+
+
+class TokenAuthTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        users.clear()
+
+    def token(self, username = 'admin', password = 'admin'):
+        response = Client().post("/api/login", content_type = 'application/json',
+                                 data = {"username": username, "password": password})
+        return response.json()['token']
+
+    def test_bearer_token(self):
+        token = self.token()
+        self.assertEqual(self.client.get("/api/user").status_code, 401)
+        response = self.client.get("/api/user", HTTP_AUTHORIZATION = f'Bearer {token}')
+        self.assertEqual(response.json(), 'admin')
+        with self.assertNumQueries(0):  # HMAC check, user from the LRU
+            self.client.get("/api/user", HTTP_AUTHORIZATION = f'Bearer {token}')
+        self.assertEqual(self.client.get("/api/user", HTTP_AUTHORIZATION = f'Bearer {token}x').status_code, 401)
+        with self.settings(API_TOKEN_MAX_AGE = -1):
+            self.assertEqual(self.client.get("/api/user", HTTP_AUTHORIZATION = f'Bearer {token}').status_code, 401)
+
+    def test_token_auth_operations(self):
+        token = self.token()
+        self.assertEqual(self.client.get("/api/profiles").status_code, 401)
+        self.assertEqual(self.client.get("/api/profiles", HTTP_AUTHORIZATION = f'Bearer {token}').status_code, 200)
+        self.assertEqual(self.client.post("/api/token/refresh").status_code, 401)
+        response = self.client.post("/api/token/refresh", HTTP_AUTHORIZATION = f'Bearer {token}')
+        self.assertEqual(verify_token(response.json()['token'])['id'], verify_token(token)['id'])
+
+    def test_password_change_voids_token(self):
+        token = self.token()
+        self.client.get("/api/user", HTTP_AUTHORIZATION = f'Bearer {token}')
+        user = User.objects.get(username = 'admin')
+        user.set_password('changed')
+        user.save()
+        self.assertEqual(self.client.get("/api/user", HTTP_AUTHORIZATION = f'Bearer {token}').status_code, 401)
+
+    def test_session_user_cached(self):
+        self.client.post("/api/login", content_type = 'application/json', data = {"username": "admin", "password": "admin"})
+        self.client.get("/api/user")
+        with self.assertNumQueries(0):  # session from the cache, user from the LRU
+            self.assertEqual(self.client.get("/api/user").json(), 'admin')
+
+    def test_ttl_cache(self):
+        lru = TTLCache(maxsize = 2, ttl = 60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)  # evicts b, the least recently used
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+        with mock.patch('myproject.lru.time.monotonic', return_value = time.monotonic() + 61):
+            self.assertIsNone(lru.get('a'))
+        self.assertEqual(len(lru), 1)
+
+
+class RateLimitTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def login(self, client = None):
+        return (client or self.client).post("/api/login", content_type = 'application/json',
+                                            data = {"username": "admin", "password": "wrong"})
+
+    def test_login_limited_by_address(self):
+        now = time.time()
+        # the clock stands still: password hashing between requests would refill the bucket
+        with self.settings(RATE_LIMITS = {'login': '2/m'}), \
+                mock.patch('myproject.ratelimit.time.time', return_value = now) as clock:
+            self.assertEqual(self.login().status_code, 401)
+            self.assertEqual(self.login(Client()).status_code, 401)  # another session, same address
+            response = self.login()
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '30')
+            clock.return_value = now + 30
+            self.assertEqual(self.login().status_code, 401)
+            self.assertEqual(self.login(Client(REMOTE_ADDR = '10.0.0.2')).status_code, 401)
+
+    def test_made_up_sessions_share_the_address(self):
+        with self.settings(RATE_LIMITS = {'text_search': '1/m'}):
+            statuses = []
+            for q in ('rat', 'big', 'small'):
+                client = Client()
+                client.cookies[settings.SESSION_COOKIE_NAME] = uuid.uuid4().hex
+                statuses.append(client.get("/api/products/search", {'q': q}).status_code)
+            self.assertEqual(statuses, [200, 429, 429])
+            # a logged-in session is its user's bucket, wherever it comes from
+            self.client.login(username = 'admin', password = 'admin')
+            self.assertEqual(self.client.get("/api/products/search?q=slayer").status_code, 200)
+            self.assertEqual(self.client.get("/api/products/search?q=old").status_code, 429)
+
+    def test_text_filters_limited_by_user(self):
+        token = self.token()
+        with self.settings(RATE_LIMITS = {'text_search': '1/m'}):
+            self.assertEqual(self.client.get("/api/products?title=rat").status_code, 200)
+            self.assertEqual(self.client.get("/api/products?title=rat").status_code, 200)  # cached
+            self.assertEqual(self.client.get("/api/products?title=big").status_code, 429)
+            self.assertEqual(self.client.get("/api/products?min_price=1").status_code, 200)  # no text filter
+            self.assertEqual(self.client.get("/api/products/search?q=rat").status_code, 429)
+            auth = {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+            self.assertEqual(self.client.get("/api/products/search?q=big", **auth).status_code, 200)
+            self.assertEqual(self.client.get("/api/products/search?q=small", **auth).status_code, 429)
+        with self.settings(RATE_LIMITS = {}):
+            self.assertEqual(self.client.get("/api/products/search?q=slayer").status_code, 200)
+
+    def token(self):
+        return Client().post("/api/login", content_type = 'application/json',
+                             data = {"username": "admin", "password": "admin"}).json()['token']
+
+
+class JSONRendererTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+
+    def test_same_values_as_default_renderer(self):
+        data = {
+            'price': Decimal('10.50'),
+            'created_at': datetime.datetime(2024, 3, 1, 12, 30, 15, 123456, tzinfo = datetime.timezone.utc),
+            'day': datetime.date(2024, 3, 1),
+            'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+            'items': [{'title': 'Крыса', 'count': 3, 'share': 0.25, 'missing': None}],
+            1: 'non-string key',
+        }
+        fast = json.loads(ORJSONRenderer().render(None, data, response_status = 200))
+        self.assertEqual(fast, json.loads(JSONRenderer().render(None, data, response_status = 200)))
+        self.assertEqual(fast['price'], '10.50')
+        self.assertEqual(fast['created_at'], '2024-03-01T12:30:15.123Z')
+
+    def test_api_round_trip(self):
+        response = self.client.get("/api/products")
+        self.assertEqual(response['Content-Type'], 'application/json; charset=utf-8')
+        self.assertEqual(len(response.json()['items']), 5)
+        response = self.client.post("/api/create_category", content_type = 'application/json',
+                                    data = {"title": "Ёжики", "slug": "hedgehogs"})
+        self.assertEqual(Category.objects.get(id = response.json()['id']).title, "Ёжики")
+        response = self.client.post("/api/create_category", content_type = 'application/json', data = '{"title": ')
+        self.assertEqual(response.status_code, 400)
+
+
+class ProductBatchTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        product_cache.products.clear()
+
+    def test_batch(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/products/batch?ids=5&ids=999&ids=2&ids=5")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([item['id'] for item in data['items']], [5, 2])
+        self.assertEqual(data['items'][1]['title'], 'ratew')
+        self.assertEqual(data['missing'], [999])
+        self.assertEqual(data['items'][0], self.client.get("/api/product/5").json())
+        # hits cost no query, only the misses are fetched
+        with self.assertNumQueries(0):
+            self.client.get("/api/products/batch?ids=2&ids=5")
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/products/batch?ids=2&ids=3&ids=4")
+        self.assertEqual(len(response.json()['items']), 3)
+        self.assertEqual(self.client.get("/api/products/batch").status_code, 422)
+        ids = '&'.join(f'ids={i}' for i in range(product_cache.MAX_IDS + 1))
+        self.assertEqual(self.client.get(f"/api/products/batch?{ids}").status_code, 422)
+
+    def test_writes_invalidate(self):
+        self.client.get("/api/products/batch?ids=2&ids=3")
+        product = Product.objects.get(id = 2)
+        product.title = 'renamed rat'
+        with mock.patch('myproject.signals.schedule_variants') as schedule, \
+                self.captureOnCommitCallbacks(execute = True):
+            product.save()
+        schedule.assert_called_once_with(product.image.name)
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/products/batch?ids=2&ids=3")
+        self.assertEqual(response.json()['items'][0]['title'], 'renamed rat')
+        with self.captureOnCommitCallbacks(execute = True):
+            Product.objects.get(id = 3).delete()
+        self.assertEqual(self.client.get("/api/products/batch?ids=2&ids=3").json()['missing'], [3])
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def fetch(keys):
+            calls.append(keys)
+            started.set()
+            release.wait(5)
+            return {key: key * 10 for key in keys if key != 3}
+
+        results = {}
+        leader = threading.Thread(target = lambda: results.update(a = flights.fetch_many([1, 2, 3], fetch)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target = lambda: results.update(b = flights.fetch_many([2, 3, 4], fetch)))
+        follower.start()
+        while 4 not in flights.calls:  # the follower has joined the leader's keys
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(calls, [[1, 2, 3], [4]])
+        self.assertEqual(results['a'], {1: 10, 2: 20})
+        self.assertEqual(results['b'], {2: 20, 4: 40})
+
+
+class SparseFieldsTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def test_products(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/products?fields=id,title&limit=2")
+        self.assertEqual(response.json()['items'], [{'id': 6, 'title': 'rat slayer'}, {'id': 2, 'title': 'ratew'}])
+        sql = queries[-1]['sql']
+        self.assertNotIn('description', sql)
+        self.assertNotIn('price', sql)
+        cursor = response.json()['next_cursor']
+        response = self.client.get(f"/api/products?fields=price&limit=2&cursor={cursor}")
+        self.assertEqual([set(item) for item in response.json()['items']], [{'price'}, {'price'}])
+        full = self.client.get("/api/products").json()['items']
+        self.assertEqual(set(full[0]), {'id', 'title', 'slug', 'category_id', 'description', 'price', 'variants'})
+        response = self.client.get("/api/products/search?q=rat&fields=title,variants")
+        self.assertEqual({tuple(item) for item in response.json()['items']}, {('title', 'variants')})
+
+    def test_orders(self):
+        full = self.client.get("/api/get_orders").json()['items']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/get_orders?fields=quantity,product.title,order.status")
+        items = response.json()['items']
+        self.assertEqual(items[0], {
+            'quantity': full[0]['quantity'],
+            'product': {'title': full[0]['product']['title']},
+            'order': {'status': full[0]['order']['status']},
+        })
+        self.assertNotIn('description', queries[-1]['sql'])
+        # product.id is the foreign key column, no join
+        response = self.client.get("/api/get_orders?fields=product.id,price")
+        self.assertEqual(response.json()['items'][0], {'product': {'id': full[0]['product']['id']}, 'price': full[0]['price']})
+        response = self.client.get("/api/get_orders?fields=product.nope,quantity")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['detail'], 'Unknown fields: product.nope')
+
+
+@override_settings(COMPRESSION_MIN_SIZE = 100)
+class CompressionTest(TestCase):
+    fixtures = ['db.json']
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+
+    def test_accepted_encoding(self):
+        def accepted(header):
+            return accepted_encoding(RequestFactory().get('/', HTTP_ACCEPT_ENCODING = header))
+        with mock.patch.dict(compression.COMPRESSORS, {'br': compression._brotli, 'gzip': compression._gzip}, clear = True):
+            self.assertEqual(accepted('gzip, deflate, br'), 'br')
+            self.assertEqual(accepted('gzip, br;q=0.5'), 'gzip')
+            self.assertEqual(accepted('br;q=0, *'), 'gzip')
+            self.assertIsNone(accepted('identity'))
+            self.assertIsNone(accepted('gzip;q=0'))
+            self.assertIsNone(accepted(''))
+
+    def test_cached_response_compressed_once(self):
+        identity = self.client.get("/api/products")
+        self.assertNotIn('Content-Encoding', identity)
+        self.assertIn('Accept-Encoding', identity['Vary'])
+        with mock.patch('myproject.cache.compress', wraps = compression.compress) as compress:
+            first = self.client.get("/api/products", HTTP_ACCEPT_ENCODING = 'gzip')
+            second = self.client.get("/api/products", HTTP_ACCEPT_ENCODING = 'gzip')
+        self.assertEqual(compress.call_count, 1)
+        for response in (first, second):
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['ETag'], 'W/' + identity['ETag'])
+            self.assertEqual(gzip.decompress(response.content), identity.content)
+        response = self.client.get("/api/products", HTTP_ACCEPT_ENCODING = 'gzip', HTTP_IF_NONE_MATCH = first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_cached_response_not_smaller(self):
+        identity = self.client.get("/api/products")
+        # a compressor whose output is never smaller: encode() declines it, here and in the middleware
+        with mock.patch.dict(compression.COMPRESSORS, {'gzip': lambda content: content + b'!'}), \
+                mock.patch('myproject.cache.cache.set', wraps = cache.set) as cache_set:
+            first = self.client.get("/api/products", HTTP_ACCEPT_ENCODING = 'gzip')
+            second = self.client.get("/api/products", HTTP_ACCEPT_ENCODING = 'gzip')
+        self.assertEqual([call.args[1] for call in cache_set.call_args_list if call.args[0].endswith(':gzip')],
+                         [cache_module.IDENTITY])
+        for response in (first, second):
+            self.assertNotIn('Content-Encoding', response)
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertEqual(response['ETag'], identity['ETag'])
+            self.assertEqual(response.content, identity.content)
+
+    def test_middleware(self):
+        response = self.client.get("/api/get_orders", HTTP_ACCEPT_ENCODING = 'gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(json.loads(gzip.decompress(response.content))['items'],
+                         self.client.get("/api/get_orders").json()['items'])
+        with self.settings(COMPRESSION_MIN_SIZE = 10 ** 6):
+            response = self.client.get("/api/get_orders", HTTP_ACCEPT_ENCODING = 'gzip')
+        self.assertNotIn('Content-Encoding', response)
+
+
+class MediaTest(TestCase):
+    fixtures = ['db.json']
+    CONTENT = bytes(range(256)) * 40
+
+    def setUp(self):
+        self.client = Client()
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        override = self.settings(MEDIA_ROOT = media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        storage = Product._meta.get_field('image').storage
+        self.name = storage.save('images/rat.jpg', ContentFile(self.CONTENT))
+        self.url = f'/media/{self.name}'
+        self.plain = storage.path('images/plain.png')
+        with open(self.plain, 'wb') as f:
+            f.write(b'png bytes')
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_whole_file(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.CONTENT)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Content-Length'], str(len(self.CONTENT)))
+        self.assertEqual(response['ETag'], '"%s"' % self.name[7:-4])
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH = response['ETag']).status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE = response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/media/images/plain.png')
+        self.assertEqual(self.body(response), b'png bytes')
+        self.assertEqual(response['Cache-Control'], f'public, max-age={settings.MEDIA_MAX_AGE}')
+
+    def test_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE = 'bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), self.CONTENT[2:6])
+        self.assertEqual(response['Content-Range'], f'bytes 2-5/{len(self.CONTENT)}')
+        response = self.client.get(self.url, HTTP_RANGE = 'bytes=-3')
+        self.assertEqual(self.body(response), self.CONTENT[-3:])
+        response = self.client.get(self.url, HTTP_RANGE = 'bytes=10000-')
+        self.assertEqual(self.body(response), self.CONTENT[10000:])
+        self.assertEqual(len(self.body(self.client.get(self.url, HTTP_RANGE = 'bytes=100-99999'))), len(self.CONTENT) - 100)
+        response = self.client.get(self.url, HTTP_RANGE = f'bytes={len(self.CONTENT)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.CONTENT)}')
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE = 'bytes=0-1', HTTP_IF_RANGE = etag).status_code, 206)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE = 'bytes=0-1', HTTP_IF_RANGE = '"old"').status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE = 'bytes=0-1,5-6').status_code, 200)
+
+    def test_metrics_keep_file_response(self):
+        middleware = MetricsMiddleware(lambda request: serve(request, self.name))
+        with mock.patch('myproject.metrics.registry', Registry()), self.settings(METRICS_DIR = None):
+            response = middleware(RequestFactory().get(self.url))
+        # still a file for wsgi.file_wrapper, i.e. sendfile()
+        self.assertIsNotNone(response.file_to_stream)
+        response.close()
+
+    def test_only_images(self):
+        for url in ('/media/images/missing.jpg', '/media/images/../myproject/settings.py',
+                    '/media/myproject/settings.py', '/media/images/.upload-x', '/media/images/'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+
+    def test_accel(self):
+        with self.settings(MEDIA_ACCEL = 'x-accel-redirect'):
+            response = self.client.get(self.url, HTTP_RANGE = 'bytes=2-5')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], settings.MEDIA_ACCEL_PREFIX + self.name)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], '"%s"' % self.name[7:-4])
+        with self.settings(MEDIA_ACCEL = 'x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(settings.MEDIA_ROOT, self.name))
+
+    def test_product_image(self):
+        Product.objects.filter(id = 2).update(image = self.name, variants = {'thumb_jpeg': 'images/plain.png'},
+                                              variants_source = self.name)
+        response = self.client.get("/api/product/2/image")
+        self.assertEqual(self.body(response), self.CONTENT)
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+        self.assertEqual(self.body(self.client.get("/api/product/2/image?variant=thumb_jpeg")), b'png bytes')
+        self.assertEqual(self.client.get("/api/product/2/image?variant=thumb_webp").status_code, 404)
+        self.assertEqual(self.client.get("/api/product/2/image?variant=huge").status_code, 400)
+        self.assertEqual(self.client.get("/api/product/999/image").status_code, 404)
+
+
+class JobTasks:
+    # test tasks registered for the duration of a test
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.calls = []
+        patcher = mock.patch.dict(jobs.TASKS, {'test.record': self.record, 'test.fail': self.broken})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, **args):
+        self.calls.append(args)
+        return args
+
+    def broken(self, **args):
+        raise RuntimeError('boom')
+
+
+class JobQueueTest(JobTasks, TestCase):
+    fixtures = ['db.json']
+
+    def test_claim_by_priority(self):
+        low = enqueue('test.record', n = 1)
+        high = enqueue('test.record', priority = 5, n = 2)
+        later = enqueue('test.record', priority = 9, delay = 60)
+        claimed = claim('worker', 5)
+        self.assertEqual([job.id for job in claimed], [high.id, low.id])
+        self.assertTrue(all(job.status == Job.RUNNING and job.attempts == 1 for job in claimed))
+        # nothing left that is due
+        self.assertEqual(claim('other', 5), [])
+        self.assertEqual(Job.objects.get(id = later.id).status, Job.QUEUED)
+
+        self.assertEqual(execute(high.id), Job.SUCCEEDED)
+        job = Job.objects.get(id = high.id)
+        self.assertEqual((job.result, job.locked_by), ({'n': 2}, ''))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_unknown_task(self):
+        with self.assertRaises(ValueError):
+            enqueue('test.missing')
+        job = Job.objects.create(name = 'test.missing', run_at = datetime.datetime.now(datetime.timezone.utc), max_attempts = 5)
+        claim('worker', 1)
+        self.assertEqual(execute(job.id), Job.FAILED)
+        self.assertIn('Unknown task', Job.objects.get(id = job.id).last_error)
+
+    def test_retry_with_backoff(self):
+        job = enqueue('test.fail', max_attempts = 2)
+        claim('worker', 1)
+        self.assertEqual(execute(job.id), Job.QUEUED)
+        job.refresh_from_db()
+        self.assertIn('RuntimeError: boom', job.last_error)
+        delay = (job.run_at - job.created_at).total_seconds()
+        self.assertGreaterEqual(delay, settings.JOB_RETRY_BASE / 2)
+        self.assertEqual(claim('worker', 1), [])
+
+        Job.objects.filter(id = job.id).update(run_at = job.created_at)
+        claim('worker', 1)
+        self.assertEqual(execute(job.id), Job.FAILED)
+        job.refresh_from_db()
+        self.assertEqual((job.attempts, job.status), (2, Job.FAILED))
+        self.assertLessEqual(jobs.backoff(30), settings.JOB_RETRY_MAX)
+
+    def test_requeue_stale(self):
+        job = enqueue('test.record')
+        spent = enqueue('test.record', max_attempts = 1)
+        claim('dead', 2)
+        Job.objects.update(locked_at = F('locked_at') - datetime.timedelta(seconds = settings.JOB_TIMEOUT + 1))
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual(Job.objects.get(id = job.id).status, Job.QUEUED)
+        self.assertEqual(Job.objects.get(id = spent.id).status, Job.FAILED)
+        self.assertEqual([claimed.id for claimed in claim('alive', 2)], [job.id])
+
+    def test_image_variants_as_jobs(self):
+        with self.settings(IMAGE_VARIANT_BACKEND = 'jobs'):
+            from .images import schedule_variants
+            self.assertTrue(schedule_variants('images/missing.jpg'))
+        job = Job.objects.get()
+        self.assertEqual((job.name, job.args), ('images.build_variants', {'source': 'images/missing.jpg'}))
+        Product.objects.filter(id = 4).update(image = 'images/missing.jpg')
+        claim('worker', 1)
+        self.assertEqual(execute(job.id), Job.QUEUED)  # to be retried
+        self.assertFalse(Product.objects.get(id = 4).variants_ready)
+
+
+class JobWorkerTest(JobTasks, TransactionTestCase):
+    # jobs run in worker threads, which only see committed rows
+    fixtures = ['db.json']
+    databases = {'default', 'readonly'}
+
+    def test_run_jobs(self):
+        enqueue('test.record', n = 1)
+        enqueue('test.fail', max_attempts = 1)
+        out = io.StringIO()
+        call_command('run_jobs', '--once', '--workers', '1', stdout = out)
+        self.assertEqual(self.calls, [{'n': 1}])
+        self.assertIn('1 jobs succeeded, 0 to be retried, 1 failed', out.getvalue())
+
+    def test_order_endpoints(self):
+        data = {'order_ids': [3, 4], 'status_id': 2}
+        self.assertEqual(self.client.post("/api/orders/status", data, content_type = 'application/json').status_code, 401)
+        User.objects.create_user(username = 'plain', password = 'plain')
+        self.client.login(username = 'plain', password = 'plain')
+        self.assertEqual(self.client.post("/api/orders/status", data, content_type = 'application/json').status_code, 403)
+
+        User.objects.create_user(username = 'staff', password = 'staff', is_staff = True)
+        self.client.login(username = 'staff', password = 'staff')
+        response = self.client.post("/api/orders/status", data, content_type = 'application/json')
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual((job['name'], job['status']), ('orders.set_status', Job.QUEUED))
+        self.assertEqual(self.client.post("/api/orders/status", {'order_ids': [3], 'status_id': 99},
+                                          content_type = 'application/json').status_code, 404)
+
+        OrderItem.objects.filter(order_id = 3).update(quantity = 2)
+        response = self.client.post("/api/orders/recompute_totals", {'order_ids': [3], 'priority': 1},
+                                    content_type = 'application/json')
+        self.assertEqual(response.status_code, 202)
+        call_command('run_jobs', '--once', stdout = io.StringIO())
+
+        self.assertEqual(set(Order.objects.filter(id__in = [3, 4]).values_list('status_id', flat = True)), {2})
+        order = Order.objects.get(id = 3)
+        self.assertEqual(order.total, order.get_total_price())
+        status = self.client.get(f"/api/jobs/{job['id']}").json()
+        self.assertEqual((status['status'], status['result']), (Job.SUCCEEDED, {'updated': 2}))
+        self.assertEqual([job['name'] for job in self.client.get("/api/jobs?status=succeeded").json()],
+                         ['orders.recompute_totals', 'orders.set_status'])
+        self.assertEqual(self.client.get("/api/jobs/999").status_code, 404)
@@ -0,0 +1,93 @@
+import copy
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.utils.crypto import constant_time_compare
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+from ninja.security import HttpBearer
+
+from .lru import TTLCache
+
+SALT = 'myproject.tokens'
+# a token is void once the password changes: it carries a slice of the same hash
+# that logs sessions out on a password change
+HASH_LENGTH = 16
+
+users = TTLCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+
+def issue_token(user):
+    """A bearer token for `user`, valid for API_TOKEN_MAX_AGE seconds."""
+    return signing.dumps({'id': user.pk, 'hash': user.get_session_auth_hash()[:HASH_LENGTH]}, salt = SALT)
+
+
+def verify_token(token):
+    """The token's payload if its signature and age are valid, else None. Pure HMAC, no queries."""
+    try:
+        return signing.loads(token, salt = SALT, max_age = settings.API_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+
+def cached_user(user_id):
+    """The user with this id through the in-process LRU, or None. Every caller gets
+    its own copy, so a request mutating its user does not leak into another one."""
+    User = get_user_model()
+    try:
+        user_id = User._meta.pk.to_python(user_id)  # sessions store the id as a string
+    except ValidationError:
+        return None
+    user = users.get(user_id)
+    if user is None:
+        try:
+            user = User._default_manager.get(pk = user_id)
+        except User.DoesNotExist:
+            return None
+        users.set(user_id, user)
+    return copy.copy(user)
+
+
+def user_from_token(token):
+    payload = verify_token(token)
+    if not isinstance(payload, dict):
+        return None
+    user = cached_user(payload.get('id'))
+    if user is None or not user.is_active:
+        return None
+    if not constant_time_compare(payload.get('hash', ''), user.get_session_auth_hash()[:HASH_LENGTH]):
+        return None
+    return user
+
+
+class TokenAuth(HttpBearer):
+    """Ninja auth for `Authorization: Bearer <token>` issued by /login."""
+
+    def authenticate(self, request, token):
+        user = user_from_token(token)
+        if user is not None:
+            request.user = user
+        return user
+
+
+class BearerTokenMiddleware(MiddlewareMixin):
+    """Sets request.user from a bearer token, so views reading request.user work for
+    API clients as they do for browsers with a session cookie."""
+
+    def process_request(self, request):
+        scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme.lower() == 'bearer' and token:
+            request.user = SimpleLazyObject(lambda: user_from_token(token) or AnonymousUser())
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend resolving session users through the same LRU, so a request with
+    a (cached) session costs no auth_user query either."""
+
+    def get_user(self, user_id):
+        user = cached_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
@@ -15,10 +15,15 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
+from django.conf import settings
 from django.urls import path
 from .api import api
+from .media import serve
+from .metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/", api.urls),
+    path("metrics", metrics_view),
+    path(settings.MEDIA_URL.lstrip('/') + '<path:name>', serve, name='media'),
 ]
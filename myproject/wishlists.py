@@ -0,0 +1,81 @@
+from django.db import connections, router, transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.db.models.functions import Greatest
+
+from .models import Wishlist
+
+MAX_OPERATIONS = 500
+
+
+def merge_operations(operations):
+    """
+    Fold (product, delta, quantity) operations into one per product, in order:
+    {product: ('set', quantity) | ('add', delta)}. A set followed by deltas is
+    still a set; deltas after deltas add up.
+    """
+    merged = {}
+    for product, delta, quantity in operations:
+        if quantity is not None:
+            merged[product] = ('set', quantity)
+        else:
+            kind, value = merged.get(product, ('add', 0))
+            merged[product] = (kind, max(value + delta, 0) if kind == 'set' else value + delta)
+    return merged
+
+
+def increment(user_id, deltas):
+    """INSERT ... ON CONFLICT DO UPDATE adding `deltas` (all positive) to the user's
+    rows in one statement; SQLite 3.24+ and PostgreSQL share the syntax."""
+    table = Wishlist._meta.db_table
+    using = router.db_for_write(Wishlist)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    values = ', '.join(['(%s, %s, %s)'] * len(deltas))
+    params = [value for product, delta in deltas.items() for value in (user_id, product, delta)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {qn(table)} ({qn("user_id")}, {qn("product_id")}, {qn("quantity")}) '
+            f'VALUES {values} '
+            f'ON CONFLICT ({qn("user_id")}, {qn("product_id")}) '
+            f'DO UPDATE SET {qn("quantity")} = {qn(table)}.{qn("quantity")} + excluded.{qn("quantity")}',
+            params,
+        )
+
+
+def apply_operations(user_id, operations):
+    """
+    Apply wishlist operations for one user with database-side arithmetic, so
+    concurrent requests never lose an update. Whatever the number of operations
+    it runs at most four statements: an upsert-increment, a clamped decrement, an
+    upsert of absolute quantities and a delete of rows that reached zero.
+    Products must exist. Returns the product ids touched.
+    """
+    merged = merge_operations(operations)
+    increments = {product: value for product, (kind, value) in merged.items() if kind == 'add' and value > 0}
+    decrements = {product: value for product, (kind, value) in merged.items() if kind == 'add' and value < 0}
+    quantities = {product: value for product, (kind, value) in merged.items() if kind == 'set' and value > 0}
+    rows = Wishlist.objects.filter(user_id = user_id)
+
+    with transaction.atomic():
+        if increments:
+            increment(user_id, increments)
+        if decrements:
+            rows.filter(product_id__in = decrements).update(quantity = Greatest(
+                F('quantity') + Case(
+                    *(When(product_id = product, then = Value(delta)) for product, delta in decrements.items()),
+                    output_field = IntegerField(),
+                ),
+                0,
+            ))
+        if quantities:
+            Wishlist.objects.bulk_create(
+                [Wishlist(user_id = user_id, product_id = product, quantity = value)
+                 for product, value in quantities.items()],
+                update_conflicts = True,
+                unique_fields = ['user', 'product'],
+                update_fields = ['quantity'],
+            )
+        removed = [product for product, (kind, value) in merged.items() if kind == 'set' and value == 0]
+        if decrements or removed:
+            rows.filter(Q(product_id__in = removed) | Q(product_id__in = decrements, quantity__lte = 0)).delete()
+    return list(merged)